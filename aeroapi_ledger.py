@@ -0,0 +1,98 @@
+#Local tally of AeroAPI spend for the current billing cycle
+# The usage endpoint is only asked every so often. In between, each paid call adds an estimated
+# cost to the tally so we stay under the monthly limit without asking before every call.
+# The tally lives in shared memory so shard workers (PROCESS_WORKERS) can all count against the one
+# limit, see share()
+import datetime
+import multiprocessing
+import time
+import logging
+
+logger = logging.getLogger('AeroAPI_Ledger')
+
+#where each part of the tally sits in the shared array
+REPORTED, ESTIMATED, CALLS, LAST_RECONCILE, CYCLE, NEXT_TRY = range(6)
+#how long (seconds) to wait before asking for usage again when it couldn't be had, or while another
+# thread or process is already asking
+retry_seconds = 60
+
+class AeroApiLedger:
+    def __init__(self, fetch_usage, reconcile_interval, call_cost):
+        #fetch_usage() returns the total spent this billing cycle according to FlightAware, or None
+        self.fetch_usage = fetch_usage
+        self.reconcile_interval = reconcile_interval
+        self.call_cost = call_cost
+        #spawn's Array, as that's how shard workers are started. Its lock covers threads and processes.
+        # A last reconcile or cycle of 0 means there hasn't been one yet
+        self.state = multiprocessing.get_context('spawn').Array('d', 6)
+
+    def share(self, state):
+        #count against another ledger's tally from here on, the coordinator's in a shard worker
+        self.state = state
+
+    def billing_cycle(self):
+        #billing cycles start at the beginning of the month
+        today = datetime.datetime.today()
+        return today.year * 100 + today.month
+
+    def reset_if_new_cycle(self):
+        cycle = self.billing_cycle()
+        if cycle != self.state[CYCLE]:
+            if self.state[CYCLE] != 0:
+                logger.info("New AeroAPI billing cycle. Spend reset to $0")
+            self.state[CYCLE] = cycle
+            self.state[REPORTED] = 0.0
+            self.state[ESTIMATED] = 0.0
+            self.state[CALLS] = 0
+            self.state[LAST_RECONCILE] = 0
+            self.state[NEXT_TRY] = 0
+
+    def reconcile(self):
+        #FlightAware is asked outside the lock, so paid calls elsewhere don't wait on it.
+        # Times are wall clock rather than monotonic, as other processes compare against them
+        with self.state.get_lock():
+            self.reset_if_new_cycle()
+            now = time.time()
+            if now < self.state[NEXT_TRY]:
+                return
+            if self.state[LAST_RECONCILE] != 0 and now - self.state[LAST_RECONCILE] < self.reconcile_interval:
+                return
+            self.state[NEXT_TRY] = now + retry_seconds
+            cycle = self.state[CYCLE]
+            estimated = self.state[ESTIMATED]
+            calls = self.state[CALLS]
+        total = self.fetch_usage()
+        with self.state.get_lock():
+            if self.state[CYCLE] != cycle:
+                return
+            if total is None:
+                logger.info("Couldn't get AeroAPI usage, asking again in " + str(retry_seconds) + " seconds" +
+                            (". No paid lookups until it's known" if self.state[LAST_RECONCILE] == 0 else
+                             ". Carrying on with the local estimate of $" + str(round(self.total(), 4))))
+                return
+            logger.debug("AeroAPI usage reconciled. Estimated $" + str(round(self.state[REPORTED] + estimated, 4)) + ", actual $" + str(total) +
+                         " after " + str(int(calls)) + " calls")
+            self.state[LAST_RECONCILE] = time.time()
+            self.state[NEXT_TRY] = 0
+            self.state[REPORTED] = total
+            #calls made while we were asking may not be in FlightAware's total yet, so they stay estimated
+            self.state[ESTIMATED] = max(0.0, self.state[ESTIMATED] - estimated)
+            self.state[CALLS] = max(0, self.state[CALLS] - calls)
+
+    def total(self):
+        return self.state[REPORTED] + self.state[ESTIMATED]
+
+    def record_call(self):
+        with self.state.get_lock():
+            self.reset_if_new_cycle()
+            self.state[ESTIMATED] += self.call_cost
+            self.state[CALLS] += 1
+
+    def spent(self):
+        #None until FlightAware has told us what's been spent this cycle, so an unknown spend never passes for $0
+        self.reconcile()
+        with self.state.get_lock():
+            self.reset_if_new_cycle()
+            if self.state[LAST_RECONCILE] == 0:
+                return None
+            return self.total()
@@ -0,0 +1,59 @@
+#In-memory table of recently seen aircraft, keyed by ICAO hex
+# Mirrors the latest flights row for each hex so the debounce check and flight ID lookups
+# don't need a database round trip on every poll
+import logging
+
+logger = logging.getLogger('Aircraft_State')
+
+class AircraftState:
+    __slots__ = ('flight_id', 'timestamp', 'first_seen', 'last_seen', 'bsky_post')
+
+    def __init__(self, flight_id, timestamp, bsky_post=None):
+        self.flight_id = flight_id
+        #same value as flights.timestamp, which is what the debounce is measured against
+        self.timestamp = timestamp
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.bsky_post = bsky_post
+
+class AircraftStateTable:
+    def __init__(self):
+        self.aircraft = {}
+
+    def __len__(self):
+        return self.aircraft.__len__()
+
+    def get(self, hex):
+        return self.aircraft.get(hex, None)
+
+    def add(self, hex, flight_id, timestamp, bsky_post=None):
+        #a new flights row always replaces whatever we knew about this hex before
+        self.aircraft[hex] = AircraftState(flight_id, timestamp, bsky_post)
+
+    def seen(self, hex, now):
+        state = self.aircraft.get(hex, None)
+        if state is not None:
+            state.last_seen = round(now)
+        return state
+
+    def set_reportable(self, hex, now):
+        state = self.aircraft.get(hex, None)
+        if state is not None:
+            state.timestamp = now
+            state.bsky_post = 0
+
+    def mark_posted(self, flight_id):
+        #a copy, as the poll loop can be adding aircraft from another thread
+        for state in list(self.aircraft.values()):
+            if state.flight_id == flight_id:
+                state.bsky_post = 1
+                break
+
+    def evict(self, oldest_allowed):
+        #anything older than this can no longer affect a debounce or posting decision
+        stale = [hex for hex, state in list(self.aircraft.items()) if state.timestamp < oldest_allowed]
+        for hex in stale:
+            self.aircraft.pop(hex, None)
+        if stale.__len__():
+            logger.debug(str(stale.__len__()) + " stale aircraft evicted, " + str(self.aircraft.__len__()) + " remain")
+        return stale.__len__()
@@ -0,0 +1,163 @@
+#In-memory index of the airports table, plus bulk import of an offline airports file
+# Usage: python airport_index.py airports.csv
+#   loads an OurAirports style airports.csv (https://ourairports.com/data/) into the airports table
+import geometry
+import db_connections
+import config
+import collections
+import datetime
+import math
+import numpy
+import psycopg2.extras
+import csv
+import sys
+import logging
+
+logger = logging.getLogger('Airport_Index')
+
+Airport = collections.namedtuple('Airport', ['code_icao', 'code_iata', 'name', 'city', 'country', 'lat', 'lon'])
+
+#size of the grid cells (degrees) used for nearest airport searches
+grid_size = 1.0
+#one degree of latitude
+km_per_degree = 111.19
+
+class AirportIndex:
+    def __init__(self):
+        self.by_icao = {}
+        self.by_iata = {}
+        self.grid = collections.defaultdict(list)
+        self.loaded = False
+
+    def __len__(self):
+        return self.by_icao.__len__()
+
+    def load(self, rows):
+        #rows of (code_icao, code_iata, name, city, country_code, lat, lon)
+        for row in rows:
+            self.add(Airport(*row))
+        self.loaded = True
+        logger.info(str(self.by_icao.__len__()) + " airports loaded into memory")
+
+    def cell(self, lat, lon):
+        return (math.floor(lat / grid_size), self.wrap(math.floor(lon / grid_size)))
+
+    def wrap(self, col):
+        #keep longitude columns continuous across the antimeridian
+        columns = round(360 / grid_size)
+        return (col + columns // 2) % columns - columns // 2
+
+    def add(self, airport):
+        if airport.code_icao is None:
+            return
+        old = self.by_icao.get(airport.code_icao, None)
+        if old is not None and old.lat is not None and old.lon is not None:
+            self.grid[self.cell(float(old.lat), float(old.lon))].remove(old)
+        self.by_icao[airport.code_icao] = airport
+        if airport.code_iata:
+            self.by_iata[airport.code_iata] = airport
+        if airport.lat is not None and airport.lon is not None:
+            self.grid[self.cell(float(airport.lat), float(airport.lon))].append(airport)
+
+    def icao(self, code):
+        return self.by_icao.get(code, None)
+
+    def iata(self, code):
+        return self.by_iata.get(code, None)
+
+    def lookup(self, code):
+        #flight routes mostly give ICAO codes but the odd IATA one sneaks through
+        airport = self.by_icao.get(code, None)
+        return airport if airport is not None else self.by_iata.get(code, None)
+
+    def ring_cells(self, home_row, home_col, ring):
+        #just the outline of the square of cells <ring> away from home
+        if ring == 0:
+            return [(home_row, home_col)]
+        cells = []
+        for col in range(home_col - ring, home_col + ring + 1):
+            cells.append((home_row - ring, col))
+            cells.append((home_row + ring, col))
+        for row in range(home_row - ring + 1, home_row + ring):
+            cells.append((row, home_col - ring))
+            cells.append((row, home_col + ring))
+        return cells
+
+    def nearest(self, lat, lon, count=1, max_km=None):
+        #search outward one ring of grid cells at a time until nothing closer can be found
+        home_row, home_col = self.cell(lat, lon)
+        found = []
+        searched = set()
+        ring = 0
+        max_ring = math.ceil(180 / grid_size)
+        while ring <= max_ring:
+            candidates = []
+            for row, col in self.ring_cells(home_row, home_col, ring):
+                this_cell = (row, self.wrap(col))
+                if this_cell not in searched:
+                    searched.add(this_cell)
+                    candidates.extend(self.grid.get(this_cell, ()))
+            if candidates:
+                dists = geometry.haversine_km((lat, lon),
+                                              numpy.array([float(a.lat) for a in candidates]),
+                                              numpy.array([float(a.lon) for a in candidates]))
+                found.extend(zip(dists.tolist(), candidates))
+                found.sort(key=lambda pair: pair[0])
+                del found[count:]
+            #anything in the next ring out is at least this far away
+            if (2 * ring + 1) * grid_size >= 360:
+                #every longitude has been searched, so only latitude is left
+                next_ring_km = ring * grid_size * km_per_degree
+            else:
+                next_ring_km = ring * grid_size * km_per_degree * math.cos(math.radians(min(90, abs(lat) + (ring + 1) * grid_size)))
+            if found.__len__() == count and found[-1][0] <= next_ring_km:
+                break
+            if max_km is not None and next_ring_km > max_km:
+                break
+            ring += 1
+        return [(airport, dist) for dist, airport in found if max_km is None or dist <= max_km]
+
+def ourairports_rows(filename, timestamp):
+    #map an OurAirports airports.csv onto the columns of our airports table
+    with open(filename, encoding='utf-8', newline='') as f:
+        for line in csv.DictReader(f):
+            code_icao = line.get('icao_code') or line.get('gps_code') or line.get('ident')
+            if not code_icao:
+                continue
+            try:
+                lat = float(line['latitude_deg'])
+                lon = float(line['longitude_deg'])
+            except (KeyError, TypeError, ValueError):
+                lat = lon = None
+            yield (code_icao, line.get('iata_code') or None, line.get('name') or None, line.get('type') or None,
+                   line.get('municipality') or None, line.get('iso_region') or None, lat, lon,
+                   line.get('iso_country') or None, timestamp)
+
+def import_ourairports(filename):
+    #everything goes in as one transaction. Airports we already have are left alone
+    timestamp = round(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    rows = list(ourairports_rows(filename, timestamp))
+    def work(conn):
+        cur = conn.cursor()
+        try:
+            if config.postgres_enabled:
+                psycopg2.extras.execute_values(cur, "insert into airports "\
+                    "(code_icao, code_iata, name, type, city, state, lat, lon, country_code, timestamp)" \
+                    " values %s on conflict do nothing;", rows, page_size=1000)
+            else:
+                cur.executemany("insert or ignore into airports "\
+                    "(code_icao, code_iata, name, type, city, state, lat, lon, country_code, timestamp)" \
+                    " values (?,?,?,?,?,?,?,?,?,?);", rows)
+            conn.commit()
+        finally:
+            cur.close()
+    db_connections.write(work)
+    logger.info(str(rows.__len__()) + " airports read from " + filename)
+    return rows.__len__()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=config.logging_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    import helper_functions
+    helper_functions.create_sql_tables()
+    for airports_file in sys.argv[1:]:
+        import_ourairports(airports_file)
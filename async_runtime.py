@@ -0,0 +1,108 @@
+#asyncio runtime for the poll loop (RUNTIME_MODE=async)
+# The feed is fetched on a fixed cadence however long processing takes. Fetching, processing and
+# writing tracks each run as their own task and hand work on through a bounded queue, so a slow
+# database write no longer holds up the next fetch. The lookup and database code is blocking, so
+# each stage runs it on a worker thread. Enrichment and Bluesky posting keep their own bounded
+# queues and threads, and are fed from the processing stage as before.
+# If processing falls behind, snapshots waiting for it are merged into one rather than queued up.
+import http_client
+import feeds
+import metrics
+import asyncio
+import math
+import logging
+
+logger = logging.getLogger('Async_Runtime')
+
+def merge_snapshots(older, newer):
+    #the newer snapshot plus any aircraft only the older one had, so a short visit isn't missed.
+    # Their track points are stamped with the newer time, off by at most the time between the two
+    age = newer.get('now', 0) - older.get('now', 0)
+    merged = {aircraft['hex']: aircraft for aircraft in newer['aircraft']}
+    for aircraft in older['aircraft']:
+        if aircraft['hex'] not in merged:
+            merged[aircraft['hex']] = feeds.aged(aircraft, age)
+    return dict(newer, aircraft=list(merged.values()))
+
+class SnapshotSlot:
+    #a queue of one. Putting a snapshot in while the last one is still waiting merges the two
+    def __init__(self):
+        self.snapshot = None
+        self.ready = asyncio.Event()
+        self.merged = 0
+
+    def put(self, snapshot):
+        if self.snapshot is not None:
+            snapshot = merge_snapshots(self.snapshot, snapshot)
+            self.merged += 1
+            metrics.snapshots_merged.inc()
+            logger.debug("Processing is behind. Merged a waiting snapshot into the next one")
+        self.snapshot = snapshot
+        self.ready.set()
+
+    async def get(self):
+        await self.ready.wait()
+        self.ready.clear()
+        snapshot, self.snapshot = self.snapshot, None
+        return snapshot
+
+class AsyncRuntime:
+    def __init__(self, fetch, process, persist, after_poll, interval):
+        #fetch() returns a snapshot, http_client.not_modified or None. process(data) handles one snapshot,
+        # persist(now) writes out what processing left buffered, and after_poll(data) runs when a snapshot is done
+        self.fetch = fetch
+        self.process = process
+        self.persist = persist
+        self.after_poll = after_poll
+        self.interval = interval
+        self.ticks = 0
+        self.missed_ticks = 0
+
+    async def fetcher(self, slot):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            with metrics.timer(metrics.stage_seconds, stage='fetch'):
+                data = await asyncio.to_thread(self.fetch)
+            self.ticks += 1
+            if data is http_client.not_modified:
+                logger.debug("aircraft.json not modified since the last poll")
+            elif data is None:
+                print("Error: No valid 1090 data feed. Check to ensure LIVE_DATA_URL or LIVE_DATA_URLS is set correctly")
+            else:
+                slot.put(data)
+            next_tick += self.interval
+            behind = loop.time() - next_tick
+            if behind > 0:
+                #the fetch itself overran. Skip the ticks we missed rather than firing them all at once
+                missed = math.floor(behind / self.interval) + 1
+                next_tick += missed * self.interval
+                self.missed_ticks += missed
+                metrics.ticks_missed.inc(missed)
+                logger.info("Feed fetch overran by " + str(round(behind, 1)) + " s. Skipping " + str(missed) + " tick(s)")
+            await asyncio.sleep(next_tick - loop.time())
+
+    async def processor(self, slot, persist_queue):
+        while True:
+            data = await slot.get()
+            await asyncio.to_thread(self.process, data)
+            #a flush takes everything buffered when it runs, so one waiting request covers any number of polls
+            try:
+                persist_queue.put_nowait(data['now'])
+            except asyncio.QueueFull:
+                pass
+            self.after_poll(data)
+
+    async def persister(self, persist_queue):
+        while True:
+            now = await persist_queue.get()
+            await asyncio.to_thread(self.persist, now)
+
+    async def run(self):
+        slot = SnapshotSlot()
+        persist_queue = asyncio.Queue(maxsize=1)
+        logger.info("Polling every " + str(self.interval) + " s on the asyncio runtime")
+        await asyncio.gather(self.fetcher(slot), self.processor(slot, persist_queue), self.persister(persist_queue))
+
+def run(fetch, process, persist, after_poll, interval):
+    asyncio.run(AsyncRuntime(fetch, process, persist, after_poll, interval).run())
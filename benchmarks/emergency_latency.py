@@ -0,0 +1,127 @@
+#End to end latency of emergency alerts, against the regular post for the same aircraft
+# Usage: python -m benchmarks.emergency_latency [contacts] [emergencies] [interval]
+#   replays synthetic traffic in real time, one snapshot every <interval> seconds, with the lookups
+#   and Bluesky stubbed. From the second poll on, one new aircraft per poll turns up inside
+#   AIRSPACE_RADIUS_KM squawking 7700. For each one it times, from the moment its first snapshot
+#   arrived, the alert, the follow-up with its details and the regular post. Lookups are slowed
+#   down by BENCH_PROVIDER_DELAY (0.25 s unless set), as the fast lane is meant to beat them.
+#   Defaults to 500 contacts, 5 emergencies and a 1 second interval
+import subprocess
+import tempfile
+import threading
+import json
+import time
+import os
+import sys
+
+default_contacts = 500
+default_emergencies = 5
+default_interval = 1.0
+#how long to wait (seconds) after the last snapshot for the slowest posts to go out
+settle_seconds = 30
+
+def emergency_aircraft(index, home, dist_km):
+    #a new aircraft, dist_km due north of home, squawking 7700
+    return {'hex': 'e%05x' % index, 'type': 'adsb_icao', 'flight': 'EMG%04d ' % index, 'alt_baro': 6000, 'gs': 180.0,
+            'track': 180.0, 'squawk': '7700', 'emergency': 'general', 'seen': 0.1, 'seen_pos': 0.2,
+            'lat': home[0] + dist_km / 111.19, 'lon': home[1]}
+
+def run_one(contacts, emergencies, interval):
+    import replay
+    import helper_functions
+    import db_connections
+    import bluesky_poster
+    import emergency_lane
+    import track_writer
+    import enrichment
+    import constants
+    import config
+    import main
+    import logging
+    helper_functions.create_sql_tables()
+    replay.install_stubs(float(os.getenv('BENCH_PROVIDER_DELAY', 0.25)))
+    sent = []
+    lock = threading.Lock()
+    class TimedBlueskyClient(replay.StubBlueskyClient):
+        def send_post(self, text):
+            with lock:
+                sent.append((time.perf_counter(), text))
+    bluesky_poster.Client = TimedBlueskyClient
+    main_logger = logging.getLogger('Main')
+    tracks = track_writer.create_track_writer() if config.adsb_history_enabled else None
+    enricher = enrichment.create_enrichment_pool()
+    poster = bluesky_poster.BlueskyPoster(helper_functions.postable_flights, helper_functions.bsky_post_text,
+                                          helper_functions.mark_flights_posted,
+                                          set if enricher is None else enricher.pending_ids,
+                                          None, config.bsky_backoff_seconds, config.bsky_backoff_max)
+    lane = emergency_lane.EmergencyLane(poster.alert, 0, config.emergency_repeat_seconds)
+    snapshots = list(replay.synthetic_snapshots(contacts, emergencies + 2, interval=interval))
+    arrived = {}
+    dist_km = min(config.airspace_radius_km, config.record_radius_km) / 2
+    try:
+        helper_functions.warm_aircraft_state(snapshots[0]['now'])
+        next_poll = time.perf_counter()
+        for poll, data in enumerate(snapshots):
+            for index in range(1, min(poll, emergencies) + 1):
+                data['aircraft'].append(emergency_aircraft(index, constants.home, dist_km))
+            time.sleep(max(0, next_poll - time.perf_counter()))
+            next_poll += interval
+            started = time.perf_counter()
+            if poll >= 1 and poll <= emergencies:
+                arrived['EMG%04d' % poll] = started
+            main.process_snapshot(main_logger, data, tracks, enricher, None, lane)
+            poster.notify()
+        deadline = time.perf_counter() + settle_seconds
+        while time.perf_counter() < deadline:
+            with lock:
+                regular = sum(1 for _, text in sent if 'flight #EMG' in text and not text.startswith('Update'))
+            if regular >= emergencies:
+                break
+            poster.notify()
+            time.sleep(0.1)
+    finally:
+        lane.close()
+        if enricher is not None:
+            enricher.close()
+        poster.close()
+        if tracks is not None:
+            tracks.close()
+        db_connections.close_all()
+    results = []
+    for flight, started in sorted(arrived.items()):
+        def first(match):
+            times = [at for at, text in sent if match(text)]
+            return None if not times else round((min(times) - started) * 1000, 1)
+        results.append({'flight': flight,
+                        'alert_ms': first(lambda text: text.startswith('EMERGENCY: ' + flight)),
+                        'details_ms': first(lambda text: text.startswith('Update') and 'flight #' + flight in text),
+                        'regular_ms': first(lambda text: not text.startswith('Update') and 'flight #' + flight in text)})
+    return {'contacts': contacts, 'interval_ms': interval * 1000, 'emergencies': results}
+
+def run_all(contacts, emergencies, interval):
+    with tempfile.TemporaryDirectory() as folder:
+        env = dict(os.environ)
+        env.setdefault('LOG_LEVEL', 'WARNING')
+        env['ADSB_SAVE_FOLDER'] = folder + os.sep
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.emergency_latency', '--one', str(contacts), str(emergencies), str(interval)],
+                                env=env, capture_output=True, text=True, check=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+def print_table(result):
+    print(str(result['contacts']) + " contacts, a snapshot every " + str(round(result['interval_ms'])) + " ms")
+    print("flight    alert ms  details ms  regular post ms")
+    for r in result['emergencies']:
+        print("%-8s  %8s  %10s  %15s" % (r['flight'], r['alert_ms'], r['details_ms'], r['regular_ms']))
+    alerts = [r['alert_ms'] for r in result['emergencies'] if r['alert_ms'] is not None]
+    if alerts:
+        print("alerts within one poll: " + str(sum(1 for a in alerts if a <= result['interval_ms'])) + " of " +
+              str(result['emergencies'].__len__()) + ", worst " + str(max(alerts)) + " ms")
+
+if __name__ == "__main__":
+    if sys.argv.__len__() > 1 and sys.argv[1] == '--one':
+        print(json.dumps(run_one(int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]))))
+    else:
+        contacts = int(sys.argv[1]) if sys.argv.__len__() > 1 else default_contacts
+        emergencies = int(sys.argv[2]) if sys.argv.__len__() > 2 else default_emergencies
+        interval = float(sys.argv[3]) if sys.argv.__len__() > 3 else default_interval
+        print_table(run_all(contacts, emergencies, interval))
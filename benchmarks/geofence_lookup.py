@@ -0,0 +1,114 @@
+#Time to find which geofence every contact in a snapshot is in
+# Usage: python -m benchmarks.geofence_lookup [contacts] [fences] [vertices]
+#   compiles synthetic fences around MY_LAT/MY_LON (corridors, airport areas with a hole, some with
+#   altitude limits) and times geofences.FenceIndex.locate on snapshots of contacts spread over
+#   RECORD_RADIUS_KM, then geometry.prefilter with and without the fences. Every answer is checked
+#   against a plain even-odd test of each fence in turn. Defaults to 500 contacts, 50 fences and
+#   64 vertices per fence
+import random
+import math
+import time
+import sys
+
+default_contacts = 500
+default_fences = 50
+default_vertices = 64
+snapshots = 200
+
+def synthetic_fences(count, vertices, home, spread_deg, rng):
+    fences = []
+    for i in range(count):
+        lat = home[0] + rng.uniform(-spread_deg, spread_deg)
+        lon = home[1] + rng.uniform(-spread_deg, spread_deg) / math.cos(math.radians(home[0]))
+        radius = rng.uniform(0.02, 0.25)
+        if i % 3 == 0:
+            #a long thin approach corridor, as a rectangle turned to a random heading
+            angle = rng.uniform(0, math.pi)
+            dx, dy = math.cos(angle) * radius * 2, math.sin(angle) * radius * 2
+            wx, wy = -math.sin(angle) * 0.01, math.cos(angle) * 0.01
+            ring = [[lon - dx - wx, lat - dy - wy], [lon + dx - wx, lat + dy - wy], [lon + dx + wx, lat + dy + wy], [lon - dx + wx, lat - dy + wy]]
+            rings = [ring]
+        else:
+            #an irregular area, every fifth one with a hole in the middle
+            ring = []
+            for k in range(vertices):
+                a = 2 * math.pi * k / vertices
+                r = radius * rng.uniform(0.5, 1)
+                ring.append([lon + r * math.cos(a) / math.cos(math.radians(lat)), lat + r * math.sin(a)])
+            rings = [ring]
+            if i % 5 == 1:
+                rings.append([[lon + radius * 0.2 * math.cos(2 * math.pi * k / 8), lat + radius * 0.2 * math.sin(2 * math.pi * k / 8)] for k in range(8)])
+        properties = {'name': 'fence ' + str(i), 'action': ('alert', 'record', 'exclude')[i % 3]}
+        if i % 4 == 0:
+            properties['max_altitude'] = 3000
+        fences.append({'type': 'Feature', 'properties': properties, 'geometry': {'type': 'Polygon', 'coordinates': rings}})
+    return {'type': 'FeatureCollection', 'features': fences}
+
+def plain_locate(index, altitude, lat, lon):
+    #what locate should find, one fence at a time
+    for number, fence in enumerate(index.fences):
+        crossings = sum(1 for x1, y1, x2, y2 in fence.edges if (y1 > lat) != (y2 > lat) and x1 + (lat - y1) * (x2 - x1) / (y2 - y1) > lon)
+        if crossings % 2 == 1 and (fence.min_altitude is None or altitude >= fence.min_altitude) and \
+                (fence.max_altitude is None or altitude <= fence.max_altitude):
+            return number
+    return -1
+
+def percentiles(values):
+    values = sorted(values)
+    return {'p50': round(values[len(values) // 2], 1), 'p95': round(values[int(len(values) * 0.95)], 1), 'max': round(values[-1], 1)}
+
+def run(contacts, fence_count, vertices):
+    import geofences
+    import geometry
+    import constants
+    import config
+    rng = random.Random(fence_count * 1000 + vertices)
+    spread_deg = config.record_radius_km / 111.19
+    started = time.perf_counter()
+    index = geofences.FenceIndex(geofences.parse_fences(synthetic_fences(fence_count, vertices, constants.home, spread_deg * 0.7, rng)))
+    compile_ms = (time.perf_counter() - started) * 1000
+    locate_us = []
+    with_us = []
+    without_us = []
+    mismatches = 0
+    inside = 0
+    for snapshot in range(snapshots):
+        aircraft_list = []
+        for i in range(contacts):
+            aircraft_list.append({'hex': '%06x' % (snapshot * contacts + i), 'seen_pos': 0.5,
+                                  'alt_baro': rng.choice(['ground', 1500, 2500, 5000, 12000, 35000]),
+                                  'lat': constants.home[0] + rng.uniform(-spread_deg, spread_deg),
+                                  'lon': constants.home[1] + rng.uniform(-spread_deg, spread_deg) / math.cos(math.radians(constants.home[0]))})
+        lats, lons = geometry.snapshot_positions(aircraft_list)
+        started = time.perf_counter()
+        found = index.locate(aircraft_list, lats, lons)
+        locate_us.append((time.perf_counter() - started) * 1000000)
+        started = time.perf_counter()
+        geometry.prefilter(aircraft_list, constants.home, config.record_radius_km, config.airspace_radius_km, fences=index)
+        with_us.append((time.perf_counter() - started) * 1000000)
+        started = time.perf_counter()
+        geometry.prefilter(aircraft_list, constants.home, config.record_radius_km, config.airspace_radius_km)
+        without_us.append((time.perf_counter() - started) * 1000000)
+        inside += int((found >= 0).sum())
+        #checking every answer is slow, so only the first few snapshots
+        if snapshot < 5:
+            mismatches += sum(1 for i, aircraft in enumerate(aircraft_list) if plain_locate(index, geofences.altitude_of(aircraft), lats[i], lons[i]) != found[i])
+    return {'contacts': contacts, 'fences': fence_count, 'vertices': vertices, 'grid': [index.rows, index.cols],
+            'exact_cells': round(index.exact_cells / (index.rows * index.cols), 3), 'compile_ms': round(compile_ms),
+            'inside_per_snapshot': round(inside / snapshots, 1), 'mismatches': mismatches, 'locate_us': percentiles(locate_us),
+            'prefilter_us': percentiles(with_us), 'prefilter_no_fences_us': percentiles(without_us)}
+
+def print_result(r):
+    print(str(r['fences']) + " fences of up to " + str(r['vertices']) + " vertices on a " + str(r['grid'][0]) + " x " + str(r['grid'][1]) +
+          " grid, compiled in " + str(r['compile_ms']) + " ms. " + str(round(r['exact_cells'] * 100, 1)) + "% of cells need an exact check")
+    print(str(r['contacts']) + " contacts per snapshot, " + str(r['inside_per_snapshot']) + " inside a fence. " +
+          str(r['mismatches']) + " wrong answers")
+    print("                          p50 us   p95 us   max us")
+    for label, key in (('locate', 'locate_us'), ('prefilter with fences', 'prefilter_us'), ('prefilter without fences', 'prefilter_no_fences_us')):
+        print("%-24s  %7.1f  %7.1f  %7.1f" % (label, r[key]['p50'], r[key]['p95'], r[key]['max']))
+
+if __name__ == "__main__":
+    contacts = int(sys.argv[1]) if sys.argv.__len__() > 1 else default_contacts
+    fence_count = int(sys.argv[2]) if sys.argv.__len__() > 2 else default_fences
+    vertices = int(sys.argv[3]) if sys.argv.__len__() > 3 else default_vertices
+    print_result(run(contacts, fence_count, vertices))
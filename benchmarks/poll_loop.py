@@ -0,0 +1,49 @@
+#Poll loop benchmark over synthetic traffic
+# Usage: python -m benchmarks.poll_loop [polls] [contacts ...]
+#   each aircraft count runs in its own process with a fresh SQLite database (or the configured
+#   Postgres one) so the results don't leak into each other. Defaults to 20 polls of 50, 500 and 5000 contacts
+import subprocess
+import tempfile
+import json
+import os
+import sys
+
+default_contacts = (50, 500, 5000)
+
+def run_one(polls, contacts):
+    import replay
+    import helper_functions
+    import db_connections
+    helper_functions.create_sql_tables()
+    counter = replay.install_stubs(float(os.getenv('BENCH_PROVIDER_DELAY', 0)))
+    result = replay.play(replay.synthetic_snapshots(contacts, polls), counter)
+    db_connections.close_all()
+    return result
+
+def run_all(polls, contacts_list):
+    results = {}
+    for contacts in contacts_list:
+        with tempfile.TemporaryDirectory() as folder:
+            env = dict(os.environ)
+            env.setdefault('ADSB_HISTORY_ENABLED', 'true')
+            env.setdefault('LOG_LEVEL', 'WARNING')
+            env['ADSB_SAVE_FOLDER'] = folder + os.sep
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.poll_loop', '--one', str(polls), str(contacts)],
+                                    env=env, capture_output=True, text=True, check=True).stdout
+            results[contacts] = json.loads(output.strip().splitlines()[-1])
+    return results
+
+def print_table(results):
+    print("contacts  polls  p50 ms  p95 ms  p99 ms  max ms  queries/poll  track rows  flights  posts")
+    for contacts, r in results.items():
+        print("%8d  %5d  %6.1f  %6.1f  %6.1f  %6.1f  %12.1f  %10d  %7s  %5d" %
+              (contacts, r['polls'], r['poll_ms']['p50'], r['poll_ms']['p95'], r['poll_ms']['p99'], r['poll_ms']['max'],
+               r['db_queries_per_poll'], r['track_rows'], r['flights'], r['bsky_posts']))
+
+if __name__ == "__main__":
+    if sys.argv.__len__() > 1 and sys.argv[1] == '--one':
+        print(json.dumps(run_one(int(sys.argv[2]), int(sys.argv[3]))))
+    else:
+        polls = int(sys.argv[1]) if sys.argv.__len__() > 1 else 20
+        contacts_list = [int(c) for c in sys.argv[2:]] or default_contacts
+        print_table(run_all(polls, contacts_list))
@@ -0,0 +1,87 @@
+#Throughput of the poll loop against the number of shard worker processes
+# Usage: python -m benchmarks.shard_scaling [polls] [contacts] [workers ...]
+#   plays the same synthetic traffic, every aircraft inside RECORD_RADIUS_KM, through one process
+#   and then through PROCESS_WORKERS worker processes. Each run is its own process with a fresh
+#   SQLite database (or the configured Postgres one). Defaults to 10 polls of 5000 contacts, on one
+#   process and on 2, 4 and 8 workers up to the number of cores
+import subprocess
+import tempfile
+import json
+import time
+import os
+import sys
+
+default_contacts = 5000
+default_polls = 10
+
+def install_worker_stubs(provider_delay):
+    #runs in each shard worker, so lookups are stubbed there too
+    import replay
+    replay.install_stubs(provider_delay)
+
+def run_one(polls, contacts, workers):
+    import replay
+    import helper_functions
+    import db_connections
+    import shard_pool
+    import config
+    import main
+    import logging
+    helper_functions.create_sql_tables()
+    provider_delay = float(os.getenv('BENCH_PROVIDER_DELAY', 0))
+    snapshots = list(replay.synthetic_snapshots(contacts, polls, spread_km=config.record_radius_km))
+    if workers <= 1:
+        counter = replay.install_stubs(provider_delay)
+        result = replay.play(snapshots, counter, post=False)
+        db_connections.close_all()
+        return {'workers': 1, 'contacts': contacts, 'polls': result['polls'], 'poll_ms': result['poll_ms'],
+                'contacts_per_second': round(contacts * result['polls_per_second']), 'flights': result['flights']}
+    shards = shard_pool.ShardPool(workers, install_worker_stubs, (provider_delay,))
+    main_logger = logging.getLogger('Main')
+    latencies = []
+    try:
+        #an empty snapshot first, so the time the workers take to start isn't counted
+        shards.process({'now': snapshots[0]['now'] - config.sleep_time, 'aircraft': []})
+        started = time.perf_counter()
+        for data in snapshots:
+            poll_started = time.perf_counter()
+            main.process_snapshot(main_logger, data, None, None, shards)
+            latencies.append((time.perf_counter() - poll_started) * 1000)
+        elapsed = time.perf_counter() - started
+    finally:
+        shards.close()
+    flights = helper_functions.sql_fetchone("select count(*) from flights", [])
+    db_connections.close_all()
+    return {'workers': workers, 'contacts': contacts, 'polls': latencies.__len__(), 'poll_ms': replay.percentiles(latencies),
+            'contacts_per_second': round(contacts * latencies.__len__() / elapsed), 'flights': None if flights is None else flights[0]}
+
+def run_all(polls, contacts, workers_list):
+    results = []
+    for workers in workers_list:
+        with tempfile.TemporaryDirectory() as folder:
+            env = dict(os.environ)
+            env.setdefault('ADSB_HISTORY_ENABLED', 'true')
+            env.setdefault('LOG_LEVEL', 'WARNING')
+            env['ADSB_SAVE_FOLDER'] = folder + os.sep
+            output = subprocess.run([sys.executable, '-m', 'benchmarks.shard_scaling', '--one', str(polls), str(contacts), str(workers)],
+                                    env=env, capture_output=True, text=True, check=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+def print_table(results):
+    print(str(os.cpu_count()) + " cores")
+    print("workers  contacts  polls  p50 ms  p95 ms  max ms  contacts/s  speedup  flights")
+    base = results[0]['contacts_per_second'] if results else 0
+    for r in results:
+        print("%7d  %8d  %5d  %6.1f  %6.1f  %6.1f  %10d  %6.2fx  %7s" %
+              (r['workers'], r['contacts'], r['polls'], r['poll_ms']['p50'], r['poll_ms']['p95'], r['poll_ms']['max'],
+               r['contacts_per_second'], 0 if base == 0 else r['contacts_per_second'] / base, r['flights']))
+
+if __name__ == "__main__":
+    if sys.argv.__len__() > 1 and sys.argv[1] == '--one':
+        print(json.dumps(run_one(int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]))))
+    else:
+        polls = int(sys.argv[1]) if sys.argv.__len__() > 1 else default_polls
+        contacts = int(sys.argv[2]) if sys.argv.__len__() > 2 else default_contacts
+        workers_list = [int(w) for w in sys.argv[3:]] or [1] + [w for w in (2, 4, 8) if w <= max(2, os.cpu_count() or 1)]
+        print_table(run_all(polls, contacts, workers_list))
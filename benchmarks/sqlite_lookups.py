@@ -0,0 +1,125 @@
+#SQLite lookup latency against the size of the flights table
+# Usage: python -m benchmarks.sqlite_lookups [rows ...]
+#   for each table size, fills a fresh SQLite database with synthetic flights and times the lookups
+#   made on every poll, once with the indexes and tuning pragmas and once the way SQLite was set
+#   up before (rollback journal, full sync, default cache, no indexes). Each run is its own process.
+#   Defaults to 10000, 100000 and 1000000 rows
+import subprocess
+import tempfile
+import threading
+import random
+import json
+import time
+import os
+import sys
+
+default_rows = (10000, 100000, 1000000)
+#aircraft in the table. Each one turns up rows / aircraft times
+aircraft_per_row = 0.2
+lookups = 200
+writer_threads = 4
+writes_per_thread = 100
+
+#the old setup, before the indexes and tuning pragmas
+baseline_env = {'SQLITE_JOURNAL_MODE': 'delete', 'SQLITE_SYNCHRONOUS': 'full', 'SQLITE_CACHE_MB': '2', 'SQLITE_MMAP_MB': '0'}
+
+def fill(rows, now):
+    import db_connections
+    rng = random.Random(rows)
+    hexes = ['%06x' % hex for hex in rng.sample(range(0x100000, 0xffffff), max(1, round(rows * aircraft_per_row)))]
+    #one flight every few seconds, the oldest first, all posted bar the last few minutes
+    values = []
+    for i in range(rows):
+        timestamp = round(now - (rows - i) * 5)
+        values.append((timestamp, rng.choice(hexes), 'SYN%04d' % (i % 10000), rng.randrange(1000, 40000, 100),
+                       53.5 + rng.uniform(-0.5, 0.5), -113.5 + rng.uniform(-0.5, 0.5),
+                       0 if now - timestamp < 300 else 1))
+    def work(conn):
+        cur = conn.cursor()
+        try:
+            cur.executemany("insert into flights (timestamp, icao_hex, flight, altitude, lat, lon, bsky_post) values (?,?,?,?,?,?,?)", values)
+            conn.commit()
+        finally:
+            cur.close()
+    db_connections.write(work)
+    return hexes
+
+def timed(function, count):
+    #per call latency in microseconds
+    import replay
+    latencies = []
+    for i in range(count):
+        started = time.perf_counter()
+        function(i)
+        latencies.append((time.perf_counter() - started) * 1000000)
+    return replay.percentiles(latencies)
+
+def run_one(rows, tuned):
+    import helper_functions
+    import db_connections
+    helper_functions.create_sql_tables()
+    if not tuned:
+        def drop_indexes(conn):
+            cur = conn.cursor()
+            try:
+                cur.execute("select name from sqlite_master where type = 'index' and name like 'uix_%'")
+                for (name,) in cur.fetchall():
+                    cur.execute("drop index " + name)
+                conn.commit()
+            finally:
+                cur.close()
+        db_connections.write(drop_indexes)
+    now = time.time()
+    hexes = fill(rows, now)
+    rng = random.Random(1)
+    probes = [rng.choice(hexes) for _ in range(lookups)]
+    result = {'rows': rows, 'profile': 'tuned' if tuned else 'baseline'}
+    #the lookups below are the ones helper_functions makes against the database
+    result['latest_flight_us'] = timed(lambda i: helper_functions.latest_flight_id(probes[i]), lookups)
+    result['postable_us'] = timed(lambda i: helper_functions.postable_flights(now), lookups)
+    result['recent_flights_us'] = timed(lambda i: helper_functions.warm_aircraft_state(now), lookups)
+    #small writes from several threads at once, as the enrichment pool and poll loop make them
+    def writes(thread):
+        for i in range(writes_per_thread):
+            helper_functions.insert_update_row("update flights set bsky_post = 1 where id = (?)", [thread * writes_per_thread + i + 1])
+    started = time.perf_counter()
+    threads = [threading.Thread(target=writes, args=(t,)) for t in range(writer_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result['writes_per_second'] = round(writer_threads * writes_per_thread / (time.perf_counter() - started))
+    result['commits'] = db_connections.stats().get('commits', 0)
+    db_connections.close_all()
+    return result
+
+def run_all(rows_list):
+    results = []
+    for rows in rows_list:
+        for tuned in (False, True):
+            with tempfile.TemporaryDirectory() as folder:
+                env = dict(os.environ)
+                env.setdefault('LOG_LEVEL', 'WARNING')
+                env['POSTGRES_ENABLED'] = 'false'
+                env['ADSB_SAVE_FOLDER'] = folder + os.sep
+                if not tuned:
+                    env.update(baseline_env)
+                output = subprocess.run([sys.executable, '-m', 'benchmarks.sqlite_lookups', '--one', str(rows), '1' if tuned else '0'],
+                                        env=env, capture_output=True, text=True, check=True).stdout
+                results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+def print_table(results):
+    print("     rows  profile   latest flight p50/p95 us  postable p50/p95 us  recent p50/p95 us  writes/s  commits")
+    for r in results:
+        print("%9d  %-8s  %11.0f %11.0f  %9.0f %9.0f  %8.0f %8.0f  %8d  %7d" %
+              (r['rows'], r['profile'], r['latest_flight_us']['p50'], r['latest_flight_us']['p95'],
+               r['postable_us']['p50'], r['postable_us']['p95'], r['recent_flights_us']['p50'], r['recent_flights_us']['p95'],
+               r['writes_per_second'], r['commits']))
+
+if __name__ == "__main__":
+    if sys.argv.__len__() > 1 and sys.argv[1] == '--one':
+        print(json.dumps(run_one(int(sys.argv[2]), sys.argv[3] == '1')))
+    else:
+        rows_list = [int(r) for r in sys.argv[1:]] or default_rows
+        print_table(run_all(rows_list))
@@ -0,0 +1,193 @@
+#Posts reportable flights to Bluesky from a background thread
+# The queue is the flights table itself (bsky_post = 0), so nothing is lost over a restart.
+# One client is logged in once and reused; its session is saved to disk so restarts don't log in again.
+# Emergency alerts skip the queue: they're held in memory and sent before anything else.
+import config
+import metrics
+from atproto import Client
+import collections
+import threading
+import datetime
+import time
+import os
+import logging
+
+logger = logging.getLogger('Bluesky_Poster')
+
+class BlueskyPoster:
+    def __init__(self, fetch_posts, post_text, mark_posted, pending_ids, session_file, backoff_seconds, backoff_max):
+        #fetch_posts(now, pending_ids) returns the postable rows, id last
+        self.fetch_posts = fetch_posts
+        self.post_text = post_text
+        self.mark_posted = mark_posted
+        self.pending_ids = pending_ids
+        self.session_file = session_file
+        self.backoff_seconds = backoff_seconds
+        self.backoff_max = backoff_max
+        self.client = None
+        #flight id -> (failed attempts, monotonic time of the next try)
+        self.retries = {}
+        #posted, but the database update failed. Kept so they're marked later rather than posted twice
+        self.unmarked = set()
+        #set while Bluesky has told us to slow down
+        self.paused_until = 0
+        #alert texts waiting to go out ahead of the regular posts
+        self.alerts = collections.deque()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.worker, name="bluesky-poster", daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        #new reportable flights may be waiting
+        self.wake.set()
+
+    def alert(self, text):
+        #sent as soon as the poster thread wakes, or between two regular posts if it's part way through a sweep
+        self.alerts.append(text)
+        self.wake.set()
+
+    def send_alerts(self):
+        try:
+            while self.alerts and time.monotonic() >= self.paused_until:
+                if self.client is None:
+                    self.login()
+                text = self.alerts[0]
+                logger.info("Bsky alert is:\n" + text)
+                try:
+                    with metrics.timer(metrics.stage_seconds, stage='bsky_alert'):
+                        self.client.send_post(text)
+                    self.alerts.popleft()
+                    metrics.bsky_posts.inc(result='alert')
+                except Exception as e:
+                    #alerts keep their place at the front of the line and go again once we're allowed
+                    delay = self.rate_limit_delay(e)
+                    metrics.bsky_posts.inc(result='failed' if delay is None else 'rate_limited')
+                    delay = self.backoff_seconds if delay is None else delay
+                    logger.info("Error sending an alert, retrying in " + str(round(delay)) + " seconds: " + str(e))
+                    self.paused_until = time.monotonic() + delay
+        except Exception as e:
+            logger.debug("Error authenticating to Bluesky. Check credentials if this persists. " + str(e))
+            self.client = None
+            self.paused_until = time.monotonic() + self.backoff_seconds
+
+    def save_session(self, event, session):
+        if self.session_file is None:
+            return
+        try:
+            with open(self.session_file, 'w') as f:
+                f.write(self.client.export_session_string())
+        except Exception as e:
+            logger.debug("Couldn't save the Bluesky session: " + str(e))
+
+    def login(self):
+        client = Client()
+        client.on_session_change(self.save_session)
+        self.client = client
+        if self.session_file is not None and os.path.exists(self.session_file):
+            try:
+                with open(self.session_file) as f:
+                    client.login(session_string=f.read())
+                logger.info("Bluesky session resumed")
+                return client
+            except Exception as e:
+                logger.debug("Saved Bluesky session no longer valid, logging in again: " + str(e))
+        client.login(config.bsky_account, config.bsky_app_pass)
+        self.save_session(None, None)
+        logger.info("Logged in to Bluesky as " + config.bsky_account)
+        return client
+
+    def backoff(self, flight_id):
+        attempts = self.retries.get(flight_id, (0, 0))[0] + 1
+        delay = min(self.backoff_max, self.backoff_seconds * 2 ** (attempts - 1))
+        self.retries[flight_id] = (attempts, time.monotonic() + delay)
+        return delay
+
+    def rate_limit_delay(self, e):
+        #Bluesky answers 429 with a ratelimit-reset header (epoch seconds)
+        response = getattr(e, 'response', None)
+        if response is None or getattr(response, 'status_code', None) != 429:
+            return None
+        reset = (getattr(response, 'headers', None) or {}).get('ratelimit-reset', None)
+        try:
+            return max(self.backoff_seconds, float(reset) - datetime.datetime.now(datetime.timezone.utc).timestamp())
+        except (TypeError, ValueError):
+            return self.backoff_max
+
+    def sweep(self):
+        if time.monotonic() < self.paused_until:
+            return
+        posts = self.fetch_posts(time.time(), self.pending_ids())
+        posted = []
+        try:
+            for unposted_aircraft in posts:
+                flight_id = unposted_aircraft[-1]
+                if flight_id in self.unmarked or self.retries.get(flight_id, (0, 0))[1] > time.monotonic():
+                    continue
+                if self.alerts:
+                    self.send_alerts()
+                    if time.monotonic() < self.paused_until:
+                        break
+                if self.client is None:
+                    self.login()
+                try:
+                    post_text = self.post_text(unposted_aircraft)
+                except Exception as e:
+                    #a row we can't describe mustn't hold up the ones behind it, or be taken for a login problem
+                    metrics.bsky_posts.inc(result='failed')
+                    logger.info("Couldn't build the post for flight " + str(flight_id) + ", retrying in " + str(self.backoff(flight_id)) + " seconds: " + str(e))
+                    continue
+                logger.info("Bsky post is:\n" + post_text)
+                try:
+                    with metrics.timer(metrics.stage_seconds, stage='bsky_post'):
+                        self.client.send_post(post_text)
+                    posted.append(flight_id)
+                    self.retries.pop(flight_id, None)
+                    metrics.bsky_posts.inc(result='sent')
+                except Exception as e:
+                    delay = self.rate_limit_delay(e)
+                    metrics.bsky_posts.inc(result='failed' if delay is None else 'rate_limited')
+                    if delay is not None:
+                        logger.info("Bluesky rate limit reached. Pausing posts for " + str(round(delay)) + " seconds")
+                        self.paused_until = time.monotonic() + delay
+                        break
+                    logger.debug("Error posting flight " + str(flight_id) + ", retrying in " + str(self.backoff(flight_id)) + " seconds: " + str(e))
+        except Exception as e:
+            logger.debug("Error authenticating to Bluesky. Check credentials if this persists. " + str(e))
+            self.client = None
+            self.paused_until = time.monotonic() + self.backoff_seconds
+        finally:
+            self.unmarked.update(posted)
+            if self.unmarked:
+                if self.mark_posted(self.unmarked):
+                    self.unmarked.clear()
+                else:
+                    logger.info("Couldn't mark " + str(self.unmarked.__len__()) + " posted flights in the database. Will try again")
+        #forget retries for flights that have dropped out of the queue
+        queued = set(row[-1] for row in posts)
+        for flight_id in list(self.retries):
+            if flight_id not in queued:
+                del self.retries[flight_id]
+
+    def worker(self):
+        while not self.stopping:
+            self.wake.wait(config.sleep_time)
+            self.wake.clear()
+            if self.stopping:
+                return
+            try:
+                self.send_alerts()
+                self.sweep()
+            except Exception as e:
+                logger.info("Error posting to Bluesky: " + str(e))
+
+    def close(self, timeout=30):
+        self.stopping = True
+        self.wake.set()
+        self.thread.join(timeout)
+
+def create_bluesky_poster(fetch_posts, post_text, mark_posted, pending_ids):
+    if config.bsky_post_enabled:
+        return BlueskyPoster(fetch_posts, post_text, mark_posted, pending_ids, config.bsky_session_file,
+                             config.bsky_backoff_seconds, config.bsky_backoff_max)
+    return None
@@ -12,14 +12,74 @@ postgres_port = int(os.getenv('POSTGRES_PORT',5432))
 postgres_db = os.getenv('POSTGRES_DATABASE','aero-alerts')
 postgres_user = os.getenv('POSTGRES_USER','aero-user')
 postgres_password = os.getenv('POSTGRES_PASSWORD','aero-pass')
+#size of the Postgres connection pool
+db_pool_min = int(os.getenv('DB_POOL_MIN',1))
+db_pool_max = int(os.getenv('DB_POOL_MAX',5))
+#idle connections older than this (seconds) are checked before being reused
+db_healthcheck_interval = int(os.getenv('DB_HEALTHCHECK_SECONDS',30))
 
 #Save location for database - only used for sqlite
 adsb_save_folder = os.getenv('ADSB_SAVE_FOLDER','/data')
+#SQLite tuning. WAL lets lookups carry on while a write is being committed. Only used for sqlite
+sqlite_journal_mode = os.getenv('SQLITE_JOURNAL_MODE','wal').lower()
+#'normal' in WAL mode only syncs at checkpoints. A power cut can lose the last few commits but never corrupts the database
+sqlite_synchronous = os.getenv('SQLITE_SYNCHRONOUS','normal').lower()
+#Page cache and memory mapped I/O sizes (MB) for each SQLite connection
+sqlite_cache_mb = int(os.getenv('SQLITE_CACHE_MB',64))
+sqlite_mmap_mb = int(os.getenv('SQLITE_MMAP_MB',256))
+#How long (ms) the SQLite writer waits for more writes to commit along with the first. 0 commits whatever is already queued
+sqlite_commit_window_ms = int(os.getenv('SQLITE_COMMIT_WINDOW_MS',0))
+#Track rows are buffered and written in one go at the end of each poll, or sooner once this many rows/milliseconds have built up
+track_flush_rows = int(os.getenv('TRACK_FLUSH_ROWS',1000))
+track_flush_ms = int(os.getenv('TRACK_FLUSH_MS',5000))
+#How often (seconds) the daily tracks csv is fsynced to disk. 0 for every write, -1 to leave it to the OS. Only used for sqlite
+track_fsync_seconds = int(os.getenv('TRACK_FSYNC_SECONDS',60))
+#Split the postgres tracks table into 'daily' or 'monthly' partitions. 'none' keeps one table
+track_partitions = os.getenv('TRACK_PARTITIONS','none').lower()
+#Partitions older than this many days are removed. 0 keeps everything. Only used with TRACK_PARTITIONS
+track_retention_days = int(os.getenv('TRACK_RETENTION_DAYS',0))
+#'drop' deletes old partitions, 'detach' keeps them as standalone tables to archive however you like
+track_retention_action = os.getenv('TRACK_RETENTION_ACTION','drop').lower()
+#Only write a track point when the aircraft does something unexpected, rather than every poll
+track_compression_enabled = os.getenv("TRACK_COMPRESSION_ENABLED", "false").lower() == "true"
+#How far (metres) off its predicted position, or how much its altitude (ft), heading (degrees) or speed (knots) changes, before a point is written
+track_position_tolerance_m = float(os.getenv('TRACK_POSITION_TOLERANCE_M',250))
+track_altitude_tolerance_ft = float(os.getenv('TRACK_ALTITUDE_TOLERANCE_FT',200))
+track_heading_tolerance = float(os.getenv('TRACK_HEADING_TOLERANCE',5))
+track_speed_tolerance_kt = float(os.getenv('TRACK_SPEED_TOLERANCE_KT',10))
+#Write a point at least this often (seconds) even if nothing has changed
+track_heartbeat_seconds = int(os.getenv('TRACK_HEARTBEAT_SECONDS',60))
 
 logging_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+#Port to serve Prometheus style metrics on (http://host:port/metrics). 0 turns metrics off
+metrics_port = int(os.getenv('METRICS_PORT',0))
 
 # pi-aware local JSON feed with cleansed input
 live_data_url = os.getenv('LIVE_DATA_URL','http://adsbexchange.local/tar1090/data/aircraft.json')
+#Feeds from several receivers, separated by spaces or ;. Used in place of LIVE_DATA_URL when set.
+# Give a receiver its own position with url@lat,lon. Ones without use MY_LAT/MY_LON
+live_data_urls = os.getenv('LIVE_DATA_URLS','').replace(';',' ').split()
+#Most feeds fetched at once when there are several
+feed_workers = int(os.getenv('FEED_WORKERS',16))
+#'poll' reads LIVE_DATA_URL every SLEEP_TIME seconds, 'sbs' streams messages from SBS_HOST:SBS_PORT as they arrive
+ingest_mode = os.getenv('INGEST_MODE','poll').lower()
+#'sync' waits SLEEP_TIME seconds after each poll is processed. 'async' fetches every SLEEP_TIME seconds on the dot,
+# with processing and track writes overlapping the next fetch. Only used when INGEST_MODE is 'poll'
+runtime_mode = os.getenv('RUNTIME_MODE','sync').lower()
+#Worker processes to split each snapshot's aircraft between, by ICAO hex. Each one keeps its own aircraft state,
+# track writer, enrichment pool and database connections. 0 or 1 keeps everything in one process. Only used when INGEST_MODE is 'poll'
+process_workers = int(os.getenv('PROCESS_WORKERS',0))
+#readsb/dump1090 SBS-1 (BaseStation) output
+sbs_host = os.getenv('SBS_HOST','adsbexchange.local')
+sbs_port = int(os.getenv('SBS_PORT',30003))
+#Shortest time (seconds) between positions handled for one aircraft in sbs mode
+sbs_position_interval = float(os.getenv('SBS_POSITION_INTERVAL',1))
+#Forget an aircraft after this many seconds without a message in sbs mode
+sbs_stale_seconds = int(os.getenv('SBS_STALE_SECONDS',60))
+
+#Timeouts (seconds) for every HTTP request, to the antenna or to the lookup APIs
+http_connect_timeout = float(os.getenv('HTTP_CONNECT_TIMEOUT',3.05))
+http_read_timeout = float(os.getenv('HTTP_READ_TIMEOUT',10))
 
 # antenna location
 my_lat = float(os.getenv('MY_LAT'))
@@ -29,16 +89,36 @@ my_lon = float(os.getenv('MY_LON'))
 airspace_radius_km = int(os.getenv('AIRSPACE_RADIUS_KM',10))
 # distance threshold for tracking aircraft
 record_radius_km = int(os.getenv('RECORD_RADIUS_KM',100))
+#GeoJSON file of polygon geofences, used alongside the two radii. Empty for none
+geofences_file = os.getenv('GEOFENCES_FILE','')
 
 #Time to wait between polling the antenna data (seconds)
 sleep_time = int(os.getenv('SLEEP_TIME',10))
+#Ignore aircraft whose last position is older than this (seconds). 0 keeps them all
+stale_position_seconds = int(os.getenv('STALE_POSITION_SECONDS',60))
 #Time to wait after recording an aircraft before re-posting it
 aircraft_debounce = int(os.getenv('AIRCRAFT_DEBOUNCE',3600))
 
+#Background workers that look up registration/route/airport details for new aircraft. 0 does the lookups inline
+enrich_workers = int(os.getenv('ENRICH_WORKERS',4))
+enrich_queue_size = int(os.getenv('ENRICH_QUEUE_SIZE',500))
+#Most requests allowed in flight to any one API provider at once
+enrich_provider_limit = int(os.getenv('ENRICH_PROVIDER_LIMIT',2))
+#How long (seconds) to remember that a data source had nothing for an aircraft before asking again
+negative_cache_ttl = int(os.getenv('NEGATIVE_CACHE_TTL',86400))
+#Per data source overrides, e.g. "adsbdb=604800,hexdb=604800,flightaware=3600"
+negative_cache_provider_ttls = {provider.strip().lower(): int(ttl) for provider, ttl in
+                                (item.split('=') for item in os.getenv('NEGATIVE_CACHE_TTLS','').split(',') if '=' in item)}
+#Most misses remembered in memory at once
+negative_cache_size = int(os.getenv('NEGATIVE_CACHE_SIZE',10000))
+
 #Monthly spend limit for AeroAPI
 aeroapi_enabled = os.getenv("AEROAPI_ENABLED", "false").lower() == "true"
 aeroapi_limit = float(os.getenv('AEROAPI_LIMIT',0))
 aero_api_key = os.getenv('AEROAPI_KEY','')
+#How often (seconds) to check actual spend with FlightAware, and the cost assumed for each call in between
+aeroapi_reconcile_interval = int(os.getenv('AEROAPI_RECONCILE_SECONDS',3600))
+aeroapi_call_cost = float(os.getenv('AEROAPI_CALL_COST',0.005))
 
 #Bluesky posting settings
 bsky_post_enabled = os.getenv("BSKY_POST_ENABLED", "false").lower() == "true"
@@ -46,6 +126,17 @@ bsky_account = os.getenv('BSKY_ACCOUNT','')
 bsky_app_pass = os.getenv('BSKY_APP_PASS','')
 #Oldest allowed age of a detected flight to post if it joins our airspace
 bsky_post_lag = int(os.getenv('BSKY_POST_LAG',1800))
+#Where the Bluesky login session is kept between restarts. Set to an empty string to log in every start
+bsky_session_file = os.getenv('BSKY_SESSION_FILE',os.path.join(adsb_save_folder,'bsky_session')) or None
+#Wait (seconds) before retrying a failed post. Doubles on each failure up to BSKY_BACKOFF_MAX
+bsky_backoff_seconds = int(os.getenv('BSKY_BACKOFF_SECONDS',5))
+bsky_backoff_max = int(os.getenv('BSKY_BACKOFF_MAX',300))
+#Alert straight away when an aircraft squawks 7500/7600/7700 or declares an emergency, ahead of the regular posts
+emergency_alerts_enabled = os.getenv("EMERGENCY_ALERTS_ENABLED", "false").lower() == "true"
+#Only alert on emergencies this close (km). 0 alerts on anything the receivers hear
+emergency_radius_km = float(os.getenv('EMERGENCY_RADIUS_KM',0))
+#Don't alert again on the same aircraft and emergency for this long (seconds)
+emergency_repeat_seconds = int(os.getenv('EMERGENCY_REPEAT_SECONDS',1800))
 
 #Azure storage account details. Relevant if history enabled and sqlite used
 azure_backup_enabled = os.getenv("AZ_BACKUP_ENABLED", "false").lower() == "true"
@@ -13,6 +13,14 @@ home = (config.my_lat, config.my_lon)
 knots_to_kph = 1.852
 meters_to_feet = 3.28084
 
+#grid cells used by the spatial index on postgres tables (spatial.py). 0.1 degrees is about 11 km north to south
+grid_cell_size = 0.1
+grid_columns = round(360 / grid_cell_size)
+#the number of the cell a row's position falls in, counted west to east and then south to north
+cell_expression_postgres = "(floor((lat + 90) / " + str(grid_cell_size) + ")::integer * " + str(grid_columns) + \
+                " + mod(floor((lon + 180) / " + str(grid_cell_size) + ")::integer, " + str(grid_columns) + "))"
+cell_column_postgres = "cell integer generated always as " + cell_expression_postgres + " stored"
+
 csv_header = ['Timestamp', 'Hex', 'Type', 'Flight','Altitude','Groundspeed','Track','Lat','Lon','FlightID']
 
 #ADSBDB endpoints
@@ -51,6 +59,7 @@ flights_table_sqlite =   "Create table if not exists flights (" \
                     ", dest_icao text" \
                     ", flightroute_source text" \
                     ", bsky_post integer" \
+                    ", geofence text" \
                     ")"
 
 airports_table_sqlite = "Create table if not exists airports (" \
@@ -79,6 +88,14 @@ registrations_table_sqlite = "Create table if not exists registrations (" \
                 ", source text" \
                 ")"
 
+lookup_misses_table_sqlite = "Create table if not exists lookup_misses (" \
+                "id integer primary key" \
+                ", provider text" \
+                ", lookup_key text" \
+                ", timestamp integer" \
+                ", unique (provider, lookup_key)" \
+                ")"
+
 #postgres syntax
 flights_table_postgres =   "Create table if not exists flights (" \
                     "id serial primary key" \
@@ -100,6 +117,8 @@ flights_table_postgres =   "Create table if not exists flights (" \
                     ", dest_icao varchar" \
                     ", flightroute_source varchar" \
                     ", bsky_post integer" \
+                    ", geofence varchar" \
+                    + ", " + cell_column_postgres + \
                     ")"
 
 airports_table_postgres = "Create table if not exists airports (" \
@@ -114,6 +133,7 @@ airports_table_postgres = "Create table if not exists airports (" \
                 ", lon numeric" \
                 ", country_code varchar" \
                 ", timestamp integer" \
+                + ", " + cell_column_postgres + \
                 ")"
 
 registrations_table_postgres = "Create table if not exists registrations (" \
@@ -140,17 +160,90 @@ tracks_table_postgres = "Create table if not exists tracks (" \
                 ", lat numeric" \
                 ", lon numeric" \
                 ", flightID integer" \
+                + ", " + cell_column_postgres + \
+                ")"
+
+lookup_misses_table_postgres = "Create table if not exists lookup_misses (" \
+                "id serial primary key" \
+                ", provider varchar" \
+                ", lookup_key varchar" \
+                ", timestamp integer" \
+                ", unique (provider, lookup_key)" \
+                ")"
+
+#tracks partitioned by timestamp (TRACK_PARTITIONS). The primary key has to include the partition key
+tracks_partitioned_table_postgres = "Create table if not exists tracks (" \
+                "id serial" \
+                ", timestamp integer not null" \
+                ", hex varchar" \
+                ", type varchar" \
+                ", flight varchar" \
+                ", altitude integer" \
+                ", groundspeed numeric" \
+                ", track numeric" \
+                ", lat numeric" \
+                ", lon numeric" \
+                ", flightID integer" \
+                + ", " + cell_column_postgres + \
+                ", primary key (id, timestamp)" \
+                ") partition by range (timestamp)"
+
+#one row per flight, kept up to date as track points are written
+flight_summaries_table_postgres = "Create table if not exists flight_summaries (" \
+                "flight_id integer primary key" \
+                ", icao_hex varchar" \
+                ", flight varchar" \
+                ", first_seen integer" \
+                ", last_seen integer" \
+                ", min_altitude integer" \
+                ", max_altitude integer" \
+                ", closest_km numeric" \
+                ", closest_timestamp integer" \
+                ", closest_lat numeric" \
+                ", closest_lon numeric" \
+                ", points integer" \
                 ")"
 
-indexes_postgres = "create index if not exists uix_timestamp on tracks (timestamp);" \
+flight_summaries_upsert_postgres = "insert into flight_summaries " \
+                "(flight_id, icao_hex, flight, first_seen, last_seen, min_altitude, max_altitude, " \
+                "closest_km, closest_timestamp, closest_lat, closest_lon, points) values %s " \
+                "on conflict (flight_id) do update set " \
+                "flight = coalesce(excluded.flight, flight_summaries.flight)" \
+                ", first_seen = least(flight_summaries.first_seen, excluded.first_seen)" \
+                ", last_seen = greatest(flight_summaries.last_seen, excluded.last_seen)" \
+                ", min_altitude = least(flight_summaries.min_altitude, excluded.min_altitude)" \
+                ", max_altitude = greatest(flight_summaries.max_altitude, excluded.max_altitude)" \
+                ", closest_timestamp = case when flight_summaries.closest_km is null or excluded.closest_km < flight_summaries.closest_km " \
+                "then excluded.closest_timestamp else flight_summaries.closest_timestamp end" \
+                ", closest_lat = case when flight_summaries.closest_km is null or excluded.closest_km < flight_summaries.closest_km " \
+                "then excluded.closest_lat else flight_summaries.closest_lat end" \
+                ", closest_lon = case when flight_summaries.closest_km is null or excluded.closest_km < flight_summaries.closest_km " \
+                "then excluded.closest_lon else flight_summaries.closest_lon end" \
+                ", closest_km = least(flight_summaries.closest_km, excluded.closest_km)" \
+                ", points = flight_summaries.points + excluded.points;"
+
+tracks_indexes_postgres = "create index if not exists uix_timestamp on tracks (timestamp);" \
                     "create index if not exists uix_tracks_hex on tracks (hex);" \
-                    "create index if not exists uix_tracks_lat on tracks (lat);" \
-                    "create index if not exists uix_tracks_lon on tracks (lon);" \
-                    "create index if not exists uix_tracks_fid on tracks (flightID);" \
-                    "create index if not exists uix_airports_icao on airports (code_icao);" \
-                    "create index if not exists uix_airports_lat on airports (lat);" \
-                    "create index if not exists uix_airports_lon on airports (lon);" \
+                    "create index if not exists uix_tracks_cell on tracks (cell, timestamp);" \
+                    "create index if not exists uix_tracks_fid on tracks (flightID);"
+
+#each partition only covers a day or a month, so a small brin index is enough for time ranges
+tracks_partitioned_indexes_postgres = "create index if not exists uix_ptracks_timestamp on tracks using brin (timestamp);" \
+                    "create index if not exists uix_ptracks_hex on tracks (hex);" \
+                    "create index if not exists uix_ptracks_fid on tracks (flightID);" \
+                    "create index if not exists uix_ptracks_cell on tracks (cell, timestamp);"
+
+indexes_postgres = "create index if not exists uix_airports_icao on airports (code_icao);" \
+                    "create index if not exists uix_airports_cell on airports (cell);" \
                     "create index if not exists uix_registrations_hex on registrations (icao_hex);" \
                     "create index if not exists uix_flights_hex on flights (icao_hex);" \
+                    "create index if not exists uix_flights_cell on flights (cell, timestamp);" \
+                    "create index if not exists uix_flights_post on flights (bsky_post, timestamp);" \
                     "create index if not exists uix_flights_origin on flights (origin_icao);" \
-                    "create index if not exists uix_flights_dest on flights (dest_icao);"
\ No newline at end of file
+                    "create index if not exists uix_flights_dest on flights (dest_icao);"
+
+#the lookups made on every poll: latest flight per aircraft, flights waiting to be posted and recent flights
+indexes_sqlite = "create index if not exists uix_flights_hex_id on flights (icao_hex, id);" \
+                    "create index if not exists uix_flights_post on flights (bsky_post, timestamp);" \
+                    "create index if not exists uix_flights_timestamp on flights (timestamp);" \
+                    "create index if not exists uix_lookup_misses_timestamp on lookup_misses (timestamp);"
\ No newline at end of file
@@ -0,0 +1,394 @@
+#Connection management for the SQL backends
+# Postgres gets a bounded pool of connections that are health checked before reuse.
+# SQLite gets a single long-lived connection shared (one at a time) by every caller for reads,
+# and a writer thread with its own connection that every change goes through.
+import constants
+import config
+import metrics
+import sqlite3
+import psycopg2
+import threading
+import contextlib
+import queue
+import time
+import logging
+
+logger = logging.getLogger('DB_Connections')
+
+def connection_lost(conn, error):
+    #whether error means the connection itself is gone, rather than the query failing. Cancelled
+    # queries, lock timeouts, deadlocks and misuse leave a healthy connection, and the work isn't
+    # run again, as it may already have changed something
+    if config.postgres_enabled:
+        return isinstance(error, psycopg2.InterfaceError) or \
+            (isinstance(error, psycopg2.OperationalError) and conn is not None and conn.closed != 0)
+    return isinstance(error, sqlite3.ProgrammingError) and 'closed database' in str(error)
+
+class ConnectionStats:
+    def __init__(self):
+        self.opened = 0
+        self.reused = 0
+        self.discarded = 0
+        self.failed_checks = 0
+
+    def as_dict(self):
+        return {'opened': self.opened, 'reused': self.reused,
+                'discarded': self.discarded, 'failed_checks': self.failed_checks}
+
+class PostgresPool:
+    def __init__(self, min_size, max_size, check_interval):
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.stats = ConnectionStats()
+        self.lock = threading.Lock()
+        #bounds how many connections can be checked out at once
+        self.slots = threading.BoundedSemaphore(max_size)
+        #idle connections as (connection, time it was returned)
+        self.idle = []
+        for _ in range(min_size):
+            self.idle.append((self.open(), time.monotonic()))
+
+    def open(self):
+        conn = psycopg2.connect(dbname=config.postgres_db,user=config.postgres_user,
+                                password=config.postgres_password,host=config.postgres_server,port=config.postgres_port)
+        self.stats.opened += 1
+        logger.debug("Opened Postgres connection #" + str(self.stats.opened))
+        return conn
+
+    def healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        #don't bother pinging something we only just used
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("select 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception as e:
+            logger.info("Pooled Postgres connection failed its health check: " + str(e))
+            self.stats.failed_checks += 1
+            return False
+
+    def checkout(self):
+        self.slots.acquire()
+        try:
+            while True:
+                with self.lock:
+                    if not self.idle:
+                        break
+                    conn, idle_since = self.idle.pop()
+                if self.healthy(conn, idle_since):
+                    self.stats.reused += 1
+                    return conn
+                self.close(conn)
+            return self.open()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def checkin(self, conn):
+        try:
+            if not conn.closed:
+                #never hand out a connection sitting in an open or aborted transaction
+                conn.rollback()
+                with self.lock:
+                    self.idle.append((conn, time.monotonic()))
+            else:
+                self.stats.discarded += 1
+        except Exception:
+            self.close(conn)
+        finally:
+            self.slots.release()
+
+    def discard(self, conn):
+        self.close(conn)
+        self.slots.release()
+
+    def close(self, conn):
+        self.stats.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, _ in idle:
+            conn.close()
+
+def open_sqlite(isolation_level=''):
+    conn = sqlite3.connect(constants.db_name, check_same_thread=False, isolation_level=isolation_level)
+    conn.execute("pragma journal_mode = " + config.sqlite_journal_mode)
+    conn.execute("pragma synchronous = " + config.sqlite_synchronous)
+    #a negative cache_size is in KiB rather than pages
+    conn.execute("pragma cache_size = -" + str(config.sqlite_cache_mb * 1024))
+    conn.execute("pragma mmap_size = " + str(config.sqlite_mmap_mb * 1024 * 1024))
+    conn.execute("pragma temp_store = memory")
+    return conn
+
+class SqliteConnection:
+    def __init__(self):
+        self.stats = ConnectionStats()
+        #sqlite only allows one writer anyway, so callers simply take turns on the one connection
+        self.lock = threading.RLock()
+        self.conn = None
+
+    def open(self):
+        conn = open_sqlite()
+        self.stats.opened += 1
+        logger.debug("Opened SQLite connection to " + constants.db_name)
+        return conn
+
+    def checkout(self):
+        self.lock.acquire()
+        try:
+            if self.conn is None:
+                self.conn = self.open()
+            else:
+                self.stats.reused += 1
+            return self.conn
+        except Exception:
+            self.lock.release()
+            raise
+
+    def checkin(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        finally:
+            self.lock.release()
+
+    def discard(self, conn):
+        self.stats.discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+        self.conn = None
+        self.lock.release()
+
+    def close_all(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+class WriterConnection:
+    #what work() is handed on the writer thread. The writer commits the whole batch at once,
+    # so commit() does nothing here and rollback() only undoes this one piece of work
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.conn.execute("rollback to write")
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+class WriteJob:
+    __slots__ = ('work', 'done', 'result', 'error')
+
+    def __init__(self, work):
+        self.work = work
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SqliteWriter:
+    #one thread and one connection make every change to the SQLite database. Writes that queue up
+    # while a commit is under way go in the next commit together, so a busy moment costs one sync
+    max_batch = 256
+
+    def __init__(self, commit_window_ms):
+        self.commit_window = commit_window_ms / 1000
+        self.queue = queue.Queue()
+        self.conn = None
+        self.writes = 0
+        self.commits = 0
+        self.thread = threading.Thread(target=self.loop, name="sqlite-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, work):
+        #blocks until work(conn) has been committed, and returns what it returned
+        if threading.current_thread() is self.thread:
+            return work(WriterConnection(self.conn))
+        job = WriteJob(work)
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.commit_window
+        while batch.__len__() < self.max_batch and batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.next_batch()
+            jobs = [job for job in batch if job is not None]
+            if jobs:
+                self.commit(jobs)
+            if batch[-1] is None:
+                break
+        if self.conn is not None:
+            #let sqlite refresh its query planner statistics on the way out. Not worth waiting on another process for
+            try:
+                self.conn.execute("pragma optimize")
+            except sqlite3.OperationalError as e:
+                logger.debug("Skipped pragma optimize: " + str(e))
+            self.conn.close()
+            self.conn = None
+
+    def commit(self, jobs):
+        try:
+            if self.conn is None:
+                #transactions are managed here rather than by the sqlite3 module
+                self.conn = open_sqlite(isolation_level=None)
+            #take the write lock up front, so with shard workers sharing the file we wait for it rather than fail part way
+            self.conn.execute("begin immediate")
+            for job in jobs:
+                #a savepoint each, so one bad write doesn't take the rest of the batch with it
+                self.conn.execute("savepoint write")
+                try:
+                    job.result = job.work(WriterConnection(self.conn))
+                    self.conn.execute("release write")
+                except Exception as e:
+                    job.error = e
+                    self.conn.execute("rollback to write")
+                    self.conn.execute("release write")
+            self.conn.execute("commit")
+            self.writes += jobs.__len__()
+            self.commits += 1
+            metrics.db_write_batch.observe(jobs.__len__())
+        except Exception as e:
+            logger.info("SQLite write batch of " + str(jobs.__len__()) + " failed: " + str(e))
+            for job in jobs:
+                job.result = None
+                job.error = job.error or e
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+        finally:
+            for job in jobs:
+                job.done.set()
+
+    def close(self):
+        #finish what's queued, then stop
+        self.queue.put(None)
+        self.thread.join(timeout=30)
+
+manager = None
+manager_lock = threading.Lock()
+writer = None
+
+def get_manager():
+    global manager
+    if manager is None:
+        with manager_lock:
+            if manager is None:
+                if config.postgres_enabled:
+                    manager = PostgresPool(config.db_pool_min, config.db_pool_max, config.db_healthcheck_interval)
+                else:
+                    manager = SqliteConnection()
+    return manager
+
+@contextlib.contextmanager
+def connection():
+    #borrow a connection for the length of a with block. Dead connections are thrown away, not reused
+    this_manager = get_manager()
+    conn = this_manager.checkout()
+    try:
+        yield conn
+    except Exception as e:
+        if connection_lost(conn, e):
+            this_manager.discard(conn)
+        else:
+            this_manager.checkin(conn)
+        raise
+    except BaseException:
+        this_manager.checkin(conn)
+        raise
+    else:
+        this_manager.checkin(conn)
+
+def run(work):
+    #run work(conn), retrying once on a brand new connection if the one we got has died
+    metrics.db_queries.inc()
+    with metrics.timer(metrics.db_seconds):
+        conn = None
+        try:
+            with connection() as conn:
+                return work(conn)
+        except Exception as e:
+            if not connection_lost(conn, e):
+                raise
+            logger.info("Database connection lost, reconnecting: " + str(e))
+        with connection() as conn:
+            return work(conn)
+
+def get_writer():
+    global writer
+    if writer is None:
+        with manager_lock:
+            if writer is None:
+                writer = SqliteWriter(config.sqlite_commit_window_ms)
+    return writer
+
+def write(work):
+    #run work(conn) for anything that changes the database. With SQLite it's handed to the writer
+    # thread and committed along with whatever other writes are waiting
+    if config.postgres_enabled:
+        return run(work)
+    metrics.db_queries.inc()
+    with metrics.timer(metrics.db_seconds):
+        return get_writer().submit(work)
+
+def checkpoint():
+    #copy everything in the SQLite write-ahead log into the database file, so the file is complete on its own
+    if config.postgres_enabled:
+        return
+    with connection() as conn:
+        conn.execute("pragma wal_checkpoint(full)")
+
+def stats():
+    connection_stats = get_manager().stats.as_dict()
+    if writer is not None:
+        connection_stats['writes'] = writer.writes
+        connection_stats['commits'] = writer.commits
+    return connection_stats
+
+def log_stats():
+    connection_stats = stats()
+    logger.debug("Database connections opened: " + str(connection_stats['opened']) +
+                 ", reused: " + str(connection_stats['reused']) +
+                 ", discarded: " + str(connection_stats['discarded']))
+    if 'commits' in connection_stats:
+        logger.debug("SQLite writes: " + str(connection_stats['writes']) + " in " + str(connection_stats['commits']) + " commits")
+
+def close_all():
+    global writer
+    if writer is not None:
+        writer.close()
+        writer = None
+    if manager is not None:
+        manager.close_all()
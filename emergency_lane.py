@@ -0,0 +1,123 @@
+#Fast lane for aircraft declaring an emergency
+# Each snapshot (or streamed message) is checked for emergency squawks and the emergency field
+# before anything else is done with it. A short alert made only from what the antenna heard goes
+# to the Bluesky poster, which sends it ahead of the regular posts. The aircraft is then looked
+# up on the lane's own thread and a second post follows with the details.
+import helper_functions
+import sbs_ingest
+import feeds
+import metrics
+import config
+from flight import Flight
+import threading
+import queue
+import logging
+
+logger = logging.getLogger('Emergency_Lane')
+
+#what each kind in aircraft.json's emergency field means
+emergency_reasons = {'general': 'general emergency', 'lifeguard': 'medical emergency', 'minfuel': 'minimum fuel',
+                     'nordo': 'radio failure', 'unlawful': 'unlawful interference', 'downed': 'aircraft downed'}
+
+def emergency_of(aircraft):
+    #the emergency kind an aircraft is declaring, or None. Feeds without the emergency field still have the squawk
+    kind = aircraft.get('emergency', None)
+    if kind in emergency_reasons:
+        return kind
+    return sbs_ingest.emergency_squawks.get(aircraft.get('squawk', None), None)
+
+def alert_text(aircraft, kind, dist, bearing):
+    flight = (aircraft.get('flight', None) or '').strip() or aircraft['hex'].replace('~', '').upper()
+    text = "EMERGENCY: " + flight + " is declaring " + emergency_reasons[kind]
+    if aircraft.get('squawk', None) is not None:
+        text += " (squawk " + aircraft['squawk'] + ")"
+    text += "\n"
+    if dist is not None:
+        text += str(round(dist)) + " km to the " + helper_functions.heading_to_direction(bearing)
+        altitude = aircraft.get('alt_baro', None)
+        if altitude is not None:
+            text += ", " + (altitude if isinstance(altitude, str) else str(altitude) + " ft")
+        text += "\n"
+    return text + "Details to follow"
+
+def details_text(flight, kind):
+    #the regular post, made from the looked up flight rather than a flights row
+    origin = flight.origin_airport.get('name', None) if isinstance(flight.origin_airport, dict) else None
+    dest = flight.dest_airport.get('name', None) if isinstance(flight.dest_airport, dict) else None
+    reg = flight.reg
+    row = (flight.flight, None if reg is None else reg.registration, None if reg is None else reg.model,
+           None if reg is None else reg.manufacturer, None if reg is None else reg.owner_name,
+           flight.altitude, flight.speed, flight.track, flight.bearing, flight.airline_name, origin, dest, flight.id)
+    return "Update on the " + emergency_reasons[kind] + ":\n" + helper_functions.bsky_post_text(row)
+
+class EmergencyLane:
+    def __init__(self, send, radius_km, repeat_seconds):
+        #send(text) posts straight away. A radius_km of 0 alerts on anything the receivers hear
+        self.send = send
+        self.radius_km = radius_km
+        self.repeat_seconds = repeat_seconds
+        #hex -> (kind, time of the alert), so an aircraft is alerted once per emergency rather than every poll
+        self.alerted = {}
+        self.alerts = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.worker, name="emergency-lane", daemon=True)
+        self.thread.start()
+
+    def check(self, now, aircraft_list):
+        #returns how many new alerts went out
+        found = 0
+        for aircraft in aircraft_list:
+            kind = emergency_of(aircraft)
+            if kind is None:
+                continue
+            hex = aircraft['hex'].replace('~', '').lower()
+            last = self.alerted.get(hex, None)
+            if last is not None and last[0] == kind and now - last[1] < self.repeat_seconds:
+                continue
+            lat, lon = helper_functions.aircraft_lat_lon(aircraft)
+            dist = bearing = None
+            if lat is not None and lon is not None:
+                home = feeds.home_of(aircraft)
+                dist = helper_functions.get_distance(home, (lat, lon))
+                bearing = helper_functions.get_bearing(home, (lat, lon))
+            if self.radius_km > 0 and (dist is None or dist > self.radius_km):
+                #too far away, or nowhere yet. It's checked again with the next position
+                continue
+            self.alerted[hex] = (kind, now)
+            self.send(alert_text(aircraft, kind, dist, bearing))
+            self.alerts += 1
+            found += 1
+            metrics.emergency_alerts.inc(kind=kind)
+            logger.info(hex + ": declaring " + emergency_reasons[kind] + ". Alert sent")
+            self.queue.put((now, dict(aircraft), kind))
+        if found:
+            self.evict(now)
+        return found
+
+    def evict(self, now):
+        for hex in [hex for hex, (kind, alerted) in self.alerted.items() if now - alerted >= self.repeat_seconds]:
+            del self.alerted[hex]
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            now, aircraft, kind = item
+            try:
+                with metrics.timer(metrics.stage_seconds, stage='emergency_enrich'):
+                    flight = Flight(now, aircraft, enrich=True)
+                self.send(details_text(flight, kind))
+            except Exception as e:
+                logger.info(aircraft['hex'] + ": Error looking up the aircraft in an emergency: " + str(e))
+
+    def close(self, timeout=30):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+def create_emergency_lane(poster):
+    if not config.emergency_alerts_enabled:
+        return None
+    #without Bluesky the alerts still go to the log
+    send = poster.alert if poster is not None else lambda text: logger.warning("Emergency alert:\n" + text)
+    return EmergencyLane(send, config.emergency_radius_km, config.emergency_repeat_seconds)
@@ -0,0 +1,68 @@
+#Background lookups for newly inserted flights
+# The flights row goes in straight away with what the antenna told us. Registration, route and
+# airport details are looked up here by a pool of worker threads and filled in afterwards.
+import config
+import metrics
+import threading
+import queue
+import logging
+
+logger = logging.getLogger('Enrichment')
+
+class EnrichmentPool:
+    def __init__(self, workers, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.worker, name="enrichment-" + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, flight):
+        with self.lock:
+            self.pending.add(flight.id)
+        try:
+            self.queue.put_nowait(flight)
+            return True
+        except queue.Full:
+            #better to have a bare flights row than to stall the poll loop
+            logger.info(flight.hex + ": Enrichment queue full, flight left with antenna details only")
+            with self.lock:
+                self.pending.discard(flight.id)
+            return False
+
+    def pending_ids(self):
+        with self.lock:
+            return set(self.pending)
+
+    def worker(self):
+        while True:
+            flight = self.queue.get()
+            if flight is None:
+                self.queue.task_done()
+                return
+            try:
+                with metrics.timer(metrics.stage_seconds, stage='enrich'):
+                    flight.Enrich()
+                    flight.UpdateEnrichedRecord()
+                logger.debug(flight.hex + ": Enrichment complete")
+            except Exception as e:
+                logger.info(flight.hex + ": Error enriching flight: " + str(e))
+            finally:
+                with self.lock:
+                    self.pending.discard(flight.id)
+                self.queue.task_done()
+
+    def close(self, timeout=30):
+        #let anything already queued finish, within reason
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+
+def create_enrichment_pool():
+    if config.enrich_workers > 0:
+        return EnrichmentPool(config.enrich_workers, config.enrich_queue_size)
+    return None
@@ -0,0 +1,155 @@
+#Several receivers' aircraft.json feeds merged into one snapshot
+# Every feed is fetched at once on a small thread pool, so a poll takes about as long as the slowest
+# feed rather than all of them added up. An aircraft heard by more than one receiver is kept once,
+# at the freshest position any of them has. Each aircraft is tagged with the receiver that position
+# came from, and its distance and bearing are worked out from that receiver's home.
+# With a single feed the snapshot is passed on untouched, as before.
+import http_client
+import metrics
+import constants
+import config
+import concurrent.futures
+import math
+import numpy
+import logging
+
+logger = logging.getLogger('Feeds')
+
+class Receiver:
+    def __init__(self, url, home):
+        self.url = url
+        self.home = home
+        #the last snapshot this feed sent, reused when it answers 304
+        self.last = None
+        self.failures = 0
+
+def parse_receivers(entries, default_url, default_home):
+    #entries are url or url@lat,lon. With none there's just the one feed at default_url
+    receivers = []
+    for entry in entries:
+        url, home = entry, default_home
+        if '@' in entry:
+            head, tail = entry.rsplit('@', 1)
+            try:
+                lat, lon = (float(value) for value in tail.split(','))
+                url, home = head, (lat, lon)
+            except ValueError:
+                #an @ that's part of the url, as in user:password@host
+                pass
+        receivers.append(Receiver(url, home))
+    return receivers or [Receiver(default_url, default_home)]
+
+receivers = parse_receivers(config.live_data_urls, config.live_data_url, constants.home)
+#receiver homes as arrays, with MY_LAT/MY_LON on the end for aircraft that aren't tagged
+home_lats = numpy.array([receiver.home[0] for receiver in receivers] + [constants.home[0]])
+home_lons = numpy.array([receiver.home[1] for receiver in receivers] + [constants.home[1]])
+
+def home_of(aircraft):
+    #home of the receiver an aircraft's position came from. A single feed isn't merged so nothing is
+    # tagged, but its home may still be set with url@lat,lon
+    receiver = aircraft.get('receiver', None)
+    if receiver is None:
+        return receivers[0].home if receivers.__len__() == 1 else constants.home
+    return receivers[receiver].home
+
+def homes(aircraft_list):
+    #what geometry.prefilter measures from. One home with a single receiver, otherwise a pair of arrays
+    if receivers.__len__() == 1:
+        return receivers[0].home
+    index = numpy.fromiter((aircraft.get('receiver', -1) for aircraft in aircraft_list), dtype=numpy.intp, count=aircraft_list.__len__())
+    return home_lats[index], home_lons[index]
+
+def receiver_homes(indexes):
+    #as homes(), from the receiver index of each point (None where it isn't tagged)
+    if receivers.__len__() == 1:
+        return receivers[0].home
+    index = numpy.fromiter((-1 if receiver is None else receiver for receiver in indexes), dtype=numpy.intp, count=indexes.__len__())
+    return home_lats[index], home_lons[index]
+
+def aged(aircraft, age):
+    #a copy of an aircraft from an older snapshot, with its seen times counted from a newer one
+    aircraft = dict(aircraft)
+    for key in ('seen', 'seen_pos'):
+        if aircraft.get(key, None) is not None:
+            aircraft[key] = aircraft[key] + age
+    if aircraft.get('lastPosition', None) is not None and aircraft['lastPosition'].get('seen_pos', None) is not None:
+        aircraft['lastPosition'] = dict(aircraft['lastPosition'], seen_pos=aircraft['lastPosition']['seen_pos'] + age)
+    return aircraft
+
+def position_age(aircraft):
+    #seconds since the position we'd use was heard. Aircraft without one lose to any that have one
+    fix = aircraft if 'lat' in aircraft else aircraft.get('lastPosition', None)
+    if fix is None:
+        return math.inf
+    seen_pos = fix.get('seen_pos', None)
+    return 0 if seen_pos is None else seen_pos
+
+def merge(snapshots):
+    #snapshots are (receiver index, snapshot). Every aircraft comes out once, at its freshest position,
+    # with its seen times counted from the newest snapshot
+    now = max(data.get('now', 0) for _, data in snapshots)
+    merged = {}
+    duplicates = 0
+    for index, data in snapshots:
+        lag = now - data.get('now', now)
+        for aircraft in data['aircraft']:
+            #readsb marks non-ICAO addresses with ~, which handle_contact strips later
+            key = aircraft['hex'].replace('~', '').lower()
+            age = position_age(aircraft) + lag
+            best = merged.get(key, None)
+            if best is not None:
+                duplicates += 1
+                if age >= best[0]:
+                    continue
+            if lag > 0:
+                aircraft = aged(aircraft, lag)
+            aircraft['receiver'] = index
+            merged[key] = (age, aircraft)
+    metrics.feed_duplicates.inc(duplicates)
+    logger.debug(str(merged.__len__()) + " aircraft from " + str(snapshots.__len__()) + " feeds, " + str(duplicates) + " heard more than once")
+    return {'now': now, 'messages': sum(data.get('messages', 0) for _, data in snapshots),
+            'aircraft': [aircraft for _, aircraft in merged.values()]}
+
+class FeedSet:
+    def __init__(self, receivers, fetch, workers):
+        #fetch(url) returns a snapshot, http_client.not_modified or None, as http_client.get_feed does
+        self.receivers = receivers
+        self.fetch_one = fetch
+        self.executor = None
+        if receivers.__len__() > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, receivers.__len__())),
+                                                                  thread_name_prefix='feed')
+        logger.info("Polling " + str(receivers.__len__()) + " feed(s)")
+
+    def fetch(self):
+        #one merged snapshot, not_modified if no feed has anything new, or None if none answered
+        if self.executor is None:
+            return self.fetch_one(self.receivers[0].url)
+        results = list(self.executor.map(self.fetch_one, [receiver.url for receiver in self.receivers]))
+        snapshots = []
+        changed = False
+        for index, (receiver, data) in enumerate(zip(self.receivers, results)):
+            if data is http_client.not_modified:
+                data = receiver.last
+            elif data is None:
+                #a receiver that's down just drops out until it's back
+                receiver.failures += 1
+                metrics.feed_failures.inc(feed=receiver.url)
+                logger.info("No data from " + receiver.url)
+            else:
+                receiver.last = data
+                changed = True
+            if data is not None:
+                snapshots.append((index, data))
+        if not snapshots:
+            return None
+        if not changed:
+            return http_client.not_modified
+        return merge(snapshots)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+def create_feed_set():
+    return FeedSet(receivers, http_client.get_feed, config.feed_workers)
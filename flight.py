@@ -1,6 +1,7 @@
 #Class definition of a flight object
 import helper_functions
 import constants
+import feeds
 import config
 from registration import Registration
 import logging
@@ -8,7 +9,7 @@ import logging
 logger = logging.getLogger('Flight')
 
 class Flight:
-    def __init__(self, now, aircraftjson):
+    def __init__(self, now, aircraftjson, enrich=True, geofence=None):
         self.timestamp = round(now)
         self.hex = None
         self.flight = None
@@ -30,8 +31,17 @@ class Flight:
         self.flightroute_source = None
         self.bearing = None
         self.bsky_post = None
-        self.reg = Registration(aircraftjson['hex'])
+        #name of the geofence that got the aircraft recorded, if any
+        self.geofence = geofence
+        self.id = None
+        self.reg = None
         self.SetProperties(aircraftjson)
+        #the lookups can be left for the enrichment workers so the poll loop isn't held up
+        if enrich:
+            self.Enrich()
+
+    def Enrich(self):
+        self.reg = Registration(self.hex)
         self.CheckAeroAPI()
         #self.Checkadsbdb() #This is a last resort. Callsign information (flight routes) is very inaccurate. Hexdb even worse for this.
    
@@ -50,7 +60,9 @@ class Flight:
         self.track = None if self.track is None else round(self.track)
         self.squawk = aircraftjson.get('squawk',None)
         self.emerg = aircraftjson.get('emergency',None)
-        self.bearing = round(helper_functions.get_bearing(constants.home, (self.lat, self.lon)))
+        #an emergency can be alerted on before there's a position, from the squawk alone
+        if self.lat is not None and self.lon is not None:
+            self.bearing = round(helper_functions.get_bearing(feeds.home_of(aircraftjson), (self.lat, self.lon)))
         logger.info(self.hex + ": Default properties set")
 
     def Checkadsbdb(self):
@@ -113,8 +125,8 @@ class Flight:
             aircraft_insert = "insert into flights "\
                         "(timestamp, icao_hex, flight, " \
                         " altitude, speed, lat, lon, distance, heading, squawk, emergency, airline_name, airline_country," \
-                        " origin_icao, dest_icao, flightroute_source, bearing, bsky_post)" \
-                        " values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) on conflict do nothing;"
+                        " origin_icao, dest_icao, flightroute_source, bearing, bsky_post, geofence)" \
+                        " values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) on conflict do nothing returning id;"
             aircraft_values = (self.timestamp, #timestamp
                         self.hex, #icao_hex
                         self.flight, #flight
@@ -132,14 +144,15 @@ class Flight:
                         self.dest_icao, #dest icao
                         self.flightroute_source,
                         self.bearing,
-                        self.bsky_post                 
+                        self.bsky_post,
+                        self.geofence
                         )        
         else:
             aircraft_insert = "insert or ignore into flights "\
                         "(timestamp, icao_hex, flight, " \
                         " altitude, speed, lat, lon, distance, heading, squawk, emergency, airline_name, airline_country," \
-                        " origin_icao, dest_icao, flightroute_source, bearing, bsky_post)" \
-                        " values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);"
+                        " origin_icao, dest_icao, flightroute_source, bearing, bsky_post, geofence)" \
+                        " values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?);"
             aircraft_values = [self.timestamp, #timestamp
                         self.hex, #icao_hex
                         self.flight, #flight
@@ -157,8 +170,25 @@ class Flight:
                         self.dest_icao, #dest icao
                         self.flightroute_source,
                         self.bearing,
-                        self.bsky_post                 
+                        self.bsky_post,
+                        self.geofence
                         ]
 
-        #write this into the database
-        helper_functions.insert_update_row(aircraft_insert, aircraft_values)
\ No newline at end of file
+        #write this into the database and remember it so we don't have to look it up again
+        self.id = helper_functions.insert_row_returning_id(aircraft_insert, aircraft_values)
+        if self.id is not None:
+            helper_functions.aircraft_table.add(self.hex, self.id, self.timestamp, self.bsky_post)
+
+    def UpdateEnrichedRecord(self):
+        #fill in what the lookups found on the row we inserted earlier
+        if config.postgres_enabled:
+            enriched_update = "update flights set flight = (%s), airline_name = (%s), airline_country = (%s)," \
+                        " origin_icao = (%s), dest_icao = (%s), flightroute_source = (%s) where id = (%s)"
+            enriched_values = (self.flight, self.airline_name, self.airline_country,
+                        self.origin_icao, self.dest_icao, self.flightroute_source, self.id)
+        else:
+            enriched_update = "update flights set flight = (?), airline_name = (?), airline_country = (?)," \
+                        " origin_icao = (?), dest_icao = (?), flightroute_source = (?) where id = (?)"
+            enriched_values = [self.flight, self.airline_name, self.airline_country,
+                        self.origin_icao, self.dest_icao, self.flightroute_source, self.id]
+        helper_functions.insert_update_row(enriched_update, enriched_values)
\ No newline at end of file
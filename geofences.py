@@ -0,0 +1,246 @@
+#Polygon geofences from a GeoJSON file (GEOFENCES_FILE)
+# Fences work alongside RECORD_RADIUS_KM and AIRSPACE_RADIUS_KM. Anything inside an 'alert' fence
+# is recorded and posted about wherever it is, anything inside a 'record' fence is recorded without
+# a post, and anything inside an 'exclude' fence is dropped, even inside the circles.
+# At startup the fences are drawn onto a grid. Most cells are wholly inside or outside every fence,
+# so a single array lookup answers for everything in them. Only positions in a cell an edge runs
+# through, or one an altitude limited fence covers, get an exact even-odd test.
+# Coordinates are taken as flat lon/lat, so a fence can't cross the antimeridian.
+import config
+import numpy
+import json
+import math
+import time
+import logging
+
+logger = logging.getLogger('Geofences')
+
+#in order of priority. An aircraft inside more than one fence takes the first of these, then the one earliest in the file
+actions = ('exclude', 'alert', 'record')
+#cells along the longer side of the grid
+grid_cells = 512
+#what a grid cell holds when it isn't a fence's index
+no_fence = -1
+check_exactly = -2
+#how far (in cells) to widen each edge when drawing it, so rounding never leaves out a cell it touches
+edge_slack = 1e-6
+
+def altitude_of(aircraft):
+    #feet, with on the ground as 0. NaN when unknown, which is outside any altitude limits
+    altitude = aircraft.get('alt_baro', None)
+    if altitude == 'ground':
+        return 0.0
+    return float(altitude) if isinstance(altitude, (int, float)) else math.nan
+
+class Fence:
+    def __init__(self, name, action, rings, min_altitude=None, max_altitude=None):
+        self.name = name
+        self.action = action
+        self.min_altitude = min_altitude
+        self.max_altitude = max_altitude
+        self.banded = min_altitude is not None or max_altitude is not None
+        #every side of every ring as lon1, lat1, lon2, lat2. Under the even-odd rule holes and the
+        # parts of a MultiPolygon need nothing special
+        sides = []
+        for ring in rings:
+            points = [(float(point[0]), float(point[1])) for point in ring]
+            if points and points[0] != points[-1]:
+                points.append(points[0])
+            if points.__len__() < 4:
+                raise ValueError(name + ": a ring needs at least 3 points")
+            sides.extend((x1, y1, x2, y2) for (x1, y1), (x2, y2) in zip(points, points[1:]))
+        if not sides:
+            raise ValueError(name + ": no coordinates")
+        self.sides = numpy.array(sides, dtype=float)
+        #sides along a line of latitude are never crossed going east, so they're left out of the exact test
+        self.edges = self.sides[self.sides[:, 1] != self.sides[:, 3]]
+
+class FenceIndex:
+    def __init__(self, fences):
+        #sorted stays in file order within each action
+        self.fences = sorted(fences, key=lambda fence: actions.index(fence.action))
+        self.excludes = numpy.array([fence.action == 'exclude' for fence in self.fences], dtype=bool)
+        sides = numpy.concatenate([fence.sides for fence in self.fences])
+        self.min_lon, self.max_lon = min(sides[:, 0].min(), sides[:, 2].min()), max(sides[:, 0].max(), sides[:, 2].max())
+        self.min_lat, self.max_lat = min(sides[:, 1].min(), sides[:, 3].min()), max(sides[:, 1].max(), sides[:, 3].max())
+        self.cell = max(self.max_lon - self.min_lon, self.max_lat - self.min_lat, 1e-9) / grid_cells
+        self.cols = int(math.floor((self.max_lon - self.min_lon) / self.cell)) + 1
+        self.rows = int(math.floor((self.max_lat - self.min_lat) / self.cell)) + 1
+        #the fence each cell is wholly inside, no_fence, or check_exactly. Drawn lowest priority first
+        # so the fence that wins is the one left in a cell
+        self.answers = numpy.full((self.rows, self.cols), no_fence, dtype=numpy.intp)
+        exact = numpy.zeros((self.rows, self.cols), dtype=bool)
+        for index in reversed(range(self.fences.__len__())):
+            fence = self.fences[index]
+            edge = self.edge_cells(fence.sides)
+            inside = self.inside_cells(fence.edges) & ~edge
+            if fence.banded:
+                #whether it counts depends on each aircraft's altitude
+                exact |= edge | inside
+            else:
+                self.answers[inside] = index
+                exact |= edge
+        self.answers[exact] = check_exactly
+        self.exact_cells = int(numpy.count_nonzero(exact))
+        self.bucket_edges()
+
+    def edge_cells(self, sides):
+        #every cell a side passes through. Each row a side crosses gets a run of columns, marked at
+        # both ends and filled in with a running sum
+        marks = numpy.zeros((self.rows, self.cols + 1), dtype=numpy.int32)
+        for x1, y1, x2, y2 in sides:
+            low, high = min(y1, y2), max(y1, y2)
+            first = max(int(math.floor((low - self.min_lat) / self.cell - edge_slack)), 0)
+            last = min(int(math.floor((high - self.min_lat) / self.cell + edge_slack)), self.rows - 1)
+            rows = numpy.arange(first, last + 1)
+            bottom = numpy.clip(self.min_lat + rows * self.cell, low, high)
+            top = numpy.clip(self.min_lat + (rows + 1) * self.cell, low, high)
+            if y1 == y2:
+                west = numpy.full(rows.shape, min(x1, x2))
+                east = numpy.full(rows.shape, max(x1, x2))
+            else:
+                at_bottom = x1 + (bottom - y1) * (x2 - x1) / (y2 - y1)
+                at_top = x1 + (top - y1) * (x2 - x1) / (y2 - y1)
+                west = numpy.minimum(at_bottom, at_top)
+                east = numpy.maximum(at_bottom, at_top)
+            west = numpy.clip(numpy.floor((west - self.min_lon) / self.cell - edge_slack), 0, self.cols - 1).astype(numpy.intp)
+            east = numpy.clip(numpy.floor((east - self.min_lon) / self.cell + edge_slack), 0, self.cols - 1).astype(numpy.intp)
+            numpy.add.at(marks, (rows, west), 1)
+            numpy.add.at(marks, (rows, east + 1), -1)
+        return numpy.cumsum(marks, axis=1)[:, :-1] > 0
+
+    def inside_cells(self, edges):
+        #whether each cell's centre is inside, by the same even-odd rule as check(). Every
+        # crossing of a row's centre line is east of the centres in columns before it, so counting
+        # the crossings from the east end of the row gives each centre's count in one pass
+        centres = self.min_lat + (numpy.arange(self.rows) + 0.5) * self.cell
+        rows, which = numpy.nonzero((edges[:, 1] > centres[:, None]) != (edges[:, 3] > centres[:, None]))
+        e = edges[which]
+        x = e[:, 0] + (centres[rows] - e[:, 1]) * (e[:, 2] - e[:, 0]) / (e[:, 3] - e[:, 1])
+        #the first column whose centre isn't west of the crossing
+        after = numpy.clip(numpy.ceil((x - self.min_lon) / self.cell - 0.5), 0, self.cols).astype(numpy.intp)
+        counts = numpy.zeros((self.rows, self.cols + 1), dtype=numpy.int32)
+        numpy.add.at(counts, (rows, after), 1)
+        east = counts[:, ::-1].cumsum(axis=1)[:, ::-1]
+        return east[:, 1:] % 2 == 1
+
+    def locate(self, aircraft_list, lats, lons):
+        #index into self.fences of the fence each position is in, or no_fence. Missing positions (NaN) are in none
+        found = numpy.full(lats.shape, no_fence, dtype=numpy.intp)
+        rows = numpy.floor((lats - self.min_lat) / self.cell)
+        cols = numpy.floor((lons - self.min_lon) / self.cell)
+        on_grid = numpy.nonzero((rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols))[0]
+        found[on_grid] = self.answers[rows[on_grid].astype(numpy.intp), cols[on_grid].astype(numpy.intp)]
+        exact = numpy.nonzero(found == check_exactly)[0]
+        if exact.size:
+            found[exact] = self.check(aircraft_list, exact, lats[exact], lons[exact])
+        return found
+
+    def bucket_edges(self):
+        #every fence's edges listed under each grid row they pass through, so an exact check only
+        # looks at the edges in its own row. Kept as flat arrays in row order, with each edge's slope
+        # worked out ahead of time
+        edges = numpy.concatenate([fence.edges for fence in self.fences])
+        edge_fences = numpy.concatenate([numpy.full(fence.edges.shape[0], index, dtype=numpy.intp)
+                                         for index, fence in enumerate(self.fences)])
+        low = numpy.minimum(edges[:, 1], edges[:, 3])
+        high = numpy.maximum(edges[:, 1], edges[:, 3])
+        first = numpy.clip(numpy.floor((low - self.min_lat) / self.cell - edge_slack), 0, self.rows - 1).astype(numpy.intp)
+        last = numpy.clip(numpy.floor((high - self.min_lat) / self.cell + edge_slack), 0, self.rows - 1).astype(numpy.intp)
+        spans = last - first + 1
+        edge_ids = numpy.repeat(numpy.arange(edges.shape[0]), spans)
+        rows = numpy.repeat(first - numpy.cumsum(spans) + spans, spans) + numpy.arange(edge_ids.size)
+        edge_ids = edge_ids[numpy.argsort(rows, kind='stable')]
+        self.row_starts = numpy.concatenate(([0], numpy.cumsum(numpy.bincount(rows, minlength=self.rows))))
+        self.bucket_x1 = edges[edge_ids, 0]
+        self.bucket_y1 = edges[edge_ids, 1]
+        self.bucket_y2 = edges[edge_ids, 3]
+        self.bucket_slopes = (edges[edge_ids, 2] - edges[edge_ids, 0]) / (edges[edge_ids, 3] - edges[edge_ids, 1])
+        self.bucket_fences = edge_fences[edge_ids]
+        self.min_altitudes = numpy.array([-math.inf if fence.min_altitude is None else fence.min_altitude for fence in self.fences])
+        self.max_altitudes = numpy.array([math.inf if fence.max_altitude is None else fence.max_altitude for fence in self.fences])
+        self.banded = numpy.array([fence.banded for fence in self.fences], dtype=bool)
+
+    def check(self, aircraft_list, which, lats, lons):
+        #exact even-odd test, for positions near an edge. Every position is paired with the edges in
+        # its grid row, and the crossings east of it are counted for every fence at once
+        rows = numpy.floor((lats - self.min_lat) / self.cell).astype(numpy.intp)
+        starts = self.row_starts[rows]
+        counts = self.row_starts[rows + 1] - starts
+        points = numpy.repeat(numpy.arange(which.size), counts)
+        pairs = numpy.repeat(starts - numpy.cumsum(counts) + counts, counts) + numpy.arange(points.size)
+        y = lats[points]
+        y1 = self.bucket_y1[pairs]
+        crosses = ((y1 > y) != (self.bucket_y2[pairs] > y)) & (self.bucket_x1[pairs] + (y - y1) * self.bucket_slopes[pairs] > lons[points])
+        fence_count = self.fences.__len__()
+        crossings = numpy.bincount((points * fence_count + self.bucket_fences[pairs])[crosses], minlength=which.size * fence_count)
+        inside = (crossings.reshape(which.size, fence_count) & 1).astype(bool)
+        #altitudes only matter for positions inside a fence with altitude limits
+        banded = numpy.nonzero((inside & self.banded).any(axis=1))[0]
+        if banded.size:
+            altitudes = numpy.array([altitude_of(aircraft_list[which[i]]) for i in banded], dtype=float)[:, None]
+            inside[banded] &= ~self.banded | ((altitudes >= self.min_altitudes) & (altitudes <= self.max_altitudes))
+        #fences are in priority order, so the first one a position is in wins
+        return numpy.where(inside.any(axis=1), inside.argmax(axis=1), no_fence)
+
+    def excluded(self, found):
+        #which results from locate() are in an exclude fence
+        return (found >= 0) & self.excludes[found]
+
+    def fence(self, index):
+        return None if index < 0 else self.fences[index]
+
+def parse_altitude(value):
+    #feet, or 'ground'
+    if value is None:
+        return None
+    return 0.0 if value == 'ground' else float(value)
+
+def parse_fences(geojson):
+    #a FeatureCollection, a single Feature or a bare Polygon/MultiPolygon
+    if geojson.get('type', None) == 'FeatureCollection':
+        features = geojson.get('features', None) or []
+    elif geojson.get('type', None) == 'Feature':
+        features = [geojson]
+    else:
+        features = [{'type': 'Feature', 'geometry': geojson, 'properties': {}}]
+    fences = []
+    for number, feature in enumerate(features):
+        geometry = feature.get('geometry', None) or {}
+        properties = feature.get('properties', None) or {}
+        name = str(properties.get('name', None) or 'fence ' + str(number + 1))
+        action = str(properties.get('action', 'alert')).lower()
+        if action not in actions:
+            raise ValueError(name + ": action must be one of " + ", ".join(actions))
+        if geometry.get('type', None) == 'Polygon':
+            rings = geometry['coordinates']
+        elif geometry.get('type', None) == 'MultiPolygon':
+            rings = [ring for polygon in geometry['coordinates'] for ring in polygon]
+        else:
+            logger.info(name + ": skipping " + str(geometry.get('type', None)) + ". Only Polygon and MultiPolygon fences are supported")
+            continue
+        fences.append(Fence(name, action, rings, parse_altitude(properties.get('min_altitude', None)),
+                            parse_altitude(properties.get('max_altitude', None))))
+    return fences
+
+def load(path):
+    with open(path) as f:
+        fences = parse_fences(json.load(f))
+    if not fences:
+        raise ValueError(path + " has no Polygon or MultiPolygon features")
+    started = time.perf_counter()
+    index = FenceIndex(fences)
+    logger.info("Loaded " + str(fences.__len__()) + " geofences from " + path + " onto a " + str(index.rows) + " x " +
+                str(index.cols) + " grid in " + str(round((time.perf_counter() - started) * 1000)) + " ms. " +
+                str(index.exact_cells) + " cells need an exact check")
+    return index
+
+def add_flights_column(cur, conn):
+    #databases made before geofences don't have the flights.geofence column yet
+    if config.postgres_enabled:
+        cur.execute("alter table flights add column if not exists geofence varchar")
+    else:
+        cur.execute("pragma table_info(flights)")
+        if 'geofence' not in [column[1] for column in cur.fetchall()]:
+            cur.execute("alter table flights add column geofence text")
+    conn.commit()
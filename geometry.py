@@ -0,0 +1,78 @@
+#Batched geometry for a whole aircraft.json snapshot
+import helper_functions
+import numpy
+import logging
+
+logger = logging.getLogger('Geometry')
+
+#mean earth radius (IUGG) used for the spherical approximation
+earth_radius_km = 6371.0088
+# The haversine distance on the mean sphere is within 0.6% of the WGS-84 geodesic that
+# get_distance() returns. Anything closer than that to a radius edge gets the exact geodesic
+# solve, so in/out decisions always match get_distance(). Returned distances are within 0.6%
+# of get_distance() and bearings match get_bearing() to floating point precision.
+distance_tolerance = 0.006
+
+def snapshot_positions(aircraft_list):
+    #pull lat/lon out of every contact into arrays. Missing positions become NaN
+    lats = numpy.full(aircraft_list.__len__(), numpy.nan)
+    lons = numpy.full(aircraft_list.__len__(), numpy.nan)
+    for i, aircraft in enumerate(aircraft_list):
+        lat, lon = helper_functions.aircraft_lat_lon(aircraft)
+        if lat is not None and lon is not None:
+            lats[i] = lat
+            lons[i] = lon
+    return lats, lons
+
+#home is one (lat, lon), or a pair of arrays with a home for each position
+def haversine_km(home, lats, lons):
+    lat1 = numpy.radians(home[0])
+    lat2 = numpy.radians(lats)
+    dlat = lat2 - lat1
+    dlon = numpy.radians(lons - home[1])
+    a = numpy.sin(dlat/2)**2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dlon/2)**2
+    return 2 * earth_radius_km * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+#vectorised version of helper_functions.get_bearing
+def bearings(home, lats, lons):
+    lat1 = numpy.radians(home[0])
+    lat2 = numpy.radians(lats)
+    diffLong = numpy.radians(lons - home[1])
+    x = numpy.sin(diffLong) * numpy.cos(lat2)
+    y = numpy.cos(lat1) * numpy.sin(lat2) - (numpy.sin(lat1) * numpy.cos(lat2) * numpy.cos(diffLong))
+    return (numpy.degrees(numpy.arctan2(x, y)) + 360) % 360
+
+def prefilter(aircraft_list, home, *radii_km, fences=None):
+    #returns (aircraft, distance_km, bearing, fence) for every contact inside the largest radius
+    # home is one (lat, lon) for everything, or a pair of arrays with each aircraft's receiver home
+    # With a geofences.FenceIndex, contacts inside a fence come back wherever they are, with the
+    # fence they're in, and contacts inside an exclude fence don't come back at all
+    if aircraft_list.__len__() == 0:
+        return []
+    lats, lons = snapshot_positions(aircraft_list)
+    home_lats = numpy.broadcast_to(home[0], lats.shape)
+    home_lons = numpy.broadcast_to(home[1], lons.shape)
+    dists = haversine_km(home, lats, lons)
+    max_radius = max(radii_km)
+    #only contacts that could possibly be inside the biggest circle go any further
+    keep = dists <= max_radius * (1 + distance_tolerance)
+    found = None
+    if fences is not None:
+        found = fences.locate(aircraft_list, lats, lons)
+        keep = (keep | (found >= 0)) & ~fences.excluded(found)
+    candidates = numpy.nonzero(keep)[0]
+    if candidates.__len__() == 0:
+        return []
+    candidate_bearings = bearings((home_lats[candidates], home_lons[candidates]), lats[candidates], lons[candidates])
+
+    contacts = []
+    for i, bearing in zip(candidates, candidate_bearings):
+        dist = float(dists[i])
+        #near an edge the spherical estimate can't be trusted to make the call, so solve it exactly
+        if any(abs(dist - radius) <= radius * distance_tolerance for radius in radii_km):
+            dist = helper_functions.get_distance((float(home_lats[i]), float(home_lons[i])), (float(lats[i]), float(lons[i])))
+        fence = None if found is None else fences.fence(found[i])
+        if dist <= max_radius or fence is not None:
+            contacts.append((aircraft_list[i], dist, float(bearing), fence))
+    logger.debug(str(contacts.__len__()) + " of " + str(aircraft_list.__len__()) + " aircraft inside " + str(max_radius) + " km or a geofence")
+    return contacts
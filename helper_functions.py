@@ -1,20 +1,46 @@
 import constants
 import config
 import geopy.distance
-import sqlite3
 import datetime
-import requests
 import math
 import os
-from atproto import Client
 import logging
 from azure.storage.blob import BlobServiceClient
-import csv
 import pandas
-import psycopg2
+import db_connections
+import http_client
+import feeds
+import metrics
+import track_partitions
+import spatial
+import geofences
+from aircraft_state import AircraftStateTable
+from aeroapi_ledger import AeroApiLedger
+from airport_index import AirportIndex, Airport
+from registration_index import RegistrationIndex
+from negative_cache import NegativeCache
+from snapshot_delta import SnapshotDelta
 
 logger = logging.getLogger('Helper_Functions')
 
+#latest flights row for every aircraft seen inside the debounce window
+aircraft_table = AircraftStateTable()
+
+#every airport in the airports table, so route lookups don't need a query each
+airport_index = AirportIndex()
+
+#every aircraft in the registrations table, keyed by ICAO address
+registration_index = RegistrationIndex()
+
+#last position of every aircraft in the feed, so unchanged ones can be skipped
+feed_delta = SnapshotDelta(config.stale_position_seconds)
+
+#lookups that recently came back empty, so we don't ask again until the TTL runs out
+negative_cache = NegativeCache(config.negative_cache_ttl, config.negative_cache_provider_ttls, config.negative_cache_size)
+
+#polygon geofences compiled for fast lookups, or None without GEOFENCES_FILE
+geofence_index = None
+
 def get_distance(my_location, remote_location):
     distance = geopy.distance.distance(my_location, remote_location).kilometers
     #logger.debug("Object is " + str(round(distance,1)) + " km away")
@@ -76,19 +102,15 @@ def heading_to_direction(heading):
     else:  # heading >= 326.25 and heading < 348.75
         return "NNW"
 
-def sql_conn():
-    if config.postgres_enabled:
-        conn = psycopg2.connect(dbname=config.postgres_db,user=config.postgres_user,
-                                password=config.postgres_password,host=config.postgres_server,port=config.postgres_port)
-    else:
-        conn = sqlite3.connect(constants.db_name)
-    return conn
-
 def create_sql_tables():
     ##TODO simpler check if the table exists.
     #check_tables_query = "SELECT name FROM sqlite_master WHERE type='table'"
-    # connect to the database
-    conn = sql_conn()
+    # borrow a connection from the pool
+    with db_connections.connection() as conn:
+        create_tables(conn)
+    track_partitions.maintain(datetime.datetime.now(datetime.timezone.utc).timestamp(), force=True)
+
+def create_tables(conn):
     # get the cursor so we can do stuff
     cur = conn.cursor()
     # create our tables
@@ -99,7 +121,18 @@ def create_sql_tables():
         conn.commit()
         cur.execute(constants.registrations_table_postgres)
         conn.commit()
-        cur.execute(constants.tracks_table_postgres)
+        spatial.add_cell_columns(cur, conn)
+        geofences.add_flights_column(cur, conn)
+        if config.track_partitions in ('daily', 'monthly'):
+            track_partitions.create_tracks(cur, conn)
+        else:
+            cur.execute(constants.tracks_table_postgres)
+            conn.commit()
+            cur.execute(constants.tracks_indexes_postgres)
+            conn.commit()
+        cur.execute(constants.flight_summaries_table_postgres)
+        conn.commit()
+        cur.execute(constants.lookup_misses_table_postgres)
         conn.commit()
         cur.execute(constants.indexes_postgres)
         conn.commit()
@@ -110,27 +143,61 @@ def create_sql_tables():
         conn.commit()
         cur.execute(constants.registrations_table_sqlite)
         conn.commit()
+        cur.execute(constants.lookup_misses_table_sqlite)
+        conn.commit()
+        conn.executescript(constants.indexes_sqlite)
+        spatial.create_rtrees(cur, conn)
+        geofences.add_flights_column(cur, conn)
 
-    # close the connections
     cur.close()
-    conn.close()
 
-def aircraft_exists(this_aircraft, now):
-    # find the most recent entry for this aircraft
+def aircraft_state_window():
+    #how long a flights row can still influence a debounce or posting decision
+    return max(config.aircraft_debounce, config.bsky_post_lag)
+
+def warm_aircraft_state(now, keep=None):
+    #load every flight recent enough to matter. keep(hex) picks out a shard worker's own aircraft
+    oldest = round(now - aircraft_state_window())
     if config.postgres_enabled:
-        query = "select * from flights where icao_hex = (%s) order by id desc limit 1"
-        param = (this_aircraft['hex'],)
+        query = "select id, timestamp, icao_hex, bsky_post from flights where timestamp >= (%s)"
+        param = (oldest,)
     else:
-        query = "select * from flights where icao_hex = (?) order by id desc limit 1"
-        param = [this_aircraft['hex']]
-    # run the query to see if this one is entered yet
-    db_aircraft = sql_fetchone(query, param)
+        query = "select id, timestamp, icao_hex, bsky_post from flights where timestamp >= (?)"
+        param = [oldest]
+    db_flights = sql_fetchall(query, param)
+    if db_flights is not None:
+        #sorted here rather than in the query, which would make sqlite skip the timestamp index.
+        # Ascending id order so the latest row per hex wins
+        for flight_id, timestamp, hex, bsky_post in sorted(db_flights):
+            if keep is None or keep(hex):
+                aircraft_table.add(hex, flight_id, timestamp, bsky_post)
+    logger.info(str(aircraft_table.__len__()) + " recent aircraft loaded from the database")
+
+def evict_aircraft_state(now):
+    return aircraft_table.evict(round(now - aircraft_state_window()))
+
+def latest_flight_id(hex):
+    state = aircraft_table.get(hex)
+    if state is not None:
+        return state.flight_id
+    #not something we inserted recently, so fall back to the database
+    if config.postgres_enabled:
+        flightID = sql_fetchone("select ID from flights where icao_hex = (%s) order by id desc limit 1",(hex,))
+    else:
+        flightID = sql_fetchone("select ID from flights where icao_hex = (?) order by id desc limit 1",[hex])
+    return None if flightID is None else flightID[0]
+
+def aircraft_exists(this_aircraft, now):
+    # find the most recent entry for this aircraft. The state table holds every flight inside the
+    # debounce window so a miss here means there's nothing recent in the database either
+    db_aircraft = aircraft_table.seen(this_aircraft['hex'], now)
+    metrics.cache_lookups.inc(cache='aircraft_state', result='miss' if db_aircraft is None else 'hit')
     if db_aircraft is None:
         # this aircraft has never been in our airspace
         return False
     else:
         #we've seen this before, check the timestamp to verify it's  not been in the last X minutes
-        if round(now) > db_aircraft[1] + config.aircraft_debounce:
+        if round(now) > db_aircraft.timestamp + config.aircraft_debounce:
             #its been longer than the debounce time, so consider this a new entry
             return False
         else:
@@ -138,6 +205,8 @@ def aircraft_exists(this_aircraft, now):
             return True
 
 #generic function for handling calls to JSON APIs
+# Returns None when the request failed, so callers can tell that apart from an answer saying there's
+# nothing. adsbdb and hexdb say an aircraft is unknown with a 404, so that's an answer too
 def json_api_call(my_url, aeroAPI=False, hexdb=False):
     my_header = {'x-apikey':config.aero_api_key} if aeroAPI else {}
     if hexdb:
@@ -145,7 +214,13 @@ def json_api_call(my_url, aeroAPI=False, hexdb=False):
     my_url = my_url.strip()
     try:
         logger.debug("Making API call to " + my_url.strip())
-        req = requests.get(my_url.strip(), headers=my_header)
+        req = http_client.get(my_url.strip(), headers=my_header)
+        #everything but the usage endpoint costs money
+        if aeroAPI and not my_url.startswith(constants.aero_monthlyusage):
+            aeroapi_spend.record_call()
+        if not req.ok and req.status_code != 404:
+            logger.info("Error from " + my_url + ": HTTP " + str(req.status_code))
+            return None
         data = req.json()
     except Exception as e:
         logger.debug("General Exception. Error reaching " + my_url + "Exception: " + str(e))
@@ -165,47 +240,97 @@ def aircraft_lat_lon(aircraft):
     else:
         return None, None
 
+def aeroapi_usage():
+    #billing cycles start at the beginning of the month
+    # https://discussions.flightaware.com/t/billing-cycles-at-start-of-month-or-end-of-month/81398/2
+    firstdate = datetime.datetime.today().replace(day=1).strftime("%Y-%m-%d")
+    thisdate = datetime.datetime.today().strftime("%Y-%m-%d")
+    #The API throws an 'invalid argument' message if the start and end dates are the as the current date.
+    # either way the API costs would be zero to start a new billing cycle 
+    if thisdate == firstdate:
+        thisdate = datetime.datetime.today().replace(day=2).strftime("%Y-%m-%d")
+    dateparams = f"?start={firstdate}&end={thisdate}"
+    total_spent = json_api_call(constants.aero_monthlyusage+dateparams, aeroAPI=True)
+    if total_spent is None:
+        return None
+    elif 'total_cost' in total_spent:
+        total = total_spent['total_cost']
+    else:
+        total = 0
+    logger.info("Total spend this month on AeroAPI is $" + str(total))
+    return total
+
+#spend is only checked with FlightAware every so often, and estimated locally in between
+aeroapi_spend = AeroApiLedger(aeroapi_usage, config.aeroapi_reconcile_interval, config.aeroapi_call_cost)
+metrics.Gauge('aero_alerts_aeroapi_spend_dollars', 'AeroAPI spend this billing cycle, including local estimates', aeroapi_spend.total)
+
 def aeroapi_available():
     if config.aeroapi_limit > 0:
         #Let's stay just below the limit to give a slight buffer
-        #billing cycles start at the beginning of the month
-        # https://discussions.flightaware.com/t/billing-cycles-at-start-of-month-or-end-of-month/81398/2
-        firstdate = datetime.datetime.today().replace(day=1).strftime("%Y-%m-%d")
-        thisdate = datetime.datetime.today().strftime("%Y-%m-%d")
-        #The API throws an 'invalid argument' message if the start and end dates are the as the current date.
-        # either way the API costs would be zero to start a new billing cycle 
-        if thisdate == firstdate:
-            thisdate = datetime.datetime.today().replace(day=2).strftime("%Y-%m-%d")
-        dateparams = f"?start={firstdate}&end={thisdate}"
-        total_spent = json_api_call(constants.aero_monthlyusage+dateparams, aeroAPI=True)
-        if 'total_cost' in total_spent:
-                total = total_spent['total_cost']
-        else:
-            total = 0
-        logger.info("Total spend this month on AeroAPI is $" + str(total))
-        if total <= config.aeroapi_limit - 0.10:
+        total = aeroapi_spend.spent()
+        if total is not None and total <= config.aeroapi_limit - 0.10:
             return True
         else:
             return False
     else:
         return False
     
+def load_negative_cache(now):
+    oldest = round(now - negative_cache.max_ttl())
+    #nothing older than the longest TTL is any use, so tidy it up while we're here
+    if config.postgres_enabled:
+        insert_update_row("delete from lookup_misses where timestamp < (%s)", (oldest,))
+    else:
+        insert_update_row("delete from lookup_misses where timestamp < (?)", [oldest])
+    db_misses = sql_fetchall("select provider, lookup_key, timestamp from lookup_misses order by timestamp asc", [])
+    if db_misses is not None:
+        negative_cache.load(db_misses, now)
+
+def known_miss(provider, key):
+    miss = negative_cache.known_miss(provider, key)
+    metrics.cache_lookups.inc(cache='negative_' + provider, result='hit' if miss else 'miss')
+    return miss
+
+def remember_miss(provider, key):
+    now = round(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    negative_cache.add(provider, key, now)
+    if config.postgres_enabled:
+        query = "insert into lookup_misses (provider, lookup_key, timestamp) values (%s,%s,%s)" \
+                " on conflict (provider, lookup_key) do update set timestamp = excluded.timestamp;"
+        param = (provider, key, now)
+    else:
+        query = "insert or replace into lookup_misses (provider, lookup_key, timestamp) values (?,?,?);"
+        param = [provider, key, now]
+    insert_update_row(query, param)
+
+def log_negative_cache():
+    for provider, counts in negative_cache.stats().items():
+        logger.debug("Negative cache " + provider + ": " + str(counts['hits']) + " hits, " + str(counts['misses']) + " misses")
+
 def parse_flight(hex):
     #build return object
     this_flight = {}
+    if known_miss('flightaware', hex):
+        logger.debug(hex + ": FlightAware had nothing for this aircraft recently. Skipping")
+        return None
     url = "https://www.flightaware.com/live/modes/" + hex + "/redirect"
     try:
         logger.info("Parsing flight detail from " + url.strip())
         my_header = {'User-Agent':'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:135.0) Gecko/20100101 Firefox/135.0'}
-        redirect_url = requests.get(url, headers=my_header).url
+        response = http_client.get(url, headers=my_header)
     except Exception as e:
         logger.debug("General Exception. Error reaching " + url + "Exception: " + str(e))
         return None
+    #a refused, rate limited or failed request isn't FlightAware saying it has nothing, so it isn't remembered
+    if not response.ok:
+        logger.info(hex + ": FlightAware answered HTTP " + str(response.status_code) + ". Will try again next time")
+        return None
+    redirect_url = response.url
 
     #clean any mess from the URLs
     url = url.replace('https://www.flightaware.com/live/modes/',"").replace('https://flightaware.com/live/modes/',"")
     redirect_url = redirect_url.replace('https://www.flightaware.com/live/modes/',"").replace('https://flightaware.com/live/modes/',"")
-    if url != redirect_url:
+    if url != redirect_url and redirect_url.split('/').__len__() > 5:
         params = redirect_url.split('/')
         logger.debug('Parsed paramaters are: : %s', params)
         flight = redirect_url.split('/')[5]
@@ -225,20 +350,55 @@ def parse_flight(hex):
     else:
         flight = None
         this_flight = None
+        remember_miss('flightaware', hex)
 
     return this_flight
         
+def load_airport_index():
+    db_airports = sql_fetchall("select code_icao, code_iata, name, city, country_code, lat, lon from airports", [])
+    if db_airports is not None:
+        airport_index.load(db_airports)
+
+def load_geofences():
+    global geofence_index
+    if config.geofences_file:
+        geofence_index = geofences.load(config.geofences_file)
+
+def load_registration_index():
+    #this table can hold millions of rows so stream it rather than fetching it all at once
+    def work(conn):
+        if config.postgres_enabled:
+            cur = conn.cursor(name='registration_index')
+            cur.itersize = 50000
+        else:
+            cur = conn.cursor()
+        try:
+            cur.execute("select icao_hex, registration, model, manufacturer, owner_name, owner_country from registrations")
+            registration_index.load(cur)
+        finally:
+            cur.close()
+    try:
+        db_connections.run(work)
+    except Exception as e:
+        logger.info("Error loading registrations into memory. They will be looked up in the database instead. " + str(e))
+
 def get_airport_info(icao, timestamp=None):
     #build return object
     this_airport = {}
-    #check Airports DB
-    if config.postgres_enabled:
-        query = "select name, city from airports where code_icao = (%s) order by id desc limit 1"
-        param = (icao,)
+    #check the in-memory copy of the airports table first
+    if airport_index.loaded:
+        indexed_airport = airport_index.lookup(icao)
+        metrics.cache_lookups.inc(cache='airports', result='miss' if indexed_airport is None else 'hit')
+        db_airport = None if indexed_airport is None else (indexed_airport.name, indexed_airport.city)
     else:
-        query = "select name, city from airports where code_icao = (?) order by id desc limit 1"
-        param = [icao]
-    db_airport = sql_fetchone(query, param)
+        #check Airports DB
+        if config.postgres_enabled:
+            query = "select name, city from airports where code_icao = (%s) order by id desc limit 1"
+            param = (icao,)
+        else:
+            query = "select name, city from airports where code_icao = (?) order by id desc limit 1"
+            param = [icao]
+        db_airport = sql_fetchone(query, param)
     if db_airport is None and config.aeroapi_enabled and aeroapi_available():
         # this airport is new to us. Look it up and save it.
         airport_json = json_api_call(constants.aero_airport_url + icao, aeroAPI=True)
@@ -274,7 +434,14 @@ def get_airport_info(icao, timestamp=None):
                                 airport_json.get('longitude',None),
                                 airport_json.get('country_code',None),
                                 timestamp]
-            insert_update_row(airport_insert, airport_values)
+            if insert_update_row(airport_insert, airport_values):
+                airport_index.add(Airport(airport_json.get('code_icao',None),
+                                          airport_json.get('code_iata',None),
+                                          airport_json.get('name',None),
+                                          airport_json.get('city',None),
+                                          airport_json.get('country_code',None),
+                                          airport_json.get('latitude',None),
+                                          airport_json.get('longitude',None)))
             logger.info(icao + " airport details added to local database")
     elif db_airport is None:
         this_airport['name'] = None
@@ -288,62 +455,19 @@ def get_airport_info(icao, timestamp=None):
 
     return this_airport
 
-def save_track(now, aircraft):
-    #Validate the save path
-    #create one folder for each day
-    todaystring = "tracks-" + datetime.datetime.now().strftime('%Y-%m-%d')
-    #todayfolder = constants.adsb_save_folder + todaystring + "\\"
-    #todayfile = config.adsb_save_folder + "\\" + todaystring + ".csv"
-    todayfile = os.path.join(config.adsb_save_folder, todaystring + ".csv")
-    if not os.path.exists(todayfile):
-        try:
-            with open(todayfile, 'w', encoding='utf-8',newline='') as f:
-                writer = csv.writer(f)
-                writer.writerow(constants.csv_header)
-            logger.info("Created new file for today: " + todayfile)
-            #upload the database as a daily backup step
-            if config.azure_backup_enabled:
-                upload_database()
-        except Exception as e:
-            logger.info("Error creating save folder. Live info will not be saved.\n" + str(e))
-            return
-    # save this info to today's CSV file
-    logger.debug("Appending to csv file on disk: " + todayfile)
-    with open(todayfile, 'a', encoding='utf-8',newline='') as f:
-        writer = csv.writer(f)
-        #['Timestamp', 'Hex', 'Type', 'Flight','Altitude','Groundspeed','Track','Lat','Lon','FlightID']
-        flightID = sql_fetchone("select ID from flights where icao_hex = (?) order by id desc limit 1",[aircraft['hex']])
-        flight = aircraft.get('flight',None)
-        flight = None if flight is None else flight.strip()
-        alt = aircraft.get('alt_baro',None)
-        speed = aircraft.get('gs',None)
-        speed = None if speed is None else round(speed*constants.knots_to_kph,1)
-        track = track = aircraft.get('track',None)
-        track = None if track is None else round(track)
-        lat,lon = aircraft_lat_lon(aircraft)
-        info = [round(now),aircraft['hex'],aircraft['type'],flight,alt,speed,track,lat,lon,flightID[0]]
-        writer.writerow(info)
-
-def save_track_postgres(now, aircraft):
-    track_insert = "insert into tracks "\
-    "(timestamp, hex, type, flight, altitude, groundspeed, track, lat, lon, flightID)" \
-    " values (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) on conflict do nothing;"
-    
-    flightID = sql_fetchone("select ID from flights where icao_hex = (%s) order by id desc limit 1",(aircraft['hex'],))
+def track_values(now, aircraft):
+    #one row of the tracks table/csv, minus the flightID which is looked up separately
     flight = aircraft.get('flight',None)
     flight = None if flight is None else flight.strip()
     alt = aircraft.get('alt_baro',None)
     speed = aircraft.get('gs',None)
     speed = None if speed is None else round(speed*constants.knots_to_kph,1)
-    track = track = aircraft.get('track',None)
+    track = aircraft.get('track',None)
     track = None if track is None else round(track)
     lat,lon = aircraft_lat_lon(aircraft)
-        
-    track_values = (round(now),aircraft['hex'],aircraft['type'],flight,alt,speed,track,lat,lon,flightID[0])
-    insert_update_row(track_insert, track_values)
-    logger.debug(aircraft['hex'] + " written to tracks table in database")
+    return [round(now),aircraft['hex'],aircraft['type'],flight,alt,speed,track,lat,lon]
 
-def BlueskyPost(now):
+def postable_flights(now, pending_ids=()):
     # # Find any non-posted aircraft from within our tolerated lag window
     max_lag = round(now - config.bsky_post_lag)
     if config.postgres_enabled:
@@ -363,106 +487,90 @@ def BlueskyPost(now):
     
     # run the query to see if this one is entered yet.
     db_posts = sql_fetchall(query,param)
-
-    if db_posts.__len__() > 0:
-        try:
-            logger.info(str(db_posts.__len__()) + " postable items found")
-            # Instantiate the client object
-            client = Client()
-            # Log in 
-            client.login(config.bsky_account, config.bsky_app_pass)
-            #now make our post(s)   
-            for unposted_aircraft in db_posts:
-                post_text = ""
-                #bearing. Should always be known
-                if unposted_aircraft[8] is None:
-                    post_text += "Aircraft detected from unknown direction" + "!\n"
-                else:
-                    post_text += "Aircraft detected to the " + heading_to_direction(unposted_aircraft[8]) + "!\n" 
-                #owner/airline name
-                if unposted_aircraft[9] is None and unposted_aircraft[4] is None:
-                    owner = "Unknown owner"
-                elif unposted_aircraft[9] is None or unposted_aircraft[9] == 'Karat':
-                    owner = unposted_aircraft[4]
-                else:
-                    owner = unposted_aircraft[9]
-                #flight
-                if unposted_aircraft[0] is None or unposted_aircraft[0] == "":
-                    flight = "Unknown"
-                else:
-                    flight = unposted_aircraft[0]
-                #origin
-                if unposted_aircraft[10] is None:
-                    origin = "unknown origin"
-                else:
-                    origin = unposted_aircraft[10]
-                #destination
-                if unposted_aircraft[11] is None:
-                    dest = ""
-                else:
-                    dest = " to " + unposted_aircraft[11]            
-                #airline name, flight, origin airport, dest airport
-                post_text += owner + " flight #" + flight + " from " + origin + dest + "\n"
-                #model/manufacturer always report together
-                if unposted_aircraft[2] is None:
-                    model = "unknown"
-                else:
-                    model = unposted_aircraft[3] + " " + unposted_aircraft [2]
-                post_text += "Aircraft: " + model + "\n"
-                #registration
-                if unposted_aircraft[1] is None:
-                    tail = flight
-                else:
-                    tail = unposted_aircraft[1]
-                post_text += "Tail # " + tail + "\n"
-                #speed/haeading always report together
-                if unposted_aircraft[6] is None:
-                    speed = "unknown"
-                else:
-                    speed = str(unposted_aircraft[6]) + " km/h tracking " + heading_to_direction(unposted_aircraft[7])
-                post_text += "Speed: " + speed + "\n"
-                #alt
-                if unposted_aircraft[5] is None:
-                    alt = "unknown"
-                else:
-                    alt = str(unposted_aircraft[5]) + " ft"
-                post_text += "Alt: " + alt + "\n"
-            
-                logger.info("Bsky post is:\n" + post_text)
-                # Create and send a new post
-                try:
-                    new_post = client.send_post(post_text)
-                    successful_post = True
-                except Exception as e:
-                    
-                    logger.debug("Error posting: " + str(e))
-                    successful_post = False
-                #mark the record as being posted successfully
-                if successful_post:
-                    if config.postgres_enabled:
-                        query = "update flights set bsky_post = 1 where id = (%s)"
-                        param = (unposted_aircraft[12],)
-                    else:
-                        query = "update flights set bsky_post = 1 where id = (?)"
-                        param = [unposted_aircraft[12]]
-                    insert_update_row(query,param)
-        except Exception as e:
-            logger.debug("Error authenticating to Bluesky. Check credentials if this persists. "+ str(e))
-
-    return True
-
-def SetAircraftReportable(aircraft, now):
-    logger.debug("Checking if " + aircraft['hex'] + " set as reportable")
-    max_lag = round(now - config.bsky_post_lag)
+    #flights still being looked up wait for the next sweep so the post has all the details
+    return [] if db_posts is None else [row for row in db_posts if row[12] not in pending_ids]
+
+def bsky_post_text(unposted_aircraft):
+    post_text = ""
+    #bearing. Should always be known
+    if unposted_aircraft[8] is None:
+        post_text += "Aircraft detected from unknown direction" + "!\n"
+    else:
+        post_text += "Aircraft detected to the " + heading_to_direction(unposted_aircraft[8]) + "!\n" 
+    #owner/airline name
+    if unposted_aircraft[9] is None and unposted_aircraft[4] is None:
+        owner = "Unknown owner"
+    elif unposted_aircraft[9] is None or unposted_aircraft[9] == 'Karat':
+        owner = unposted_aircraft[4]
+    else:
+        owner = unposted_aircraft[9]
+    #flight
+    if unposted_aircraft[0] is None or unposted_aircraft[0] == "":
+        flight = "Unknown"
+    else:
+        flight = unposted_aircraft[0]
+    #origin
+    if unposted_aircraft[10] is None:
+        origin = "unknown origin"
+    else:
+        origin = unposted_aircraft[10]
+    #destination
+    if unposted_aircraft[11] is None:
+        dest = ""
+    else:
+        dest = " to " + unposted_aircraft[11]            
+    #airline name, flight, origin airport, dest airport
+    post_text += owner + " flight #" + flight + " from " + origin + dest + "\n"
+    #model/manufacturer report together when both are known. tar1090-db only has a description, kept as the model
+    if unposted_aircraft[2] is None:
+        model = "unknown"
+    elif unposted_aircraft[3] is None:
+        model = unposted_aircraft[2]
+    else:
+        model = unposted_aircraft[3] + " " + unposted_aircraft [2]
+    post_text += "Aircraft: " + model + "\n"
+    #registration
+    if unposted_aircraft[1] is None:
+        tail = flight
+    else:
+        tail = unposted_aircraft[1]
+    post_text += "Tail # " + tail + "\n"
+    #speed/haeading always report together
+    if unposted_aircraft[6] is None:
+        speed = "unknown"
+    else:
+        speed = str(unposted_aircraft[6]) + " km/h tracking " + heading_to_direction(unposted_aircraft[7])
+    post_text += "Speed: " + speed + "\n"
+    #alt
+    if unposted_aircraft[5] is None:
+        alt = "unknown"
+    else:
+        alt = str(unposted_aircraft[5]) + " ft"
+    post_text += "Alt: " + alt + "\n"
+    return post_text
+
+def mark_flights_posted(flight_ids):
+    #one update for everything posted in a sweep
+    flight_ids = list(flight_ids)
+    if not flight_ids:
+        return True
     if config.postgres_enabled:
-        query = "select id from flights where icao_hex = (%s) and bsky_post is null and timestamp >= (%s) order by id desc limit 1"
-        params = (aircraft['hex'], max_lag)
+        query = "update flights set bsky_post = 1 where id = any(%s)"
+        param = (flight_ids,)
     else:
-        query = "select id from flights where icao_hex = (?) and bsky_post is null and timestamp >= (?) order by id desc limit 1"
-        params = [aircraft['hex'], max_lag]
-    
-    id = sql_fetchone(query, params)
-    if id is not None:
+        query = "update flights set bsky_post = 1 where id in (" + ",".join("?" * flight_ids.__len__()) + ")"
+        param = flight_ids
+    if insert_update_row(query,param):
+        for flight_id in flight_ids:
+            aircraft_table.mark_posted(flight_id)
+        return True
+    return False
+
+def SetAircraftReportable(aircraft, now, geofence=None):
+    logger.debug("Checking if " + aircraft['hex'] + " set as reportable")
+    max_lag = round(now - config.bsky_post_lag)
+    state = aircraft_table.get(aircraft['hex'])
+    if state is not None and state.bsky_post is None and state.timestamp >= max_lag:
         logger.info(aircraft['hex'] + ": now set as reportable")
         #set the row as postable and upate more recent information about the aircraft
         newspeed = aircraft.get('gs',None)
@@ -471,9 +579,9 @@ def SetAircraftReportable(aircraft, now):
         newtrack = aircraft.get('track',None)
         newtrack = None if newtrack is None else round(newtrack)
         newlat, newlon = aircraft_lat_lon(aircraft)
-        newbearing = round(get_bearing(constants.home, (newlat, newlon)))
+        newbearing = round(get_bearing(feeds.home_of(aircraft), (newlat, newlon)))
         if config.postgres_enabled:
-            update_query = "update flights set timestamp = (%s), lat = (%s), lon = (%s), speed = (%s), altitude = (%s), heading = (%s), bearing = (%s), bsky_post = (%s) where id = (%s)"
+            update_query = "update flights set timestamp = (%s), lat = (%s), lon = (%s), speed = (%s), altitude = (%s), heading = (%s), bearing = (%s), bsky_post = (%s), geofence = coalesce(%s, geofence) where id = (%s)"
             update_values = (now,
                             newlat,
                             newlon,
@@ -482,10 +590,11 @@ def SetAircraftReportable(aircraft, now):
                             newtrack,
                             newbearing,
                             0,
-                            id[0]
+                            geofence,
+                            state.flight_id
                             )
         else:
-            update_query = "update flights set timestamp = (?), lat = (?), lon = (?), speed = (?), altitude = (?), heading = (?), bearing = (?), bsky_post = (?) where id = (?)"
+            update_query = "update flights set timestamp = (?), lat = (?), lon = (?), speed = (?), altitude = (?), heading = (?), bearing = (?), bsky_post = (?), geofence = coalesce(?, geofence) where id = (?)"
             update_values = [now,
                             newlat,
                             newlon,
@@ -494,23 +603,28 @@ def SetAircraftReportable(aircraft, now):
                             newtrack,
                             newbearing,
                             0,
-                            id[0]
+                            geofence,
+                            state.flight_id
                             ]
-        insert_update_row(update_query, update_values)
+        if insert_update_row(update_query, update_values):
+            aircraft_table.set_reportable(aircraft['hex'], now)
         logger.info(dt_to_datetime(now) + ": " + aircraft['hex'] + " is now in our space. Posting about it!")
+        return True
     
-    return
+    return False
 
 def sql_fetchone(query, values):
     logger.debug("Fetch one query: " + query)
     logger.debug('Fetch one values: : %s', values)
-    try:
-        conn = sql_conn()
+    def work(conn):
         cur = conn.cursor()
-        cur.execute(query, values)
-        result = cur.fetchone()
-        cur.close()
-        conn.close()
+        try:
+            cur.execute(query, values)
+            return cur.fetchone()
+        finally:
+            cur.close()
+    try:
+        result = db_connections.run(work)
     except Exception as e:
         logger.debug("SQL fetch one error: " + str(e))
         result = None
@@ -519,33 +633,61 @@ def sql_fetchone(query, values):
 def sql_fetchall(query, values):
     logger.debug("Fetch all query: " + query)
     logger.debug('Fetch all values: : %s', values)
-    try:
-        conn = sql_conn()
+    def work(conn):
         cur = conn.cursor()
-        cur.execute(query, values)
-        result = cur.fetchall()
-        cur.close()
-        conn.close()
+        try:
+            cur.execute(query, values)
+            return cur.fetchall()
+        finally:
+            cur.close()
+    try:
+        result = db_connections.run(work)
     except Exception as e:
         logger.debug("SQL fetch all error: " + str(e))
         result = None
     return result
 
+def insert_row_returning_id(query, record):
+    #postgres queries must end in "returning id"
+    logger.debug("Insert query: " + query)
+    logger.debug('Insert record: %s', record)
+    def work(conn):
+        cur = conn.cursor()
+        try:
+            cur.execute(query, record)
+            if config.postgres_enabled:
+                new_row = cur.fetchone()
+                new_id = None if new_row is None else new_row[0]
+            else:
+                new_id = cur.lastrowid
+            conn.commit()
+            return new_id
+        finally:
+            cur.close()
+    try:
+        new_id = db_connections.write(work)
+    except Exception as e:
+        logger.debug("SQL insert error: " + str(e))
+        new_id = None
+
+    return new_id
+
 def insert_update_row(query, record):
     logger.debug("Insert/Update query: " + query)
     logger.debug('Insert/Update record: %s', record)
-    try:
-        conn = sql_conn()
+    def work(conn):
         cur = conn.cursor()
-        cur.execute(query, record)
-        conn.commit()
+        try:
+            cur.execute(query, record)
+            conn.commit()
+        finally:
+            cur.close()
+    try:
+        db_connections.write(work)
         result = True
     except Exception as e:
         logger.debug("SQL insert error: " + str(e))
         result = False
-    finally:
-        cur.close()
-        conn.close()
         
     return result
 
@@ -553,16 +695,16 @@ def upload_database():
     #we must break the database tables down into individual csv files that can be uploaded
     tables = ['airports','flights','registrations']
     try:
-        conn = sql_conn()
-        for table in tables:
-            db_table = pandas.read_sql('SELECT * from ' + table, conn)
-            db_table.to_csv(config.adsb_save_folder + table + ".csv", index=False)
-        conn.close()
+        with db_connections.connection() as conn:
+            for table in tables:
+                db_table = pandas.read_sql('SELECT * from ' + table, conn)
+                db_table.to_csv(config.adsb_save_folder + table + ".csv", index=False)
     except Exception as e:
         logger.debug("Error exporting tables " + str(e))
 
     #now upload the database and exported tables to the blob container
     try:
+        db_connections.checkpoint()
         logger.info("Uploading database snapshot")
         blob_service_client = BlobServiceClient(account_url=config.azure_storage_account_url, credential=config.azure_storage_account_key)
         container_client = blob_service_client.get_container_client(config.azure_storage_container_name)
@@ -614,21 +756,71 @@ def validate_env_vars():
     logger.debug("[POSTGRES_DATABASE] = " + config.postgres_db)
     logger.debug("[POSTGRES_USER] = " + config.postgres_user)
     logger.debug("[POSTGRES_PASSWORD] = " + config.postgres_password)
+    logger.debug("[DB_POOL_MIN] = " + str(config.db_pool_min))
+    logger.debug("[DB_POOL_MAX] = " + str(config.db_pool_max))
+    logger.debug("[DB_HEALTHCHECK_SECONDS] = " + str(config.db_healthcheck_interval))
     logger.debug("[ADSB_SAVE_FOLDER] = " + config.adsb_save_folder)
+    logger.debug("[SQLITE_JOURNAL_MODE] = " + config.sqlite_journal_mode)
+    logger.debug("[SQLITE_SYNCHRONOUS] = " + config.sqlite_synchronous)
+    logger.debug("[SQLITE_CACHE_MB] = " + str(config.sqlite_cache_mb))
+    logger.debug("[SQLITE_MMAP_MB] = " + str(config.sqlite_mmap_mb))
+    logger.debug("[SQLITE_COMMIT_WINDOW_MS] = " + str(config.sqlite_commit_window_ms))
+    logger.debug("[TRACK_FLUSH_ROWS] = " + str(config.track_flush_rows))
+    logger.debug("[TRACK_FLUSH_MS] = " + str(config.track_flush_ms))
+    logger.debug("[TRACK_FSYNC_SECONDS] = " + str(config.track_fsync_seconds))
+    logger.debug("[TRACK_PARTITIONS] = " + config.track_partitions)
+    logger.debug("[TRACK_RETENTION_DAYS] = " + str(config.track_retention_days))
+    logger.debug("[TRACK_RETENTION_ACTION] = " + config.track_retention_action)
+    logger.debug("[TRACK_COMPRESSION_ENABLED] = " + str(config.track_compression_enabled))
+    logger.debug("[TRACK_POSITION_TOLERANCE_M] = " + str(config.track_position_tolerance_m))
+    logger.debug("[TRACK_ALTITUDE_TOLERANCE_FT] = " + str(config.track_altitude_tolerance_ft))
+    logger.debug("[TRACK_HEADING_TOLERANCE] = " + str(config.track_heading_tolerance))
+    logger.debug("[TRACK_SPEED_TOLERANCE_KT] = " + str(config.track_speed_tolerance_kt))
+    logger.debug("[TRACK_HEARTBEAT_SECONDS] = " + str(config.track_heartbeat_seconds))
     logger.debug("[LIVE_DATA_URL] = " + config.live_data_url)
+    logger.debug("[LIVE_DATA_URLS] = " + " ".join(config.live_data_urls))
+    logger.debug("[FEED_WORKERS] = " + str(config.feed_workers))
+    logger.debug("[HTTP_CONNECT_TIMEOUT] = " + str(config.http_connect_timeout))
+    logger.debug("[HTTP_READ_TIMEOUT] = " + str(config.http_read_timeout))
     logger.debug("[MY_LAT] = " + str(config.my_lat))
     logger.debug("[MY_LON] = " + str(config.my_lon))
     logger.debug("[AIRSPACE_RADIUS_KM] = " + str(config.airspace_radius_km))
     logger.debug("[RECORD_RADIUS_KM] = " + str(config.record_radius_km))
+    logger.debug("[GEOFENCES_FILE] = " + config.geofences_file)
     logger.debug("[SLEEP_TIME] = " + str(config.sleep_time))
+    logger.debug("[STALE_POSITION_SECONDS] = " + str(config.stale_position_seconds))
+    logger.debug("[METRICS_PORT] = " + str(config.metrics_port))
+    logger.debug("[INGEST_MODE] = " + config.ingest_mode)
+    logger.debug("[RUNTIME_MODE] = " + config.runtime_mode)
+    logger.debug("[PROCESS_WORKERS] = " + str(config.process_workers))
+    logger.debug("[SBS_HOST] = " + config.sbs_host)
+    logger.debug("[SBS_PORT] = " + str(config.sbs_port))
+    logger.debug("[SBS_POSITION_INTERVAL] = " + str(config.sbs_position_interval))
+    logger.debug("[SBS_STALE_SECONDS] = " + str(config.sbs_stale_seconds))
     logger.debug("[AIRCRAFT_DEBOUNCE] = " + str(config.aircraft_debounce))
+    logger.debug("[ENRICH_WORKERS] = " + str(config.enrich_workers))
+    logger.debug("[ENRICH_QUEUE_SIZE] = " + str(config.enrich_queue_size))
+    logger.debug("[ENRICH_PROVIDER_LIMIT] = " + str(config.enrich_provider_limit))
+    if config.enrich_provider_limit < 1:
+        raise ValueError("ENRICH_PROVIDER_LIMIT must be at least 1, or every lookup would wait forever")
     logger.debug("[AEROAPI_ENABLED] = " + str(config.aeroapi_enabled))
     logger.debug("[AEROAPI_LIMIT] = " + str(config.aeroapi_limit))
     logger.debug("[AEROAPI_KEY] = " + config.aero_api_key)
+    logger.debug("[AEROAPI_RECONCILE_SECONDS] = " + str(config.aeroapi_reconcile_interval))
+    logger.debug("[AEROAPI_CALL_COST] = " + str(config.aeroapi_call_cost))
+    logger.debug("[NEGATIVE_CACHE_TTL] = " + str(config.negative_cache_ttl))
+    logger.debug("[NEGATIVE_CACHE_TTLS] = " + str(config.negative_cache_provider_ttls))
+    logger.debug("[NEGATIVE_CACHE_SIZE] = " + str(config.negative_cache_size))
     logger.debug("[BSKY_POST_ENABLED] = " + str(config.bsky_post_enabled))
     logger.debug("[BSKY_ACCOUNT] = " + config.bsky_account)
     logger.debug("[BSKY_APP_PASS] = " + config.bsky_app_pass)
     logger.debug("[BSKY_POST_LAG] = " + str(config.bsky_post_lag))
+    logger.debug("[BSKY_SESSION_FILE] = " + str(config.bsky_session_file))
+    logger.debug("[BSKY_BACKOFF_SECONDS] = " + str(config.bsky_backoff_seconds))
+    logger.debug("[BSKY_BACKOFF_MAX] = " + str(config.bsky_backoff_max))
+    logger.debug("[EMERGENCY_ALERTS_ENABLED] = " + str(config.emergency_alerts_enabled))
+    logger.debug("[EMERGENCY_RADIUS_KM] = " + str(config.emergency_radius_km))
+    logger.debug("[EMERGENCY_REPEAT_SECONDS] = " + str(config.emergency_repeat_seconds))
     logger.debug("[AZ_BACKUP_ENABLED] = " + str(config.azure_backup_enabled))
     logger.debug("[AZ_STORAGE_ACCOUNT_URL] = " + config.azure_storage_account_url)
     logger.debug("[AZ_STORAGE_ACCOUNT_KEY] = " + config.azure_storage_account_key)
@@ -0,0 +1,122 @@
+#Shared HTTP sessions for the antenna feed and the lookup APIs
+# One keep-alive session per host, timeouts on everything, and a latency histogram per host
+import config
+import metrics
+import requests
+import requests.adapters
+import threading
+import time
+import urllib.parse
+import logging
+
+logger = logging.getLogger('HTTP_Client')
+
+#upper bounds (seconds) of the latency histogram buckets
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#returned by get_feed() when the feed hasn't changed since the last fetch
+not_modified = object()
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * (latency_buckets.__len__() + 1)
+        self.total = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(latency_buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = latency_buckets.__len__()
+        self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+    def as_dict(self):
+        labels = [str(bound) for bound in latency_buckets] + ['+Inf']
+        return {'count': self.count, 'errors': self.errors,
+                'mean_ms': 0 if self.count == 0 else round(self.total / self.count * 1000, 1),
+                'buckets': dict(zip(labels, self.counts))}
+
+sessions = {}
+histograms = {}
+provider_limits = {}
+#ETag/Last-Modified from the last successful fetch of each feed url
+feed_validators = {}
+lock = threading.Lock()
+
+def host_of(url):
+    return urllib.parse.urlsplit(url).netloc
+
+def session_for(host):
+    with lock:
+        if host not in sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(config.enrich_provider_limit, 1))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            sessions[host] = session
+            histograms[host] = LatencyHistogram()
+            #caps how many requests can be in flight to this host at once
+            provider_limits[host] = threading.BoundedSemaphore(config.enrich_provider_limit)
+        return sessions[host]
+
+def get(url, headers=None, limit=True, **kwargs):
+    #limit caps requests in flight to the host at ENRICH_PROVIDER_LIMIT, for the lookup providers.
+    # The feeds are fetched without it, so a slow lookup never holds up a poll
+    host = host_of(url)
+    session = session_for(host)
+    started = time.monotonic()
+    try:
+        if limit:
+            with provider_limits[host]:
+                response = session.get(url, headers=headers, timeout=(config.http_connect_timeout, config.http_read_timeout), **kwargs)
+        else:
+            response = session.get(url, headers=headers, timeout=(config.http_connect_timeout, config.http_read_timeout), **kwargs)
+    except Exception:
+        with lock:
+            histograms[host].errors += 1
+        metrics.http_errors.inc(host=host)
+        raise
+    elapsed = time.monotonic() - started
+    with lock:
+        histograms[host].observe(elapsed)
+    metrics.http_requests.inc(host=host)
+    metrics.http_seconds.observe(elapsed, host=host)
+    return response
+
+def get_feed(url):
+    #conditional GET for the antenna's aircraft.json. Returns not_modified on a 304
+    headers = {}
+    validators = feed_validators.get(url, {})
+    if 'etag' in validators:
+        headers['If-None-Match'] = validators['etag']
+    if 'last_modified' in validators:
+        headers['If-Modified-Since'] = validators['last_modified']
+    try:
+        response = get(url, headers=headers, limit=False)
+        if response.status_code == 304:
+            return not_modified
+        data = response.json()
+    except Exception as e:
+        logger.debug("General Exception. Error reaching " + url + "Exception: " + str(e))
+        return None
+    validators = {}
+    if 'ETag' in response.headers:
+        validators['etag'] = response.headers['ETag']
+    if 'Last-Modified' in response.headers:
+        validators['last_modified'] = response.headers['Last-Modified']
+    feed_validators[url] = validators
+    return data
+
+def latency_summary():
+    with lock:
+        return {host: histogram.as_dict() for host, histogram in histograms.items()}
+
+def log_latency():
+    for host, summary in latency_summary().items():
+        logger.debug(host + ": " + str(summary['count']) + " requests, " + str(summary['errors']) +
+                     " errors, mean " + str(summary['mean_ms']) + " ms, buckets " + str(summary['buckets']))
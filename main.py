@@ -1,9 +1,23 @@
 import helper_functions
+import geometry
+import db_connections
+import track_writer
+import track_partitions
+import enrichment
+import bluesky_poster
+import emergency_lane
+import http_client
+import feeds
+import metrics
+import sbs_ingest
+import async_runtime
+import shard_pool
 import constants
 import config
 import time
 import logging
 import sys
+import signal
 from flight import Flight
 
 def main():
@@ -20,42 +34,217 @@ def main():
     helper_functions.validate_env_vars()
     # start by ensuring the SQL backend is set up
     helper_functions.create_sql_tables()
+    #with PROCESS_WORKERS the workers keep the aircraft state, tracks and lookups, and this process coordinates
+    shards = shard_pool.create_shard_pool()
+    tracks = None
+    enricher = None
+    if shards is None:
+        # and load up recent flights so the debounce checks don't need the database
+        helper_functions.warm_aircraft_state(time.time())
+        helper_functions.load_airport_index()
+        helper_functions.load_registration_index()
+        helper_functions.load_geofences()
+        helper_functions.load_negative_cache(time.time())
+        tracks = track_writer.create_track_writer() if config.adsb_history_enabled else None
+        enricher = enrichment.create_enrichment_pool()
+    metrics.start_server()
+    #flights still being looked up wait for the next sweep so the post has all the details
+    if shards is not None:
+        pending_ids = shards.pending_ids
+    else:
+        pending_ids = set if enricher is None else enricher.pending_ids
+    poster = bluesky_poster.create_bluesky_poster(helper_functions.postable_flights, helper_functions.bsky_post_text,
+                                                  helper_functions.mark_flights_posted, pending_ids)
+    #emergencies are spotted before anything else is done with a snapshot, and alerted on ahead of the regular posts
+    emergencies = emergency_lane.create_emergency_lane(poster)
+    # docker stops us with SIGTERM. Treat it like ctrl+c so buffered tracks still get written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
+    try:
+        if config.ingest_mode == 'sbs':
+            stream_loop(logger, tracks, enricher, poster, emergencies)
+        elif config.runtime_mode == 'async':
+            async_loop(logger, tracks, enricher, poster, shards, emergencies)
+        else:
+            poll_loop(logger, tracks, enricher, poster, shards, emergencies)
+    finally:
+        if emergencies is not None:
+            emergencies.close()
+        if poster is not None:
+            poster.close()
+        if shards is not None:
+            shards.close()
+        if enricher is not None:
+            enricher.close()
+        if tracks is not None:
+            tracks.close()
+        db_connections.close_all()
+        logger.info("Shut down cleanly")
+
+def handle_contact(logger, now, aircraft, dist, tracks, enricher, fence=None):
+    #returns True when the aircraft has just become reportable. fence is the geofences.Fence it's inside, if any
+    aircraft['hex'] = aircraft['hex'].replace('~','')
+    geofence = None if fence is None else fence.name
+    logger.debug(aircraft['hex'] + ": " + str(round(dist,1)) + " km away" + ("" if fence is None else ", inside " + geofence))
+    if dist <= config.record_radius_km or fence is not None:
+        metrics.aircraft_seen.inc()
+        # check if this aircraft already exists in our local database
+        if not helper_functions.aircraft_exists(aircraft, now):
+            logger.info(aircraft['hex'] + " is not in the database. Adding")
+            with metrics.timer(metrics.stage_seconds, stage='insert_flight'):
+                #save what the antenna gave us now, and get specific flight details in the background
+                flyingthing = Flight(now, aircraft, enrich=enricher is None, geofence=geofence)
+                #write to DB
+                flyingthing.InsertAircraftRecord()
+            if flyingthing.id is not None:
+                metrics.flights_inserted.inc()
+            if enricher is not None and flyingthing.id is not None:
+                enricher.submit(flyingthing)
+        #here we log the track, now including the flight ID
+        if tracks is not None:
+            tracks.add(now, aircraft)
+    #if the aircraft is less than <airspace radius> away, or inside an alert fence, we set bsky_post to 0 instead of null
+    alert = fence is not None and fence.action == 'alert'
+    if dist <= config.airspace_radius_km or alert:
+        with metrics.timer(metrics.stage_seconds, stage='reportable'):
+            return helper_functions.SetAircraftReportable(aircraft, round(now), geofence if alert else None)
+    return False
+
+def persist(now, tracks):
+    #write what's buffered, and look after the tracks partitions about once an hour
+    if tracks is not None:
+        with metrics.timer(metrics.stage_seconds, stage='track_flush'):
+            tracks.flush()
+    track_partitions.maintain(now)
+
+def evict(now):
+    #forget aircraft that have left
+    with metrics.timer(metrics.stage_seconds, stage='evict'):
+        helper_functions.evict_aircraft_state(now)
+
+def housekeeping(now, tracks):
+    persist(now, tracks)
+    evict(now)
+
+def log_stats():
+    db_connections.log_stats()
+    http_client.log_latency()
+    helper_functions.log_negative_cache()
+
+def process_contacts(logger, data, tracks, enricher):
+    #returns what it found, which the shard coordinator adds up across workers
+    metrics.polls.inc()
+    metrics.aircraft_in_feed.set(data['aircraft'].__len__())
+    #only aircraft that have moved since the last poll have anything new to say
+    with metrics.timer(metrics.stage_seconds, stage='delta'):
+        moved, stale, unchanged = helper_functions.feed_delta.changed(data['aircraft'])
+    metrics.contacts_skipped.inc(stale, reason='stale')
+    metrics.contacts_skipped.inc(unchanged, reason='unchanged')
+    logger.debug(str(moved.__len__()) + " of " + str(data['aircraft'].__len__()) + " aircraft have new positions (" +
+                 str(stale) + " stale, " + str(unchanged) + " unchanged)")
+    counts = {'aircraft': data['aircraft'].__len__(), 'moved': moved.__len__(), 'stale': stale, 'unchanged': unchanged,
+              'in_range': 0, 'reportable': 0}
+    # if we have valid aircraft data, run through each aircraft to see the details
+    if moved.__len__():
+        #work out distance and bearing for the whole snapshot at once and only keep what's close enough to matter
+        with metrics.timer(metrics.stage_seconds, stage='prefilter'):
+            contacts = geometry.prefilter(moved, feeds.homes(moved), config.record_radius_km, config.airspace_radius_km,
+                                          fences=helper_functions.geofence_index)
+        metrics.contacts_in_range.set(contacts.__len__())
+        counts['in_range'] = contacts.__len__()
+        #per aircraft work is mostly in memory, so it's timed as a whole. New flights and reportable updates are timed on their own
+        with metrics.timer(metrics.stage_seconds, stage='contacts'):
+            for aircraft, dist, bearing, fence in contacts:
+                if handle_contact(logger, data['now'], aircraft, dist, tracks, enricher, fence):
+                    counts['reportable'] += 1
+    return counts
+
+def process_snapshot(logger, data, tracks, enricher, shards=None, emergencies=None):
+    if emergencies is not None:
+        #before anything else, so an emergency never waits on the database or the lookups
+        with metrics.timer(metrics.stage_seconds, stage='emergency'):
+            emergencies.check(data['now'], data['aircraft'])
+    with metrics.timer(metrics.stage_seconds, stage='poll'):
+        if shards is not None:
+            #the workers write out their own tracks and evict their own aircraft
+            shards.process(data)
+            persist(data['now'], None)
+        else:
+            process_contacts(logger, data, tracks, enricher)
+            housekeeping(data['now'], tracks)
+
+def poll_loop(logger, tracks, enricher, poster, shards=None, emergencies=None):
+    feed = feeds.create_feed_set()
     while True:
-        data = helper_functions.json_api_call(config.live_data_url)
+        with metrics.timer(metrics.stage_seconds, stage='fetch'):
+            data = feed.fetch()
+        if data is http_client.not_modified:
+            #nothing has changed since the last poll so there's nothing new to process
+            logger.debug("aircraft.json not modified since the last poll")
+            time.sleep(config.sleep_time)
+            continue
         if data is None:
-            print("Error: No valid 1090 data feed. Check to ensure the live_data_url constant is set correctly")
-
-        # if we have valid aircraft data, run through each aircraft to see the details
-        if data is not None and data['aircraft'].__len__():
-            for aircraft in data['aircraft']:
-                #Check location info
-                lat, lon = helper_functions.aircraft_lat_lon(aircraft)
-                if lat is not None and lon is not None:
-                    dist = helper_functions.get_distance(constants.home, (lat, lon))
-                    aircraft['hex'] = aircraft['hex'].replace('~','')
-                    logger.debug(aircraft['hex'] + ": " + str(round(dist,1)) + " km away")
-                    if dist <= config.record_radius_km:
-                        # check if this aircraft already exists in our local database
-                        if not helper_functions.aircraft_exists(aircraft, data['now']):
-                            logger.info(aircraft['hex'] + " is not in the database. Adding")
-                            #get specific flight details
-                            flyingthing = Flight(data['now'], aircraft)
-                            #write to DB
-                            flyingthing.InsertAircraftRecord()
-                        #here we log the track, now including the flight ID
-                        if config.adsb_history_enabled:
-                            if config.postgres_enabled:
-                                helper_functions.save_track_postgres(data['now'], aircraft)
-                            else:
-                                helper_functions.save_track(data['now'], aircraft)
-                    #if the aircraft is less than <airspace radius> away we set bsky_post to 0 instead of null
-                    if dist <= config.airspace_radius_km:
-                        helper_functions.SetAircraftReportable(aircraft, round(data['now']))
-        #tell the world
-        if data is not None and config.bsky_post_enabled:
-                helper_functions.BlueskyPost(data['now'])
+            print("Error: No valid 1090 data feed. Check to ensure LIVE_DATA_URL or LIVE_DATA_URLS is set correctly")
+        else:
+            process_snapshot(logger, data, tracks, enricher, shards, emergencies)
+        log_stats()
+        #tell the world. Posting happens on its own thread
+        if data is not None and poster is not None:
+            poster.notify()
         time.sleep(config.sleep_time)
 
+def async_loop(logger, tracks, enricher, poster, shards=None, emergencies=None):
+    #fetch, process and write tracks as overlapping stages, fetching on a fixed cadence
+    feed = feeds.create_feed_set()
+    def fetch():
+        data = feed.fetch()
+        #checked as soon as it arrives, even if processing is behind
+        if emergencies is not None and data is not None and data is not http_client.not_modified:
+            with metrics.timer(metrics.stage_seconds, stage='emergency'):
+                emergencies.check(data['now'], data['aircraft'])
+        return data
+    def process(data):
+        with metrics.timer(metrics.stage_seconds, stage='poll'):
+            if shards is not None:
+                shards.process(data)
+            else:
+                process_contacts(logger, data, tracks, enricher)
+                evict(data['now'])
+    def after_poll(data):
+        log_stats()
+        #tell the world. Posting happens on its own thread
+        if poster is not None:
+            poster.notify()
+    async_runtime.run(fetch, process,
+                      lambda now: persist(now, tracks), after_poll, config.sleep_time)
+
+def stream_loop(logger, tracks, enricher, poster, emergencies=None):
+    #same work as poll_loop, but one aircraft at a time as its messages arrive
+    stream = sbs_ingest.SbsStream(config.sbs_host, config.sbs_port)
+    sbs_aircraft = sbs_ingest.SbsAircraftTable(config.sbs_position_interval, config.sbs_stale_seconds)
+    last_housekeeping = time.monotonic()
+    for line in stream.lines():
+        now = time.time()
+        aircraft = None if line is None else sbs_aircraft.update(line, now)
+        #a squawk change comes in a message of its own, without a position, so every message is checked
+        if emergencies is not None and sbs_aircraft.touched is not None:
+            emergencies.check(now, [sbs_aircraft.touched])
+        if aircraft is not None:
+            for aircraft, dist, bearing, fence in geometry.prefilter([aircraft], constants.home, config.record_radius_km, config.airspace_radius_km,
+                                                                     fences=helper_functions.geofence_index):
+                #post as soon as it's in our airspace rather than waiting for the next sweep
+                if handle_contact(logger, now, aircraft, dist, tracks, enricher, fence) and poster is not None:
+                    poster.notify()
+        if time.monotonic() - last_housekeeping >= config.sleep_time:
+            last_housekeeping = time.monotonic()
+            sbs_aircraft.evict(now)
+            metrics.polls.inc()
+            metrics.aircraft_in_feed.set(sbs_aircraft.__len__())
+            logger.debug(str(stream.messages) + " SBS messages received, " + str(sbs_aircraft.__len__()) + " aircraft in view")
+            housekeeping(now, tracks)
+            log_stats()
+            if poster is not None:
+                poster.notify()
+
 if __name__ == "__main__":
     main()
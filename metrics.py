@@ -0,0 +1,212 @@
+#Lightweight in-process metrics, served in the Prometheus text format
+# Counters, gauges and histograms are plain dicts keyed by label values behind one lock each.
+# Nothing is recorded unless METRICS_PORT is set, so the hooks cost next to nothing when it isn't.
+import config
+import bisect
+import http.server
+import threading
+import time
+import logging
+
+logger = logging.getLogger('Metrics')
+
+enabled = config.metrics_port > 0
+
+#upper bounds (seconds) of the default latency buckets
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+
+def label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in labels) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help, function=None):
+        #function() is read at scrape time instead of set()
+        super().__init__(name, help)
+        self.function = function
+
+    def set(self, value, **labels):
+        if not enabled:
+            return
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [(self.name, (), self.function())]
+            except Exception as e:
+                logger.debug("Couldn't read " + self.name + ": " + str(e))
+                return []
+        return super().samples()
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        #label values -> [count per bucket..., +Inf count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = tuple(sorted(labels.items())) if labels else ()
+        with self.lock:
+            counts = self.values.get(key, None)
+            if counts is None:
+                counts = [0] * (self.buckets.__len__() + 1) + [0.0]
+                self.values[key] = counts
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', key + (('le', bound),), cumulative))
+            samples.append((self.name + '_sum', key, counts[-1]))
+            samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+class timer:
+    #with metrics.timer(metrics.stage_seconds, stage='name'): ...
+    # a plain class rather than a generator, as it wraps some per-aircraft work
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        if enabled:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if enabled:
+            self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+def take_counts(skip=()):
+    #counters and histograms recorded since the last call, cleared here, for a shard worker to send to
+    # the coordinator. Gauges describe the process they're in so they stay put
+    taken = []
+    for metric in registry:
+        if metric.kind == 'gauge' or metric in skip:
+            continue
+        with metric.lock:
+            if metric.values:
+                taken.append((metric.name, metric.values))
+                metric.values = {}
+    return taken
+
+def add_counts(taken):
+    #adds what take_counts() returned in another process to the metrics here
+    by_name = {metric.name: metric for metric in registry}
+    for name, values in taken:
+        metric = by_name.get(name, None)
+        if metric is None:
+            continue
+        with metric.lock:
+            for key, value in values.items():
+                current = metric.values.get(key, None)
+                if current is None:
+                    metric.values[key] = value
+                elif metric.kind == 'histogram':
+                    metric.values[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    metric.values[key] = current + value
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.append('# HELP ' + metric.name + ' ' + metric.help)
+        lines.append('# TYPE ' + metric.name + ' ' + metric.kind)
+        for name, labels, value in metric.samples():
+            lines.append(name + label_text(labels) + ' ' + str(value))
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(body.__len__()))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(port=None):
+    port = config.metrics_port if port is None else port
+    if not enabled or port <= 0:
+        return None
+    server = http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on port " + str(port))
+    return server
+
+#what the rest of the program records into
+stage_seconds = Histogram('aero_alerts_stage_seconds', 'Time spent in each stage of processing')
+polls = Counter('aero_alerts_polls_total', 'Feed snapshots or stream sweeps processed')
+ticks_missed = Counter('aero_alerts_ticks_missed_total', 'Scheduled feed fetches skipped because the one before overran (RUNTIME_MODE=async)')
+snapshots_merged = Counter('aero_alerts_snapshots_merged_total', 'Snapshots merged into the next one because processing was behind (RUNTIME_MODE=async)')
+feed_duplicates = Counter('aero_alerts_feed_duplicates_total', 'Aircraft heard by more than one receiver and merged into one')
+feed_failures = Counter('aero_alerts_feed_failures_total', 'Feed fetches that got nothing back, by feed (LIVE_DATA_URLS)')
+shard_seconds = Histogram('aero_alerts_shard_seconds', 'Time each shard worker took over a snapshot (PROCESS_WORKERS)')
+aircraft_in_feed = Gauge('aero_alerts_aircraft_in_feed', 'Aircraft in the latest feed snapshot')
+contacts_in_range = Gauge('aero_alerts_contacts_in_range', 'Aircraft within the record radius in the latest snapshot')
+contacts_skipped = Counter('aero_alerts_contacts_skipped_total', 'Aircraft in the feed left out because their position was stale or unchanged')
+aircraft_seen = Counter('aero_alerts_aircraft_seen_total', 'Aircraft positions handled within the record radius')
+flights_inserted = Counter('aero_alerts_flights_inserted_total', 'New flights rows')
+db_queries = Counter('aero_alerts_db_queries_total', 'Database round trips')
+db_seconds = Histogram('aero_alerts_db_seconds', 'Database round trip latency')
+db_write_batch = Histogram('aero_alerts_db_write_batch', 'Writes committed together by the SQLite writer', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+http_requests = Counter('aero_alerts_http_requests_total', 'HTTP requests by host')
+http_errors = Counter('aero_alerts_http_errors_total', 'HTTP requests that failed before a response, by host')
+http_seconds = Histogram('aero_alerts_http_seconds', 'HTTP request latency by host')
+cache_lookups = Counter('aero_alerts_cache_lookups_total', 'In-memory lookups by cache and result')
+track_rows = Counter('aero_alerts_track_rows_total', 'Track points written')
+track_points_dropped = Counter('aero_alerts_track_points_dropped_total', 'Track points left out by track compression')
+emergency_alerts = Counter('aero_alerts_emergency_alerts_total', 'Emergency alerts sent, by kind')
+bsky_posts = Counter('aero_alerts_bsky_posts_total', 'Bluesky posts by result')
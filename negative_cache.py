@@ -0,0 +1,61 @@
+#Remembers lookups that came back empty so we don't keep asking the same question
+# Keyed by (provider, hex/callsign). Entries expire after a per-provider TTL and the least
+# recently used are dropped once the cache is full.
+import collections
+import threading
+import time
+import logging
+
+logger = logging.getLogger('Negative_Cache')
+
+class NegativeCache:
+    def __init__(self, default_ttl, provider_ttls, max_entries):
+        self.default_ttl = default_ttl
+        self.provider_ttls = provider_ttls
+        self.max_entries = max_entries
+        #(provider, key) -> time the miss was recorded
+        self.entries = collections.OrderedDict()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.entries.__len__()
+
+    def ttl(self, provider):
+        return self.provider_ttls.get(provider, self.default_ttl)
+
+    def max_ttl(self):
+        return max([self.default_ttl] + list(self.provider_ttls.values()))
+
+    def add(self, provider, key, timestamp):
+        with self.lock:
+            self.entries[(provider, key)] = timestamp
+            self.entries.move_to_end((provider, key))
+            while self.entries.__len__() > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def load(self, rows, now):
+        #rows of (provider, key, timestamp), oldest first so the newest survive the size limit
+        for provider, key, timestamp in rows:
+            if timestamp + self.ttl(provider) > now:
+                self.add(provider, key, timestamp)
+        logger.info(str(self.entries.__len__()) + " known lookup misses loaded from the database")
+
+    def known_miss(self, provider, key, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            timestamp = self.entries.get((provider, key), None)
+            if timestamp is not None and timestamp + self.ttl(provider) > now:
+                self.entries.move_to_end((provider, key))
+                self.hits[provider] += 1
+                return True
+            if timestamp is not None:
+                del self.entries[(provider, key)]
+            self.misses[provider] += 1
+            return False
+
+    def stats(self):
+        with self.lock:
+            providers = set(self.hits) | set(self.misses)
+            return {provider: {'hits': self.hits[provider], 'misses': self.misses[provider]} for provider in providers}
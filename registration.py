@@ -3,6 +3,7 @@
 import constants
 import config
 import helper_functions
+import metrics
 import datetime
 import logging
 logger = logging.getLogger('Registration')
@@ -29,6 +30,9 @@ class Registration:
             self.InsertRegistrationRecord()
 
     def Checkadsbdb(self):
+        if helper_functions.known_miss('adsbdb', self.icao_hex):
+            logger.info(self.icao_hex + ": adsbdb had no aircraft metadata recently. Skipping")
+            return
         adsbdb_aircraft_details = helper_functions.json_api_call(constants.adsbdb_aircraft_url + self.icao_hex)
         if adsbdb_aircraft_details is not None and adsbdb_aircraft_details['response'] != "unknown aircraft":
             self.registration = adsbdb_aircraft_details['response']['aircraft']['registration']
@@ -42,10 +46,16 @@ class Registration:
             logger.info(self.icao_hex + ": Aircraft metadata gathered from adsbdb")
         else:
             logger.info(self.icao_hex + ": No aircraft metadata available from adsbdb")
+            #only remember a real answer, not a failed request
+            if adsbdb_aircraft_details is not None and adsbdb_aircraft_details.get('response', None) == "unknown aircraft":
+                helper_functions.remember_miss('adsbdb', self.icao_hex)
 
     def Checkhexdb(self):
         #aircraft details
         if self.registration is None:
+            if helper_functions.known_miss('hexdb', self.icao_hex):
+                logger.info(self.icao_hex + ": hexdb had no aircraft metadata recently. Skipping")
+                return
             hexdb_aircraft_details = helper_functions.json_api_call(constants.hexdb_aircraft_url + self.icao_hex,hexdb=True)
             if hexdb_aircraft_details is not None and 'Registration' in hexdb_aircraft_details:
                 self.registration = hexdb_aircraft_details['Registration']
@@ -59,6 +69,8 @@ class Registration:
                 logger.info(self.icao_hex + ": Aircraft metadata gathered from hexdb")
             else:
                 logger.info(self.icao_hex + ": No aircraft metadata available from hexdb")
+                if hexdb_aircraft_details is not None:
+                    helper_functions.remember_miss('hexdb', self.icao_hex)
 
     def CheckAeroAPI(self):
         logger.debug("Calling the CheckAeroAPI function here to get registration info from AeroAPI. Haven't needed this yet!")
@@ -66,6 +78,19 @@ class Registration:
         
 
     def CheckExisting(self):
+        #the in-memory index holds the whole registrations table, so a miss there means a miss here too
+        if helper_functions.registration_index.loaded:
+            indexed = helper_functions.registration_index.get(self.icao_hex)
+            metrics.cache_lookups.inc(cache='registrations', result='miss' if indexed is None else 'hit')
+            if indexed is not None:
+                self.registration, self.model, self.manufacturer, self.owner_name, self.owner_country = indexed
+                self.source = 'internal'
+                self.valid = True
+                logger.info(self.icao_hex + ": Aircraft metadata found locally from internal database")
+            else:
+                logger.info(self.icao_hex + ": No aircraft metadata available internally")
+            return
+
         if config.postgres_enabled:
             query = "select registration, model, manufacturer, owner_name, owner_country, timestamp from registrations where icao_hex = (%s)"
             param = (self.icao_hex,)
@@ -116,4 +141,6 @@ class Registration:
                         ]
 
         #write this into the database, and return True. Return False if an error occurs
-        helper_functions.insert_update_row(reg_insert, reg_values)
+        if helper_functions.insert_update_row(reg_insert, reg_values):
+            helper_functions.registration_index.add(self.icao_hex, self.registration, self.model,
+                                                    self.manufacturer, self.owner_name, self.owner_country)
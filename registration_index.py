@@ -0,0 +1,192 @@
+#Compact in-memory copy of the registrations table, plus bulk import of offline aircraft databases
+# Usage: python registration_index.py <file> [<file> ...]
+#   aircraft.csv(.gz) from tar1090-db (https://github.com/wiedehopf/tar1090-db), a BaseStation
+#   style csv export with a ModeS column, or a BaseStation.sqb database
+import db_connections
+import config
+import array
+import bisect
+import datetime
+import threading
+import numpy
+import psycopg2.extras
+import sqlite3
+import gzip
+import csv
+import sys
+import logging
+
+logger = logging.getLogger('Registration_Index')
+
+#rows written per insert batch/transaction during an import
+import_batch_size = 50000
+#separates the fields of one aircraft inside the packed record blob
+field_separator = '\x1f'
+
+def hex_to_int(hex):
+    try:
+        return int(hex, 16)
+    except (TypeError, ValueError):
+        return None
+
+class RegistrationIndex:
+    # Aircraft are held as a sorted array of 24-bit ICAO addresses, with each aircraft's details
+    # packed into one shared bytes blob. That's a few dozen bytes per airframe instead of a few
+    # hundred for a dict of tuples, and a binary search over the array is well under a microsecond.
+    def __init__(self):
+        self.keys = array.array('I')
+        self.offsets = array.array('Q', [0])
+        self.blob = b''
+        #anything added while running lands here rather than re-sorting the arrays
+        self.recent = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+
+    def __len__(self):
+        return self.keys.__len__() + self.recent.__len__()
+
+    def pack(self, registration, model, manufacturer, owner_name, owner_country):
+        fields = (registration, model, manufacturer, owner_name, owner_country)
+        return field_separator.join('' if field is None else str(field) for field in fields).encode('utf-8')
+
+    def unpack(self, record):
+        return tuple(None if field == '' else field for field in record.decode('utf-8').split(field_separator))
+
+    def load(self, rows):
+        #rows of (icao_hex, registration, model, manufacturer, owner_name, owner_country), in any order
+        keys = array.array('I')
+        offsets = array.array('Q', [0])
+        blob = bytearray()
+        for row in rows:
+            key = hex_to_int(row[0])
+            if key is None:
+                continue
+            keys.append(key)
+            blob += self.pack(*row[1:6])
+            offsets.append(blob.__len__())
+        #sort by address, dropping any duplicates
+        order = numpy.argsort(numpy.frombuffer(keys, dtype=numpy.uint32), kind='stable')
+        sorted_keys = array.array('I')
+        sorted_offsets = array.array('Q', [0])
+        sorted_blob = bytearray()
+        for i in order.tolist():
+            if sorted_keys and sorted_keys[-1] == keys[i]:
+                continue
+            sorted_keys.append(keys[i])
+            sorted_blob += blob[offsets[i]:offsets[i + 1]]
+            sorted_offsets.append(sorted_blob.__len__())
+        with self.lock:
+            self.keys = sorted_keys
+            self.offsets = sorted_offsets
+            self.blob = bytes(sorted_blob)
+            self.recent = {}
+            self.loaded = True
+        logger.info(str(self.keys.__len__()) + " aircraft registrations loaded into memory (" +
+                    str(round(self.memory_bytes() / 1048576, 1)) + " MB)")
+
+    def memory_bytes(self):
+        return self.keys.__len__() * self.keys.itemsize + self.offsets.__len__() * self.offsets.itemsize + self.blob.__len__()
+
+    def add(self, icao_hex, registration, model, manufacturer, owner_name, owner_country):
+        key = hex_to_int(icao_hex)
+        if key is not None:
+            with self.lock:
+                self.recent[key] = self.pack(registration, model, manufacturer, owner_name, owner_country)
+
+    def get(self, icao_hex):
+        #returns (registration, model, manufacturer, owner_name, owner_country) or None
+        key = hex_to_int(icao_hex)
+        if key is None:
+            return None
+        record = self.recent.get(key, None)
+        if record is None:
+            keys = self.keys
+            i = bisect.bisect_left(keys, key)
+            if i == keys.__len__() or keys[i] != key:
+                return None
+            record = self.blob[self.offsets[i]:self.offsets[i + 1]]
+        return self.unpack(record)
+
+def tar1090_rows(filename):
+    #icao;registration;typecode;dbFlags;description;year;ownop
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', encoding='utf-8', newline='') as f:
+        for line in csv.reader(f, delimiter=';'):
+            if line.__len__() < 3 or hex_to_int(line[0]) is None:
+                continue
+            description = line[4] if line.__len__() > 4 and line[4] else None
+            owner = line[6] if line.__len__() > 6 and line[6] else None
+            yield (line[0].lower(), line[1] or None, description or line[2] or None, None, owner, None)
+
+def basestation_csv_rows(filename):
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', encoding='utf-8', newline='') as f:
+        for line in csv.DictReader(f):
+            if hex_to_int(line.get('ModeS')) is None:
+                continue
+            yield (line['ModeS'].lower(), line.get('Registration') or None, line.get('Type') or line.get('ICAOTypeCode') or None,
+                   line.get('Manufacturer') or None, line.get('RegisteredOwners') or None, line.get('ModeSCountry') or None)
+
+def basestation_sqb_rows(filename):
+    conn = sqlite3.connect(filename)
+    try:
+        cur = conn.execute("select ModeS, Registration, Type, ICAOTypeCode, Manufacturer, RegisteredOwners, ModeSCountry from Aircraft")
+        for mode_s, registration, model, type_code, manufacturer, owner, country in cur:
+            if hex_to_int(mode_s) is None:
+                continue
+            yield (mode_s.lower(), registration or None, model or type_code or None, manufacturer or None, owner or None, country or None)
+    finally:
+        conn.close()
+
+def file_rows(filename):
+    if filename.endswith('.sqb'):
+        return basestation_sqb_rows(filename), 'basestation'
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt', encoding='utf-8', newline='') as f:
+        first_line = f.readline()
+    if 'ModeS' in first_line:
+        return basestation_csv_rows(filename), 'basestation'
+    return tar1090_rows(filename), 'tar1090-db'
+
+def import_registrations(filename):
+    #batched inserts, one transaction per batch. Aircraft we already know about are left alone
+    rows, source = file_rows(filename)
+    timestamp = round(datetime.datetime.now(datetime.timezone.utc).timestamp())
+    total = 0
+    batch = []
+    for row in rows:
+        batch.append((timestamp,) + row + (source,))
+        if batch.__len__() >= import_batch_size:
+            insert_batch(batch)
+            total += batch.__len__()
+            logger.info(str(total) + " registrations imported so far")
+            batch = []
+    if batch:
+        insert_batch(batch)
+        total += batch.__len__()
+    logger.info(str(total) + " registrations read from " + filename)
+    return total
+
+def insert_batch(batch):
+    def work(conn):
+        cur = conn.cursor()
+        try:
+            if config.postgres_enabled:
+                psycopg2.extras.execute_values(cur, "insert into registrations "\
+                    "(timestamp, icao_hex, registration, model, manufacturer, owner_name, owner_country, source)" \
+                    " values %s on conflict do nothing;", batch, page_size=5000)
+            else:
+                cur.executemany("insert or ignore into registrations "\
+                    "(timestamp, icao_hex, registration, model, manufacturer, owner_name, owner_country, source)" \
+                    " values (?,?,?,?,?,?,?,?);", batch)
+            conn.commit()
+        finally:
+            cur.close()
+    db_connections.write(work)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=config.logging_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    import helper_functions
+    helper_functions.create_sql_tables()
+    for registrations_file in sys.argv[1:]:
+        import_registrations(registrations_file)
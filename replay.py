@@ -0,0 +1,234 @@
+#Record aircraft.json snapshots and play them back through the processing pipeline
+# Usage: python replay.py record <recording.jsonl.gz> [polls]
+#          saves one snapshot from LIVE_DATA_URL (or the merged LIVE_DATA_URLS) every SLEEP_TIME seconds, one json document per line
+#        python replay.py play [--use-configured-db] <recording.jsonl.gz> [<recording> ...]
+#          feeds recordings through main.process_snapshot as fast as possible. Lookup APIs and Bluesky are
+#          replaced with stubs so nothing leaves the machine. Runs against a throwaway sqlite database in a
+#          temporary folder unless --use-configured-db is given, since the stubs would otherwise mark real
+#          flights as posted, cache fake misses and add fake flights to the history
+import helper_functions
+import db_connections
+import http_client
+import feeds
+import bluesky_poster
+import track_writer
+import enrichment
+import constants
+import config
+import main
+import collections
+import subprocess
+import tempfile
+import threading
+import random
+import math
+import numpy
+import gzip
+import json
+import time
+import sys
+import os
+import logging
+
+logger = logging.getLogger('Replay')
+
+def record(filename, polls=None):
+    count = 0
+    feed = feeds.create_feed_set()
+    with gzip.open(filename, 'at', encoding='utf-8') as f:
+        while polls is None or count < polls:
+            data = feed.fetch()
+            if data is not None and data is not http_client.not_modified:
+                f.write(json.dumps(data, separators=(',', ':')) + '\n')
+                f.flush()
+                count += 1
+                logger.info("Recorded snapshot " + str(count) + " with " + str(data['aircraft'].__len__()) + " aircraft")
+            time.sleep(config.sleep_time)
+    return count
+
+def read_snapshots(filename):
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, json.JSONDecodeError):
+            #a recording that was killed mid-write is still good up to its last complete snapshot
+            logger.info(filename + " ends part way through a snapshot. Using what's there")
+
+def synthetic_snapshots(count, polls, home=constants.home, spread_km=None, interval=None, seed=1):
+    #<count> aircraft flying straight lines around home, some of them close enough to record and post about
+    spread_km = config.record_radius_km * 2 if spread_km is None else spread_km
+    interval = config.sleep_time if interval is None else interval
+    rng = random.Random(seed * 100003 + count)
+    km_per_degree = 111.19
+    aircraft = []
+    for hex in rng.sample(range(0x100000, 0xffffff), count):
+        #uniform over a disc
+        dist = spread_km * math.sqrt(rng.random())
+        angle = rng.uniform(0, 2 * math.pi)
+        aircraft.append({'hex': '%06x' % hex, 'type': 'adsb_icao', 'flight': 'SYN%04d  ' % (hex % 10000),
+                         'alt_baro': rng.randrange(1000, 40000, 100), 'gs': rng.uniform(120, 480),
+                         'track': rng.uniform(0, 360), 'squawk': '%04d' % rng.randrange(1000, 7000),
+                         'lat': home[0] + dist * math.cos(angle) / km_per_degree,
+                         'lon': home[1] + dist * math.sin(angle) / (km_per_degree * math.cos(math.radians(home[0])))})
+    now = time.time()
+    for poll in range(polls):
+        yield {'now': now + poll * interval, 'messages': poll * count,
+               'aircraft': [dict(a, seen=0.1, seen_pos=0.2) for a in aircraft]}
+        for a in aircraft:
+            step_km = a['gs'] * constants.knots_to_kph * interval / 3600
+            a['lat'] += step_km * math.cos(math.radians(a['track'])) / km_per_degree
+            a['lon'] += step_km * math.sin(math.radians(a['track'])) / (km_per_degree * math.cos(math.radians(a['lat'])))
+
+class StubResponse:
+    #just enough of requests.Response for the lookup code: every provider says it doesn't know the aircraft
+    def __init__(self, url):
+        self.url = url
+        self.status_code = 404
+        self.headers = {}
+        if url.startswith(constants.adsbdb_aircraft_url):
+            self.body = {'response': 'unknown aircraft'}
+        elif url.startswith(constants.adsbdb_callsign_url):
+            self.body = {'response': 'unknown callsign'}
+        elif url.startswith(constants.aero_monthlyusage):
+            self.status_code = 200
+            self.body = {'total_cost': 0}
+        elif url.startswith('https://www.flightaware.com/'):
+            #FlightAware says it doesn't know an aircraft by not redirecting
+            self.status_code = 200
+            self.body = None
+        else:
+            self.body = {'status': '404', 'error': 'Not found.'}
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.body
+
+class StubBlueskyClient:
+    posts = 0
+
+    def on_session_change(self, callback):
+        pass
+
+    def login(self, login=None, password=None, session_string=None):
+        pass
+
+    def export_session_string(self):
+        return ''
+
+    def send_post(self, text):
+        StubBlueskyClient.posts += 1
+
+class CallCounter:
+    def __init__(self):
+        self.db_queries = 0
+        self.http_calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count_db(self, run):
+        def counted_run(work):
+            with self.lock:
+                self.db_queries += 1
+            return run(work)
+        return counted_run
+
+    def stub_http(self, delay):
+        def stub_get(url, headers=None, **kwargs):
+            with self.lock:
+                self.http_calls[http_client.host_of(url)] += 1
+            if delay:
+                time.sleep(delay)
+            return StubResponse(url)
+        return stub_get
+
+def install_stubs(provider_delay=0.0):
+    counter = CallCounter()
+    db_connections.run = counter.count_db(db_connections.run)
+    if not config.postgres_enabled:
+        #with postgres, writes go through run() and are already counted
+        db_connections.write = counter.count_db(db_connections.write)
+    http_client.get = counter.stub_http(provider_delay)
+    bluesky_poster.Client = StubBlueskyClient
+    return counter
+
+def percentiles(values):
+    if not values:
+        return {'p50': 0, 'p95': 0, 'p99': 0, 'max': 0}
+    p50, p95, p99 = numpy.percentile(values, [50, 95, 99]).tolist()
+    return {'p50': round(p50, 2), 'p95': round(p95, 2), 'p99': round(p99, 2), 'max': round(max(values), 2)}
+
+def play(snapshots, counter, post=True):
+    #runs each snapshot through the pipeline back to back and measures the poll loop's side of the work
+    main_logger = logging.getLogger('Main')
+    tracks = track_writer.create_track_writer() if config.adsb_history_enabled else None
+    enricher = enrichment.create_enrichment_pool()
+    poster = None
+    if post:
+        poster = bluesky_poster.BlueskyPoster(helper_functions.postable_flights, helper_functions.bsky_post_text,
+                                              helper_functions.mark_flights_posted,
+                                              set if enricher is None else enricher.pending_ids,
+                                              None, config.bsky_backoff_seconds, config.bsky_backoff_max)
+    latencies = []
+    queries = []
+    polls = 0
+    aircraft = 0
+    started = time.perf_counter()
+    try:
+        for data in snapshots:
+            if polls == 0:
+                helper_functions.warm_aircraft_state(data['now'])
+            queries_before = counter.db_queries
+            poll_started = time.perf_counter()
+            main.process_snapshot(main_logger, data, tracks, enricher)
+            if poster is not None:
+                poster.notify()
+            latencies.append((time.perf_counter() - poll_started) * 1000)
+            queries.append(counter.db_queries - queries_before)
+            polls += 1
+            aircraft += data['aircraft'].__len__()
+    finally:
+        #let the background work finish so its rows and queries are counted too
+        if enricher is not None:
+            enricher.close()
+        if poster is not None:
+            poster.close()
+        if tracks is not None:
+            tracks.close()
+    elapsed = time.perf_counter() - started
+    flights = helper_functions.sql_fetchone("select count(*) from flights", [])
+    return {'polls': polls,
+            'aircraft_per_poll': 0 if polls == 0 else round(aircraft / polls),
+            'poll_ms': percentiles(latencies),
+            'db_queries_per_poll': 0 if polls == 0 else round(sum(queries) / polls, 1),
+            'db_queries_total': counter.db_queries,
+            'track_rows': 0 if tracks is None else tracks.stats.rows,
+            'flights': None if flights is None else flights[0],
+            'bsky_posts': StubBlueskyClient.posts,
+            'http_calls': dict(counter.http_calls),
+            'polls_per_second': 0 if elapsed == 0 else round(polls / elapsed, 1)}
+
+if __name__ == "__main__":
+    logging.basicConfig(level=config.logging_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if sys.argv.__len__() > 2 and sys.argv[1] == 'record':
+        record(sys.argv[2], int(sys.argv[3]) if sys.argv.__len__() > 3 else None)
+    elif sys.argv.__len__() > 3 and sys.argv[1] == 'play' and sys.argv[2] == '--use-configured-db':
+        helper_functions.create_sql_tables()
+        counter = install_stubs()
+        for recording in sys.argv[3:]:
+            print(recording + ": " + json.dumps(play(read_snapshots(recording), counter)))
+        db_connections.close_all()
+    elif sys.argv.__len__() > 2 and sys.argv[1] == 'play':
+        #config is read on import, so run again in a child pointed at a temporary folder and sqlite
+        with tempfile.TemporaryDirectory() as folder:
+            env = dict(os.environ)
+            env['ADSB_SAVE_FOLDER'] = folder + os.sep
+            env['POSTGRES_ENABLED'] = 'false'
+            env['AZ_BACKUP_ENABLED'] = 'false'
+            env.pop('BSKY_SESSION_FILE', None)
+            sys.exit(subprocess.run([sys.executable, os.path.abspath(__file__), 'play', '--use-configured-db'] + sys.argv[2:], env=env).returncode)
+    else:
+        print("Usage: python replay.py record <recording.jsonl.gz> [polls] | play [--use-configured-db] <recording.jsonl.gz> [...]")
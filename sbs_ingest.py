@@ -0,0 +1,203 @@
+#Streaming ingest from a readsb/dump1090 SBS-1 (BaseStation) output, usually port 30003
+# Each line is one message about one aircraft. Messages are folded into an aircraft.json style
+# dict per aircraft so the rest of the program doesn't care where the data came from.
+# Usage: python sbs_ingest.py <recording> [port] [speed]
+#   replays a recorded SBS stream to anyone who connects, for testing without an antenna.
+#   speed 2 plays twice as fast, 0 as fast as possible
+import config
+import datetime
+import socket
+import socketserver
+import time
+import sys
+import logging
+
+logger = logging.getLogger('SBS_Ingest')
+
+#field positions in an SBS MSG line
+field_type = 1
+field_hex = 4
+field_date = 6
+field_time = 7
+field_callsign = 10
+field_altitude = 11
+field_speed = 12
+field_track = 13
+field_lat = 14
+field_lon = 15
+field_vertical_rate = 16
+field_squawk = 17
+field_emergency = 19
+field_ground = 21
+
+#how aircraft.json names the emergency squawks
+emergency_squawks = {'7500': 'unlawful', '7600': 'nordo', '7700': 'general'}
+
+def sbs_number(value, kind=float):
+    try:
+        return kind(value) if value != '' else None
+    except ValueError:
+        return None
+
+def parse_sbs_line(line):
+    #returns (hex, {aircraft.json fields}) or None for anything that isn't a usable MSG line
+    fields = line.strip().split(',')
+    if fields.__len__() < 11 or fields[0] != 'MSG' or fields[field_hex] == '':
+        return None
+    values = {}
+    if fields[field_callsign].strip() != '':
+        values['flight'] = fields[field_callsign]
+    if fields.__len__() > field_ground:
+        altitude = sbs_number(fields[field_altitude], int)
+        if altitude is not None:
+            values['alt_baro'] = altitude
+        for field, key in ((field_speed, 'gs'), (field_track, 'track'), (field_lat, 'lat'), (field_lon, 'lon')):
+            value = sbs_number(fields[field])
+            if value is not None:
+                values[key] = value
+        vertical_rate = sbs_number(fields[field_vertical_rate], int)
+        if vertical_rate is not None:
+            values['baro_rate'] = vertical_rate
+        if fields[field_squawk] != '':
+            values['squawk'] = fields[field_squawk]
+            values['emergency'] = emergency_squawks.get(fields[field_squawk], 'none')
+        if fields[field_ground] == '-1':
+            values['alt_baro'] = 'ground'
+    return fields[field_hex].lower(), values
+
+class SbsAircraftTable:
+    #latest known state of every aircraft heard on the stream
+    def __init__(self, position_interval, stale_seconds):
+        self.position_interval = position_interval
+        self.stale_seconds = stale_seconds
+        self.aircraft = {}
+        #the aircraft the last line was about, whether or not it had a position to pass on
+        self.touched = None
+        #hex -> [last message, last position, last time the position was handed on]
+        self.times = {}
+
+    def __len__(self):
+        return self.aircraft.__len__()
+
+    def update(self, line, now):
+        #returns the aircraft when it has a position worth passing on, otherwise None
+        parsed = parse_sbs_line(line)
+        self.touched = None
+        if parsed is None:
+            return None
+        hex, values = parsed
+        aircraft = self.aircraft.get(hex, None)
+        if aircraft is None:
+            aircraft = {'hex': hex, 'type': 'sbs'}
+            self.aircraft[hex] = aircraft
+            self.times[hex] = [now, None, 0]
+        times = self.times[hex]
+        times[0] = now
+        aircraft.update(values)
+        aircraft['seen'] = 0
+        self.touched = aircraft
+        if 'lat' not in values:
+            if times[1] is not None:
+                aircraft['seen_pos'] = now - times[1]
+            return None
+        times[1] = now
+        aircraft['seen_pos'] = 0
+        #a busy aircraft sends several positions a second. Only pass on one per interval
+        if now - times[2] < self.position_interval:
+            return None
+        times[2] = now
+        return aircraft
+
+    def evict(self, now):
+        #aircraft we haven't heard from in a while have gone out of range
+        for hex in [hex for hex, times in self.times.items() if now - times[0] > self.stale_seconds]:
+            del self.aircraft[hex]
+            del self.times[hex]
+
+class SbsStream:
+    def __init__(self, host, port, read_timeout=1.0, retry_max=30):
+        self.host = host
+        self.port = port
+        self.read_timeout = read_timeout
+        self.retry_max = retry_max
+        self.messages = 0
+        self.connects = 0
+
+    def connect(self):
+        retry = 1
+        while True:
+            try:
+                conn = socket.create_connection((self.host, self.port), timeout=config.http_connect_timeout)
+                conn.settimeout(self.read_timeout)
+                self.connects += 1
+                logger.info("Connected to SBS feed at " + self.host + ":" + str(self.port))
+                return conn
+            except OSError as e:
+                logger.info("Couldn't connect to SBS feed at " + self.host + ":" + str(self.port) + ". Retrying in " + str(retry) + " seconds. " + str(e))
+                time.sleep(retry)
+                retry = min(retry * 2, self.retry_max)
+
+    def lines(self):
+        #yields each line as it arrives, or None at least every read_timeout so the caller can do housekeeping
+        conn = self.connect()
+        buffer = b''
+        while True:
+            try:
+                data = conn.recv(65536)
+            except socket.timeout:
+                yield None
+                continue
+            except OSError as e:
+                data = b''
+                logger.info("SBS feed error: " + str(e))
+            if not data:
+                logger.info("SBS feed disconnected. Reconnecting")
+                conn.close()
+                buffer = b''
+                yield None
+                conn = self.connect()
+                continue
+            buffer += data
+            *complete, buffer = buffer.split(b'\n')
+            for line in complete:
+                self.messages += 1
+                yield line.decode('ascii', errors='replace')
+
+def sbs_timestamp(line):
+    fields = line.split(',')
+    try:
+        return datetime.datetime.strptime(fields[field_date] + ' ' + fields[field_time], '%Y/%m/%d %H:%M:%S.%f').timestamp()
+    except (IndexError, ValueError):
+        return None
+
+def replay_server(recording, port, speed=1.0):
+    class ReplayHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            logger.info("Replaying " + recording + " to " + str(self.client_address))
+            started = time.monotonic()
+            first = None
+            with open(recording, encoding='ascii', errors='replace') as f:
+                for line in f:
+                    timestamp = sbs_timestamp(line)
+                    if speed > 0 and timestamp is not None:
+                        first = timestamp if first is None else first
+                        wait = (timestamp - first) / speed - (time.monotonic() - started)
+                        if wait > 0:
+                            time.sleep(wait)
+                    try:
+                        self.wfile.write(line.rstrip('\r\n').encode('ascii') + b'\r\n')
+                    except OSError:
+                        return
+            logger.info("Replay to " + str(self.client_address) + " finished")
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(('', port), ReplayHandler)
+    server.daemon_threads = True
+    return server
+
+if __name__ == "__main__":
+    logging.basicConfig(level=config.logging_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    port = int(sys.argv[2]) if sys.argv.__len__() > 2 else config.sbs_port
+    speed = float(sys.argv[3]) if sys.argv.__len__() > 3 else 1.0
+    logger.info("Replay server listening on port " + str(port))
+    replay_server(sys.argv[1], port, speed).serve_forever()
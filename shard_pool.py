@@ -0,0 +1,148 @@
+#Snapshots split across worker processes by ICAO hex (PROCESS_WORKERS)
+# The poll loop runs on one core, so a snapshot with thousands of aircraft can take longer than the
+# poll interval. Here each aircraft always goes to the same worker, picked from its hex, and each
+# worker keeps its own aircraft state, track writer, enrichment pool and database connections.
+# One process handles all of an aircraft's snapshots in order, so its flight rows and track points
+# come out just as they would with one process.
+# The coordinator (the main process) fetches the feed, hands each worker its share, waits for them
+# all and adds up what they found, metrics included. Posting and tracks partition upkeep stay in the
+# coordinator. Every worker counts AeroAPI calls against the coordinator's spend tally.
+import metrics
+import config
+import multiprocessing
+import queue
+import signal
+import sys
+import time
+import zlib
+import logging
+
+logger = logging.getLogger('Shard_Pool')
+
+#how long (seconds) to wait on the workers before checking they're all still running
+result_wait = 1.0
+#how long (seconds) a worker gets to write out what it has when we shut down
+close_wait = 60
+
+def shard_of(hex, count):
+    #Python's hash() isn't the same from one process to the next, so the hex is hashed with crc32
+    return zlib.crc32(hex.replace('~', '').lower().encode('utf-8')) % count
+
+def worker_main(index, count, tasks, results, aeroapi_state, initializer, initargs):
+    #runs in each worker process. main imports this module, so it's imported here instead of at the top
+    import helper_functions
+    import track_writer
+    import enrichment
+    import db_connections
+    import main
+    logging.basicConfig(
+        level=config.logging_level,
+        format='%(asctime)s - %(name)s - shard ' + str(index) + ' - %(levelname)s - %(message)s',
+        handlers=[
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+    #ctrl+c reaches every process in the group, but it's the coordinator that decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+    helper_functions.aeroapi_spend.share(aeroapi_state)
+    main_logger = logging.getLogger('Main')
+    helper_functions.warm_aircraft_state(time.time(), keep=lambda hex: shard_of(hex, count) == index)
+    helper_functions.load_airport_index()
+    helper_functions.load_registration_index()
+    helper_functions.load_geofences()
+    helper_functions.load_negative_cache(time.time())
+    tracks = track_writer.create_track_writer() if config.adsb_history_enabled else None
+    enricher = enrichment.create_enrichment_pool()
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            now, aircraft = task
+            started = time.perf_counter()
+            counts = main.process_contacts(main_logger, {'now': now, 'aircraft': aircraft}, tracks, enricher)
+            if tracks is not None:
+                tracks.flush()
+            main.evict(now)
+            pending = [] if enricher is None else list(enricher.pending_ids())
+            #the coordinator counts polls itself, once for the whole snapshot
+            results.put((index, counts, pending, time.perf_counter() - started, metrics.take_counts(skip=(metrics.polls,))))
+    finally:
+        if enricher is not None:
+            enricher.close()
+        if tracks is not None:
+            tracks.close()
+        db_connections.close_all()
+
+class ShardPool:
+    def __init__(self, count, initializer=None, initargs=()):
+        #initializer(*initargs) runs first thing in every worker, as with multiprocessing.Pool
+        self.count = count
+        #main imports this module, so helper_functions is imported here as in worker_main
+        import helper_functions
+        #spawn rather than fork, as the coordinator already has threads and database connections open
+        context = multiprocessing.get_context('spawn')
+        self.tasks = [context.Queue() for _ in range(count)]
+        self.results = context.Queue()
+        #flights each worker still has out for enrichment, as of its last snapshot
+        self.pending = [set() for _ in range(count)]
+        self.processes = [context.Process(target=worker_main, args=(i, count, self.tasks[i], self.results, helper_functions.aeroapi_spend.state, initializer, initargs),
+                                          name='shard-' + str(i), daemon=True) for i in range(count)]
+        for process in self.processes:
+            process.start()
+        logger.info("Started " + str(count) + " shard worker processes")
+
+    def result(self):
+        while True:
+            try:
+                return self.results.get(timeout=result_wait)
+            except queue.Empty:
+                for process in self.processes:
+                    if not process.is_alive():
+                        raise RuntimeError("Shard worker " + process.name + " stopped with exit code " + str(process.exitcode))
+
+    def process(self, data):
+        #hands each worker its share of the snapshot and waits for all of them. Returns the counts added up
+        parts = [[] for _ in range(self.count)]
+        for aircraft in data['aircraft']:
+            parts[shard_of(aircraft['hex'], self.count)].append(aircraft)
+        #every worker gets every snapshot, even with nothing in it, so it still flushes and evicts on time
+        for tasks, part in zip(self.tasks, parts):
+            tasks.put((data['now'], part))
+        totals = {}
+        slowest = 0.0
+        for _ in range(self.count):
+            index, counts, pending, seconds, taken = self.result()
+            metrics.add_counts(taken)
+            self.pending[index] = set(pending)
+            slowest = max(slowest, seconds)
+            metrics.shard_seconds.observe(seconds, shard=index)
+            for key, value in counts.items():
+                totals[key] = totals.get(key, 0) + value
+        #gauges aren't sent back, so the per snapshot ones are set here
+        metrics.polls.inc()
+        metrics.aircraft_in_feed.set(totals.get('aircraft', 0))
+        metrics.contacts_in_range.set(totals.get('in_range', 0))
+        logger.debug(str(totals.get('in_range', 0)) + " of " + str(totals.get('aircraft', 0)) + " aircraft in range across " +
+                     str(self.count) + " shards. Slowest shard took " + str(round(slowest * 1000, 1)) + " ms")
+        return totals
+
+    def pending_ids(self):
+        return set().union(*self.pending)
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=close_wait)
+            if process.is_alive():
+                logger.info("Shard worker " + process.name + " didn't stop in time. Terminating it")
+                process.terminate()
+        logger.info("Shard workers stopped")
+
+def create_shard_pool():
+    if config.ingest_mode != 'poll' or config.process_workers <= 1:
+        return None
+    return ShardPool(config.process_workers)
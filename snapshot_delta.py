@@ -0,0 +1,49 @@
+#Drops contacts that haven't moved since the last aircraft.json snapshot
+# tar1090 keeps listing an aircraft for a while after its last position, with seen_pos counting up.
+# Without this every poll would re-record the same point and re-check the same aircraft.
+import threading
+import logging
+
+logger = logging.getLogger('Snapshot_Delta')
+
+class SnapshotDelta:
+    def __init__(self, stale_seconds):
+        #0 keeps positions of any age
+        self.stale_seconds = stale_seconds
+        #hex -> (lat, lon, altitude) from the previous snapshot
+        self.previous = {}
+        self.skipped_stale = 0
+        self.skipped_unchanged = 0
+        self.passed = 0
+        self.lock = threading.Lock()
+
+    def changed(self, aircraft_list):
+        #returns (aircraft with a new, recent enough position, number skipped as stale, number skipped as unchanged)
+        current = {}
+        changed = []
+        stale = unchanged = 0
+        for aircraft in aircraft_list:
+            #readsb moves a position older than a minute or so into lastPosition, with its own seen_pos
+            fix = aircraft if 'lat' in aircraft else aircraft.get('lastPosition', None)
+            if fix is None:
+                continue
+            seen_pos = fix.get('seen_pos', None)
+            if self.stale_seconds > 0 and seen_pos is not None and seen_pos > self.stale_seconds:
+                stale += 1
+                continue
+            position = (fix.get('lat', None), fix.get('lon', None), aircraft.get('alt_baro', None))
+            current[aircraft['hex']] = position
+            if self.previous.get(aircraft['hex'], None) == position:
+                unchanged += 1
+                continue
+            changed.append(aircraft)
+        with self.lock:
+            self.previous = current
+            self.skipped_stale += stale
+            self.skipped_unchanged += unchanged
+            self.passed += changed.__len__()
+        return changed, stale, unchanged
+
+    def stats(self):
+        with self.lock:
+            return {'passed': self.passed, 'skipped_stale': self.skipped_stale, 'skipped_unchanged': self.skipped_unchanged}
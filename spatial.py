@@ -0,0 +1,187 @@
+#Spatial indexing for the flights, airports and tracks tables, and the queries that use it
+# Postgres tables carry a generated "cell" column: the number of the grid cell the row's position
+# falls in, counted west to east and then south to north. Everything near a point is a handful of
+# contiguous cell ranges, one per row of the grid, which a plain btree index on cell answers.
+# SQLite gets an R*Tree virtual table per table, kept up to date by triggers.
+# Either way the index narrows things down to a box and the exact distances are worked out here.
+# Usage: python spatial.py tracks <lat> <lon> <km> <start> <end>
+#        python spatial.py flights <lat> <lon> <km> <start> <end>
+#        python spatial.py airports <lat> <lon> [count]
+#          start and end are unix timestamps
+import helper_functions
+import geometry
+import db_connections
+import constants
+import config
+import math
+import numpy
+import sys
+import logging
+
+logger = logging.getLogger('Spatial')
+
+#one degree of latitude
+km_per_degree = 111.19
+
+#tables with a position worth indexing
+spatial_tables = ('flights', 'airports', 'tracks')
+
+def bounding_boxes(lat, lon, radius_km):
+    #(min_lat, max_lat, min_lon, max_lon) boxes covering the circle, split in two where it crosses the antimeridian
+    #a little slack so rounding never leaves out a point right on the edge
+    radius_km = radius_km * 1.01
+    dlat = radius_km / km_per_degree
+    min_lat = max(-90.0, lat - dlat)
+    max_lat = min(90.0, lat + dlat)
+    widest = max(abs(min_lat), abs(max_lat))
+    if widest >= 89.9:
+        #near a pole every longitude is in range
+        return [(min_lat, max_lat, -180.0, 180.0)]
+    dlon = radius_km / (km_per_degree * math.cos(math.radians(widest)))
+    if dlon >= 180:
+        return [(min_lat, max_lat, -180.0, 180.0)]
+    min_lon = lon - dlon
+    max_lon = lon + dlon
+    if min_lon < -180:
+        return [(min_lat, max_lat, min_lon + 360, 180.0), (min_lat, max_lat, -180.0, max_lon)]
+    if max_lon > 180:
+        return [(min_lat, max_lat, min_lon, 180.0), (min_lat, max_lat, -180.0, max_lon - 360)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+def cell_ranges(lat, lon, radius_km):
+    #(first, last) cell number of every run of cells the circle could touch, numbered as in constants.cell_expression_postgres
+    ranges = []
+    for min_lat, max_lat, min_lon, max_lon in bounding_boxes(lat, lon, radius_km):
+        first_col = math.floor((min_lon + 180) / constants.grid_cell_size) % constants.grid_columns
+        last_col = min(constants.grid_columns - 1, math.floor((max_lon + 180) / constants.grid_cell_size))
+        for row in range(math.floor((min_lat + 90) / constants.grid_cell_size), math.floor((max_lat + 90) / constants.grid_cell_size) + 1):
+            ranges.append((row * constants.grid_columns + first_col, row * constants.grid_columns + last_col))
+    return ranges
+
+def near_clause(lat, lon, radius_km):
+    #where clause and values that pick out rows in range of the point via the index
+    if config.postgres_enabled:
+        ranges = cell_ranges(lat, lon, radius_km)
+        values = [value for cell_range in ranges for value in cell_range]
+        return "(" + " or ".join(["cell between %s and %s"] * ranges.__len__()) + ")", values
+    boxes = bounding_boxes(lat, lon, radius_km)
+    values = [value for box in boxes for value in box]
+    return "(" + " or ".join(["(min_lat >= ? and max_lat <= ? and min_lon >= ? and max_lon <= ?)"] * boxes.__len__()) + ")", values
+
+def rtree_table_sqlite(table):
+    return "create virtual table if not exists " + table + "_rtree using rtree(id, min_lat, max_lat, min_lon, max_lon)"
+
+def rtree_triggers_sqlite(table):
+    #keep the R*Tree in step with the table whatever writes to it
+    return ["create trigger if not exists " + table + "_rtree_insert after insert on " + table +
+            " when new.lat is not null and new.lon is not null begin"
+            " insert or replace into " + table + "_rtree values (new.id, new.lat, new.lat, new.lon, new.lon); end",
+            "create trigger if not exists " + table + "_rtree_update after update of lat, lon on " + table + " begin"
+            " delete from " + table + "_rtree where id = old.id;"
+            " insert into " + table + "_rtree select new.id, new.lat, new.lat, new.lon, new.lon"
+            " where new.lat is not null and new.lon is not null; end",
+            "create trigger if not exists " + table + "_rtree_delete after delete on " + table + " begin"
+            " delete from " + table + "_rtree where id = old.id; end"]
+
+def table_columns(cur, table):
+    cur.execute("select column_name from information_schema.columns where table_name = %s and table_schema = current_schema()", (table,))
+    return [row[0] for row in cur.fetchall()]
+
+def add_cell_columns(cur, conn):
+    #called from create_tables before tracks is created or partitioned, so tables made before the
+    # spatial index existed get the cell column too
+    for table in spatial_tables:
+        existing = table_columns(cur, table)
+        if existing and 'cell' not in existing:
+            #the column is generated, so adding it fills it in for every row already there
+            logger.info("Adding a grid cell column to " + table + ". This can take a while on a large table")
+            cur.execute("alter table " + table + " add column if not exists " + constants.cell_column_postgres)
+            conn.commit()
+    #a btree each on lat and lon can't answer "what's near here", so they go
+    cur.execute("drop index if exists uix_airports_lat; drop index if exists uix_airports_lon;"
+                "drop index if exists uix_tracks_lat; drop index if exists uix_tracks_lon;")
+    conn.commit()
+
+def create_rtrees(cur, conn):
+    #sqlite track history is kept in csv files, so only flights and airports are indexed
+    for table in ('flights', 'airports'):
+        cur.execute("select count(*) from sqlite_master where name = ?", [table + "_rtree"])
+        new_index = cur.fetchone()[0] == 0
+        cur.execute(rtree_table_sqlite(table))
+        for trigger in rtree_triggers_sqlite(table):
+            cur.execute(trigger)
+        if new_index:
+            cur.execute("insert or replace into " + table + "_rtree select id, lat, lat, lon, lon from " + table +
+                        " where lat is not null and lon is not null")
+            logger.info("Spatial index built for " + table)
+        conn.commit()
+
+def fetch(query, values):
+    rows = helper_functions.sql_fetchall(query, values)
+    return [] if rows is None else rows
+
+def within(rows, lat, lon, radius_km, lat_col, lon_col):
+    #exact filter on what the index returned, nearest first, as (distance_km, row)
+    rows = [row for row in rows if row[lat_col] is not None and row[lon_col] is not None]
+    if not rows:
+        return []
+    dists = geometry.haversine_km((lat, lon), numpy.array([float(row[lat_col]) for row in rows]),
+                                  numpy.array([float(row[lon_col]) for row in rows])).tolist()
+    found = [(dist, row) for dist, row in zip(dists, rows) if dist <= radius_km]
+    found.sort(key=lambda pair: pair[0])
+    return found
+
+def tracks_near(lat, lon, radius_km, start, end):
+    #track points within radius_km of a point between two timestamps, as (distance_km, row)
+    # rows are (timestamp, hex, flight, altitude, groundspeed, track, lat, lon, flightID)
+    if not config.postgres_enabled:
+        logger.info("Track history is only queryable with postgres. With sqlite it's in the tracks csv files")
+        return []
+    clause, values = near_clause(lat, lon, radius_km)
+    rows = fetch("select timestamp, hex, flight, altitude, groundspeed, track, lat, lon, flightID from tracks "
+                 "where timestamp between %s and %s and " + clause + " order by timestamp", [start, end] + values)
+    return within(rows, lat, lon, radius_km, 6, 7)
+
+def flights_near(lat, lon, radius_km, start, end):
+    #flights recorded within radius_km of a point between two timestamps, as (distance_km, row)
+    # rows are (id, timestamp, icao_hex, flight, altitude, lat, lon, origin_icao, dest_icao)
+    clause, values = near_clause(lat, lon, radius_km)
+    if config.postgres_enabled:
+        query = "select id, timestamp, icao_hex, flight, altitude, lat, lon, origin_icao, dest_icao from flights " \
+                "where timestamp between %s and %s and " + clause + " order by timestamp"
+    else:
+        query = "select id, timestamp, icao_hex, flight, altitude, lat, lon, origin_icao, dest_icao from flights " \
+                "where timestamp between ? and ? and id in (select id from flights_rtree where " + clause + ") order by timestamp"
+    return within(fetch(query, [start, end] + values), lat, lon, radius_km, 5, 6)
+
+def airports_nearest(lat, lon, count=1, max_km=None):
+    #the closest airports to a position, as (distance_km, (code_icao, code_iata, name, city, country_code, lat, lon))
+    # looks in a small circle first and widens it until enough airports turn up
+    radius_km = 25.0
+    limit = max_km if max_km is not None else math.pi * geometry.earth_radius_km
+    while True:
+        radius_km = min(radius_km, limit)
+        clause, values = near_clause(lat, lon, radius_km)
+        if config.postgres_enabled:
+            query = "select code_icao, code_iata, name, city, country_code, lat, lon from airports where " + clause
+        else:
+            query = "select code_icao, code_iata, name, city, country_code, lat, lon from airports " \
+                    "where id in (select id from airports_rtree where " + clause + ")"
+        found = within(fetch(query, values), lat, lon, radius_km, 5, 6)
+        if found.__len__() >= count or radius_km >= limit:
+            return found[:count]
+        radius_km *= 4
+
+if __name__ == "__main__":
+    logging.basicConfig(level=config.logging_level, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    helper_functions.create_sql_tables()
+    if sys.argv.__len__() > 6 and sys.argv[1] in ('tracks', 'flights'):
+        search = tracks_near if sys.argv[1] == 'tracks' else flights_near
+        for dist, row in search(float(sys.argv[2]), float(sys.argv[3]), float(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6])):
+            print(str(round(dist, 2)) + " km: " + str(row))
+    elif sys.argv.__len__() > 3 and sys.argv[1] == 'airports':
+        for dist, row in airports_nearest(float(sys.argv[2]), float(sys.argv[3]), int(sys.argv[4]) if sys.argv.__len__() > 4 else 1):
+            print(str(round(dist, 2)) + " km: " + str(row))
+    else:
+        print("Usage: python spatial.py tracks|flights <lat> <lon> <km> <start> <end> | airports <lat> <lon> [count]")
+    db_connections.close_all()
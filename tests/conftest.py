@@ -0,0 +1,49 @@
+#config is read on import, so the settings the tests need are set before anything imports it.
+# Everything runs against a throwaway sqlite database, and nothing is posted or served
+import tempfile
+import os
+import sys
+
+folder = tempfile.mkdtemp(prefix='aero_alerts_tests_')
+os.environ['ADSB_SAVE_FOLDER'] = folder + os.sep
+os.environ['POSTGRES_ENABLED'] = 'false'
+os.environ['BSKY_POST_ENABLED'] = 'false'
+os.environ['AZ_BACKUP_ENABLED'] = 'false'
+os.environ['METRICS_PORT'] = '0'
+os.environ.setdefault('MY_LAT', '53.5')
+os.environ.setdefault('MY_LON', '-113.5')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture(scope='session', autouse=True)
+def stubs():
+    #lookups and Bluesky are stubbed as in replay.py, so nothing leaves the machine
+    import replay
+    return replay.install_stubs()
+
+@pytest.fixture(scope='session')
+def tables():
+    import helper_functions
+    helper_functions.create_sql_tables()
+
+class RecordingClient:
+    #stands in for atproto's Client, keeping what would have been posted
+    def __init__(self):
+        self.posts = []
+
+    def on_session_change(self, callback):
+        pass
+
+    def login(self, login=None, password=None, session_string=None):
+        pass
+
+    def export_session_string(self):
+        return ''
+
+    def send_post(self, text):
+        self.posts.append(text)
+
+@pytest.fixture
+def client():
+    return RecordingClient()
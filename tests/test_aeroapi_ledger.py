@@ -0,0 +1,46 @@
+import aeroapi_ledger
+import threading
+
+def test_unknown_spend_is_not_zero():
+    #no paid lookups until FlightAware has said what's been spent
+    ledger = aeroapi_ledger.AeroApiLedger(lambda: None, 3600, 0.01)
+    assert ledger.spent() is None
+
+def test_failed_check_is_retried_without_waiting_the_interval(monkeypatch):
+    answers = [None, 2.5]
+    asked = []
+    def fetch_usage():
+        asked.append(1)
+        return answers.pop(0)
+    ledger = aeroapi_ledger.AeroApiLedger(fetch_usage, 3600, 0.01)
+    assert ledger.spent() is None
+    #inside the retry wait nothing is asked
+    assert ledger.spent() is None
+    assert asked.__len__() == 1
+    monkeypatch.setattr(aeroapi_ledger, 'retry_seconds', 0)
+    ledger.state[aeroapi_ledger.NEXT_TRY] = 0
+    assert ledger.spent() == 2.5
+    ledger.record_call()
+    assert round(ledger.spent(), 2) == 2.51
+    assert asked.__len__() == 2
+
+def test_calls_are_not_held_up_by_the_usage_check():
+    started = threading.Event()
+    release = threading.Event()
+    def fetch_usage():
+        started.set()
+        release.wait(5)
+        return 1.0
+    ledger = aeroapi_ledger.AeroApiLedger(fetch_usage, 3600, 0.01)
+    checking = threading.Thread(target=ledger.spent)
+    checking.start()
+    assert started.wait(5)
+    #record_call takes the lock, so it would wait for the check if the check held it
+    recording = threading.Thread(target=ledger.record_call)
+    recording.start()
+    recording.join(2)
+    assert not recording.is_alive()
+    release.set()
+    checking.join(5)
+    #the call made during the check isn't in FlightAware's total yet, so it's still counted
+    assert round(ledger.spent(), 2) == 1.01
@@ -0,0 +1,47 @@
+import helper_functions
+import registration_index
+import bluesky_poster
+import time
+
+def insert_flight(hex, flight):
+    return helper_functions.insert_row_returning_id("insert into flights (timestamp, icao_hex, flight, altitude, speed, heading, bearing, bsky_post)"
+                                                    " values (?,?,?,?,?,?,?,?)", [round(time.time()), hex, flight, 3000, 400, 90, 180, 0])
+
+def sweep(client, post_text=helper_functions.bsky_post_text):
+    poster = bluesky_poster.BlueskyPoster(helper_functions.postable_flights, post_text,
+                                          helper_functions.mark_flights_posted, lambda: (), None, 30, 300)
+    poster.client = client
+    try:
+        poster.sweep()
+    finally:
+        poster.close()
+    return poster
+
+def test_posts_flight_enriched_from_tar1090_index(tables, client, tmp_path):
+    #tar1090-db has a description but no manufacturer
+    filename = str(tmp_path / 'aircraft.csv')
+    with open(filename, 'w') as f:
+        f.write("c0ffee;C-FTST;B738;00;BOEING 737-800;2015;Test Airways\n")
+    registration_index.import_registrations(filename)
+    flight_id = insert_flight('c0ffee', 'TST123')
+    sweep(client)
+    assert client.posts.__len__() == 1
+    assert "Aircraft: BOEING 737-800\n" in client.posts[0]
+    assert "Tail # C-FTST\n" in client.posts[0]
+    assert helper_functions.sql_fetchone("select bsky_post from flights where id = ?", [flight_id])[0] == 1
+
+def test_bad_row_does_not_stop_the_rest(tables, client):
+    #a row that can't be turned into a post is skipped on its own, without pausing or logging out
+    bad_id = insert_flight('bad001', 'BAD1')
+    good_id = insert_flight('bad002', 'GOOD2')
+    def post_text(unposted_aircraft):
+        if unposted_aircraft[-1] == bad_id:
+            raise TypeError("can't build this one")
+        return helper_functions.bsky_post_text(unposted_aircraft)
+    poster = sweep(client, post_text)
+    assert poster.client is client
+    assert poster.paused_until == 0
+    assert bad_id in poster.retries
+    assert any("flight #GOOD2 " in post for post in client.posts)
+    assert helper_functions.sql_fetchone("select bsky_post from flights where id = ?", [good_id])[0] == 1
+    assert helper_functions.sql_fetchone("select bsky_post from flights where id = ?", [bad_id])[0] == 0
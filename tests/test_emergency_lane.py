@@ -0,0 +1,32 @@
+import emergency_lane
+import registration_index
+import time
+
+def run_lane(aircraft_list, radius_km=0):
+    sent = []
+    lane = emergency_lane.EmergencyLane(sent.append, radius_km, 1800)
+    try:
+        found = lane.check(time.time(), aircraft_list)
+    finally:
+        #waits for the details post
+        lane.close()
+    return found, sent
+
+def test_squawk_without_position(tables, tmp_path):
+    #a squawk heard before any position, from an airframe only the tar1090-db import knows
+    filename = str(tmp_path / 'aircraft.csv')
+    with open(filename, 'w') as f:
+        f.write("e77000;C-GEMR;DH8D;00;DHC-8-400;2010;Test Regional\n")
+    registration_index.import_registrations(filename)
+    found, sent = run_lane([{'hex': 'e77000', 'squawk': '7700'}])
+    assert found == 1
+    assert sent.__len__() == 2
+    assert sent[0].startswith("EMERGENCY: E77000 is declaring general emergency (squawk 7700)\n")
+    assert " km to the " not in sent[0]
+    assert sent[1].startswith("Update on the general emergency:\nAircraft detected from unknown direction!\n")
+    assert "Aircraft: DHC-8-400\n" in sent[1]
+
+def test_squawk_without_position_waits_for_one_with_a_radius(tables):
+    found, sent = run_lane([{'hex': 'e77001', 'squawk': '7700'}], radius_km=100)
+    assert found == 0
+    assert sent == []
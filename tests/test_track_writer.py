@@ -0,0 +1,20 @@
+import track_writer
+import feeds
+import numpy
+
+def test_closest_approach_is_from_each_points_receiver(monkeypatch):
+    #two receivers, 280 km apart. The flight is only heard by the second one
+    receivers = [feeds.Receiver('http://a/aircraft.json', (53.5, -113.5)), feeds.Receiver('http://b/aircraft.json', (51.0, -114.0))]
+    monkeypatch.setattr(feeds, 'receivers', receivers)
+    monkeypatch.setattr(feeds, 'home_lats', numpy.array([53.5, 51.0, 53.5]))
+    monkeypatch.setattr(feeds, 'home_lons', numpy.array([-113.5, -114.0, -113.5]))
+    #timestamp, hex, type, flight, altitude, groundspeed, track, lat, lon, flightID
+    values = [[100, 'abc123', 'adsb_icao', 'TST1', 5000, 400, 0, 51.05, -114.0, 7],
+              [110, 'abc123', 'adsb_icao', 'TST1', 4000, 400, 0, 51.01, -114.0, 7],
+              [120, 'abc123', 'adsb_icao', 'TST1', 3000, 400, 0, 51.03, -114.0, 7]]
+    summaries = track_writer.flight_summaries(values, [1, 1, 1])
+    assert summaries.__len__() == 1
+    flight_id, hex, flight, first_seen, last_seen, min_altitude, max_altitude, closest_km, closest_at, lat, lon, points = summaries[0]
+    assert (first_seen, last_seen, min_altitude, max_altitude, points) == (100, 120, 3000, 5000, 3)
+    assert closest_at == 110 and (lat, lon) == (51.01, -114.0)
+    assert abs(closest_km - 1.11) < 0.01
@@ -0,0 +1,82 @@
+#Dead-band compression for the flight tracks history
+# Each aircraft's last written point is kept. A new point is only written when the aircraft has
+# strayed from where dead reckoning from that point says it should be, or its altitude, heading
+# or speed has changed by more than a threshold. A heartbeat point is written every so often regardless.
+import math
+import threading
+import logging
+
+logger = logging.getLogger('Track_Compression')
+
+#metres per degree of latitude
+metres_per_degree = 111195.0
+knots_to_mps = 0.514444
+
+class TrackCompressor:
+    def __init__(self, position_tolerance_m, altitude_tolerance_ft, heading_tolerance, speed_tolerance_kt, heartbeat_seconds):
+        self.position_tolerance_m = position_tolerance_m
+        self.altitude_tolerance_ft = altitude_tolerance_ft
+        self.heading_tolerance = heading_tolerance
+        self.speed_tolerance_kt = speed_tolerance_kt
+        self.heartbeat_seconds = heartbeat_seconds
+        #hex -> (timestamp, lat, lon, altitude, track, speed) of the last point written
+        self.last_points = {}
+        self.points_in = 0
+        self.points_out = 0
+        self.lock = threading.Lock()
+
+    def changed(self, old, new, tolerance):
+        if old is None or new is None or isinstance(old, str) or isinstance(new, str):
+            #'ground' and missing values only count when they come or go
+            return old != new
+        return abs(new - old) > tolerance
+
+    def heading_changed(self, old, new):
+        if old is None or new is None:
+            return old != new
+        return abs((new - old + 180) % 360 - 180) > self.heading_tolerance
+
+    def off_course(self, last, now, lat, lon):
+        #where the last written point would be by now at its speed and heading
+        last_time, last_lat, last_lon, _, track, speed = last
+        travelled = 0 if track is None or speed is None else speed * knots_to_mps * (now - last_time)
+        heading = 0 if track is None else math.radians(track)
+        expected_lat = last_lat + travelled * math.cos(heading) / metres_per_degree
+        expected_lon = last_lon + travelled * math.sin(heading) / (metres_per_degree * math.cos(math.radians(last_lat)))
+        #flat earth is plenty over the few km between points
+        north = (lat - expected_lat) * metres_per_degree
+        east = (lon - expected_lon) * metres_per_degree * math.cos(math.radians(lat))
+        return math.hypot(north, east) > self.position_tolerance_m
+
+    def keep(self, now, hex, lat, lon, altitude, track, speed):
+        #True if this point should be written
+        with self.lock:
+            self.points_in += 1
+            last = self.last_points.get(hex, None)
+            if lat is None or lon is None:
+                return False
+            if (last is None
+                    or now - last[0] >= self.heartbeat_seconds
+                    or self.changed(last[3], altitude, self.altitude_tolerance_ft)
+                    or self.heading_changed(last[4], track)
+                    or self.changed(last[5], speed, self.speed_tolerance_kt)
+                    or self.off_course(last, now, lat, lon)):
+                self.last_points[hex] = (now, lat, lon, altitude, track, speed)
+                self.points_out += 1
+                return True
+            return False
+
+    def evict(self, oldest_allowed):
+        #forget aircraft we haven't written a point for in a while
+        with self.lock:
+            for hex in [hex for hex, last in self.last_points.items() if last[0] < oldest_allowed]:
+                del self.last_points[hex]
+
+    def ratio(self):
+        #points seen per point written
+        return 0 if self.points_out == 0 else self.points_in / self.points_out
+
+    def stats(self):
+        with self.lock:
+            return {'points_in': self.points_in, 'points_out': self.points_out, 'ratio': round(self.ratio(), 2),
+                    'aircraft': self.last_points.__len__()}
@@ -0,0 +1,158 @@
+#Time partitioning and retention for the Postgres tracks table
+# With TRACK_PARTITIONS set to daily or monthly, tracks is a range partitioned table on timestamp.
+# Partitions are created ahead of time, and ones older than TRACK_RETENTION_DAYS are dropped
+# or detached (left as plain tables) so old data goes without a huge delete.
+import db_connections
+import constants
+import config
+import datetime
+import re
+import time
+import logging
+
+logger = logging.getLogger('Track_Partitions')
+
+#how many partitions to keep ready past the current one
+partitions_ahead = 2
+#how often (seconds) maintain() actually does anything
+maintenance_interval = 3600
+last_maintenance = None
+
+def period_start(timestamp, interval):
+    day = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    if interval == 'monthly':
+        start = day.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(start.timestamp())
+
+def next_period(start, interval):
+    day = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+    if interval == 'monthly':
+        day = (day.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    else:
+        day = day + datetime.timedelta(days=1)
+    return int(day.timestamp())
+
+def partition_name(start, interval):
+    day = datetime.datetime.fromtimestamp(start, datetime.timezone.utc)
+    return "tracks_p" + day.strftime('%Y%m' if interval == 'monthly' else '%Y%m%d')
+
+def table_kind(cur, table):
+    #'p' for a partitioned table, 'r' for a plain one, None if it doesn't exist
+    cur.execute("select c.relkind from pg_class c join pg_namespace n on n.oid = c.relnamespace "
+                "where c.relname = %s and n.nspname = current_schema()", (table,))
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+def create_tracks(cur, conn):
+    #called from create_tables in place of the plain tracks table. maintain() adds the partitions
+    kind = table_kind(cur, 'tracks')
+    if kind == 'r':
+        migrate(cur, conn)
+    elif kind is None:
+        cur.execute(constants.tracks_partitioned_table_postgres)
+        cur.execute("create table if not exists tracks_default partition of tracks default")
+        conn.commit()
+    cur.execute(constants.tracks_partitioned_indexes_postgres)
+    conn.commit()
+
+def migrate(cur, conn):
+    #the existing plain table becomes one partition holding everything before the first new partition
+    logger.info("Converting tracks to a partitioned table. This can take a while on a large table")
+    cur.execute("select max(timestamp), max(id) from tracks")
+    max_timestamp, max_id = cur.fetchone()
+    cur.execute("alter table tracks rename to tracks_legacy")
+    #the parent's key includes timestamp, so the old key on id alone has to go
+    cur.execute("alter table tracks_legacy drop constraint tracks_pkey")
+    cur.execute(constants.tracks_partitioned_table_postgres)
+    cur.execute("create table if not exists tracks_default partition of tracks default")
+    #carry on the ids from where the old table left off
+    cur.execute("select setval(pg_get_serial_sequence('tracks', 'id'), %s)", (max(max_id or 0, 1),))
+    if max_timestamp is None:
+        cur.execute("drop table tracks_legacy")
+    else:
+        cur.execute("delete from tracks_legacy where timestamp is null")
+        cur.execute("alter table tracks_legacy alter column timestamp set not null")
+        cur.execute("alter table tracks_legacy add primary key (id, timestamp)")
+        legacy_end = next_period(period_start(max_timestamp, config.track_partitions), config.track_partitions)
+        cur.execute("alter table tracks attach partition tracks_legacy for values from (minvalue) to (%s)", (legacy_end,))
+    conn.commit()
+    logger.info("tracks is now partitioned " + config.track_partitions)
+
+def partitions(cur):
+    #(name, upper bound) of every range partition of tracks
+    cur.execute("select c.relname, pg_get_expr(c.relpartbound, c.oid) from pg_inherits i "
+                "join pg_class c on c.oid = i.inhrelid join pg_class p on p.oid = i.inhparent "
+                "where p.relname = 'tracks'")
+    found = []
+    for name, bound in cur.fetchall():
+        upper = re.search(r"TO \((\d+)\)", bound or '')
+        if upper is not None:
+            found.append((name, int(upper.group(1))))
+    return found
+
+def create_partitions(cur, conn, now):
+    existing = partitions(cur)
+    covered = max([upper for _, upper in existing], default=None)
+    start = period_start(now, config.track_partitions)
+    for _ in range(partitions_ahead + 1):
+        end = next_period(start, config.track_partitions)
+        if covered is None or start >= covered:
+            add_partition(cur, conn, partition_name(start, config.track_partitions), start, end)
+        start = end
+
+def add_partition(cur, conn, name, start, end):
+    #rows for this range may already be sitting in tracks_default (written while maintenance was failing),
+    # and postgres won't create a partition over them. So build the table on its own, move those rows
+    # across and only then attach it. Inserts into the default wait on the lock until this commits
+    cur.execute("lock table tracks_default in share row exclusive mode")
+    cur.execute("create table " + name + " (like tracks including defaults including constraints including generated)")
+    #generated columns (cell) can't be copied, the new table works them out again
+    cur.execute("select string_agg(quote_ident(column_name), ', ' order by ordinal_position) from information_schema.columns "
+                "where table_name = 'tracks' and table_schema = current_schema() and is_generated = 'NEVER'")
+    columns = cur.fetchone()[0]
+    cur.execute("with moved as (delete from tracks_default where timestamp >= %s and timestamp < %s returning *) "
+                "insert into " + name + " (" + columns + ") select " + columns + " from moved", (start, end))
+    moved = cur.rowcount
+    cur.execute("alter table tracks attach partition " + name + " for values from (%s) to (%s)", (start, end))
+    conn.commit()
+    if moved > 0:
+        logger.info("Created tracks partition " + name + ", moving " + str(moved) + " rows out of tracks_default")
+    else:
+        logger.info("Created tracks partition " + name)
+
+def apply_retention(cur, conn, now):
+    if config.track_retention_days <= 0:
+        return
+    cutoff = now - config.track_retention_days * 86400
+    for name, upper in partitions(cur):
+        if upper > cutoff:
+            continue
+        if config.track_retention_action == 'detach':
+            cur.execute("alter table tracks detach partition " + name)
+            logger.info("Detached tracks partition " + name + " past the retention period. It's still there as its own table")
+        else:
+            cur.execute("drop table " + name)
+            logger.info("Dropped tracks partition " + name + " past the retention period")
+        conn.commit()
+
+def maintain(now, force=False):
+    #create upcoming partitions and retire old ones, at most once per maintenance_interval
+    global last_maintenance
+    if not config.postgres_enabled or config.track_partitions not in ('daily', 'monthly'):
+        return
+    if not force and last_maintenance is not None and time.monotonic() - last_maintenance < maintenance_interval:
+        return
+    last_maintenance = time.monotonic()
+    def work(conn):
+        cur = conn.cursor()
+        try:
+            create_partitions(cur, conn, now)
+            apply_retention(cur, conn, now)
+        finally:
+            cur.close()
+    try:
+        db_connections.run(work)
+    except Exception as e:
+        logger.warning("Tracks partition maintenance failed, will try again later: " + str(e))
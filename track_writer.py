@@ -0,0 +1,266 @@
+#Buffered writers for the flight tracks history
+import helper_functions
+import db_connections
+import config
+import constants
+import metrics
+import geometry
+import feeds
+import numpy
+from track_compression import TrackCompressor
+import psycopg2.extras
+import datetime
+import csv
+import io
+import os
+import threading
+import time
+import logging
+
+logger = logging.getLogger('Track_Writer')
+
+class TrackWriterStats:
+    def __init__(self):
+        self.rows = 0
+        self.flushes = 0
+        self.flush_seconds = 0.0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    def record(self, rows, seconds):
+        self.rows += rows
+        self.flushes += 1
+        self.flush_seconds += seconds
+        self.last_flush_ms = seconds * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+
+    def rows_per_second(self):
+        return 0 if self.flush_seconds == 0 else self.rows / self.flush_seconds
+
+    def as_dict(self):
+        return {'rows': self.rows, 'flushes': self.flushes,
+                'rows_per_second': round(self.rows_per_second()),
+                'last_flush_ms': round(self.last_flush_ms, 1), 'max_flush_ms': round(self.max_flush_ms, 1)}
+
+class BufferedTrackWriter:
+    #rows wait here until the end of the poll, or until there are too many or they're too old
+    def __init__(self, flush_rows, flush_ms, compressor=None):
+        self.flush_rows = flush_rows
+        self.flush_ms = flush_ms
+        self.compressor = compressor
+        self.rows = []
+        self.oldest = None
+        self.latest = None
+        #set when the last flush failed. Until one works, rows only go out with the end of poll flush,
+        # so a database outage doesn't mean a reconnect attempt for every contact
+        self.failing = False
+        self.stats = TrackWriterStats()
+        #lock guards the buffer, flush_lock makes sure only one flush writes at a time
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def add(self, now, aircraft):
+        self.latest = now
+        if self.compressor is not None:
+            lat, lon = helper_functions.aircraft_lat_lon(aircraft)
+            if not self.compressor.keep(now, aircraft['hex'], lat, lon, aircraft.get('alt_baro',None),
+                                        aircraft.get('track',None), aircraft.get('gs',None)):
+                metrics.track_points_dropped.inc()
+                return
+        with self.lock:
+            if not self.rows:
+                self.oldest = time.monotonic()
+            self.rows.append(self.row(now, aircraft))
+            full = not self.failing and (self.rows.__len__() >= self.flush_rows or (time.monotonic() - self.oldest) * 1000 >= self.flush_ms)
+        if full:
+            self.flush()
+
+    def row(self, now, aircraft):
+        return helper_functions.track_values(now, aircraft)
+
+    def flush(self):
+        #rows can keep being added from another thread while a flush is writing
+        with self.flush_lock:
+            if self.compressor is not None and self.latest is not None:
+                #past the heartbeat the next point is written anyway, so there's no need to remember the last one
+                self.compressor.evict(self.latest - self.compressor.heartbeat_seconds)
+            with self.lock:
+                rows, self.rows = self.rows, []
+            if not rows:
+                return True
+            started = time.monotonic()
+            try:
+                self.write(rows)
+            except Exception as e:
+                logger.info("Error writing " + str(rows.__len__()) + " track rows, will retry at the end of the next poll: " + str(e))
+                with self.lock:
+                    self.failing = True
+                    self.rows = rows + self.rows
+                    self.oldest = time.monotonic()
+                    #don't let a long outage eat all our memory
+                    if self.rows.__len__() > self.flush_rows * 10:
+                        logger.info("Track buffer full. Discarding " + str(self.rows.__len__() - self.flush_rows * 10) + " oldest track rows")
+                        del self.rows[:self.rows.__len__() - self.flush_rows * 10]
+                return False
+            self.failing = False
+            elapsed = time.monotonic() - started
+            self.stats.record(rows.__len__(), elapsed)
+            metrics.track_rows.inc(rows.__len__())
+            logger.debug("Wrote " + str(rows.__len__()) + " track rows in " + str(round(elapsed * 1000, 1)) + " ms (" +
+                         str(round(rows.__len__() / elapsed if elapsed > 0 else 0)) + " rows/s)")
+            if self.compressor is not None:
+                logger.debug("Track compression: %s", self.compressor.stats())
+            return True
+
+    def close(self):
+        self.flush()
+        logger.info("Track writer stats: %s", self.stats.as_dict())
+        if self.compressor is not None:
+            logger.info("Track compression stats: %s", self.compressor.stats())
+
+class PostgresTrackWriter(BufferedTrackWriter):
+    track_insert = "insert into tracks "\
+    "(timestamp, hex, type, flight, altitude, groundspeed, track, lat, lon, flightID)" \
+    " values %s on conflict do nothing;"
+
+    def resolve_flight_ids(self, cur, hexes):
+        #anything we inserted recently is already in memory, the rest is looked up in one go
+        flight_ids = {}
+        missing = []
+        for hex in hexes:
+            state = helper_functions.aircraft_table.get(hex)
+            if state is not None:
+                flight_ids[hex] = state.flight_id
+            else:
+                missing.append(hex)
+        if missing:
+            cur.execute("select distinct on (icao_hex) icao_hex, id from flights where icao_hex = any(%s) order by icao_hex, id desc", (missing,))
+            for hex, flight_id in cur.fetchall():
+                flight_ids[hex] = flight_id
+        return flight_ids
+
+    def row(self, now, aircraft):
+        #the receiver rides on the end for flight_summaries, and isn't written to tracks
+        return helper_functions.track_values(now, aircraft) + [aircraft.get('receiver', None)]
+
+    def write(self, rows):
+        def work(conn):
+            cur = conn.cursor()
+            try:
+                flight_ids = self.resolve_flight_ids(cur, set(row[1] for row in rows))
+                values = [row[:9] + [flight_ids.get(row[1], None)] for row in rows]
+                psycopg2.extras.execute_values(cur, self.track_insert, values, page_size=1000)
+                summaries = flight_summaries(values, [row[9] for row in rows])
+                if summaries:
+                    psycopg2.extras.execute_values(cur, constants.flight_summaries_upsert_postgres, summaries, page_size=1000)
+                conn.commit()
+            finally:
+                cur.close()
+        db_connections.run(work)
+
+def flight_summaries(values, receivers):
+    #roll a batch of track rows up into one flight_summaries row per flight. Closest approach is measured
+    # from the home of the receiver each point came from
+    kept = [i for i, row in enumerate(values) if row[9] is not None and row[7] is not None and row[8] is not None]
+    if not kept:
+        return []
+    values = [values[i] for i in kept]
+    dists = geometry.haversine_km(feeds.receiver_homes([receivers[i] for i in kept]), numpy.array([float(row[7]) for row in values]),
+                                  numpy.array([float(row[8]) for row in values])).tolist()
+    summaries = {}
+    for row, dist in zip(values, dists):
+        timestamp, hex, _, flight, altitude, _, _, lat, lon, flight_id = row
+        altitude = altitude if isinstance(altitude, (int, float)) else None
+        summary = summaries.get(flight_id, None)
+        if summary is None:
+            summaries[flight_id] = [flight_id, hex, flight, timestamp, timestamp, altitude, altitude, round(dist, 3), timestamp, lat, lon, 1]
+            continue
+        summary[2] = summary[2] or flight
+        summary[3] = min(summary[3], timestamp)
+        summary[4] = max(summary[4], timestamp)
+        if altitude is not None:
+            summary[5] = altitude if summary[5] is None else min(summary[5], altitude)
+            summary[6] = altitude if summary[6] is None else max(summary[6], altitude)
+        if dist < summary[7]:
+            summary[7:11] = [round(dist, 3), timestamp, lat, lon]
+        summary[11] += 1
+    return [tuple(summary) for summary in summaries.values()]
+
+class CsvTrackWriter(BufferedTrackWriter):
+    #keeps today's tracks-YYYY-MM-DD.csv open and starts a new one at midnight.
+    # Each flush goes to the end of the file in one write, so shard worker processes can share it
+    def __init__(self, flush_rows, flush_ms, fsync_seconds, compressor=None):
+        super().__init__(flush_rows, flush_ms, compressor)
+        self.fsync_seconds = fsync_seconds
+        self.last_fsync = time.monotonic()
+        self.file = None
+        self.filename = None
+
+    def today_file(self):
+        todaystring = "tracks-" + datetime.datetime.now().strftime('%Y-%m-%d')
+        return os.path.join(config.adsb_save_folder, todaystring + ".csv")
+
+    def open_today(self):
+        todayfile = self.today_file()
+        if todayfile == self.filename:
+            return
+        #a new day, so let go of yesterday's file before anything tries to upload it
+        self.close_file()
+        try:
+            #whoever creates the file writes the header, even with other processes racing to do the same
+            fd = os.open(todayfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+            new_file = True
+        except FileExistsError:
+            fd = os.open(todayfile, os.O_WRONLY | os.O_APPEND)
+            new_file = False
+        self.file = os.fdopen(fd, 'ab', buffering=0)
+        self.filename = todayfile
+        if new_file:
+            self.append([constants.csv_header])
+            logger.info("Created new file for today: " + todayfile)
+            #upload the database as a daily backup step
+            if config.azure_backup_enabled:
+                helper_functions.upload_database()
+
+    def append(self, rows):
+        text = io.StringIO()
+        writer = csv.writer(text)
+        for row in rows:
+            writer.writerow(row)
+        data = text.getvalue().encode('utf-8')
+        while data:
+            data = data[self.file.write(data):]
+
+    def write(self, rows):
+        self.open_today()
+        logger.debug("Appending to csv file on disk: " + self.filename)
+        #['Timestamp', 'Hex', 'Type', 'Flight','Altitude','Groundspeed','Track','Lat','Lon','FlightID']
+        self.append([row + [helper_functions.latest_flight_id(row[1])] for row in rows])
+        if self.fsync_seconds >= 0 and time.monotonic() - self.last_fsync >= self.fsync_seconds:
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.monotonic()
+
+    def close_file(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            self.filename = None
+
+    def close(self):
+        super().close()
+        self.close_file()
+
+def create_track_compressor():
+    if not config.track_compression_enabled:
+        return None
+    compressor = TrackCompressor(config.track_position_tolerance_m, config.track_altitude_tolerance_ft,
+                                 config.track_heading_tolerance, config.track_speed_tolerance_kt, config.track_heartbeat_seconds)
+    metrics.Gauge('aero_alerts_track_compression_ratio', 'Track points seen per track point written', compressor.ratio)
+    return compressor
+
+def create_track_writer():
+    if config.postgres_enabled:
+        return PostgresTrackWriter(config.track_flush_rows, config.track_flush_ms, create_track_compressor())
+    else:
+        return CsvTrackWriter(config.track_flush_rows, config.track_flush_ms, config.track_fsync_seconds, create_track_compressor())